@@ -0,0 +1,95 @@
+"""
+Compare cold and warm `DotCi3Mixin.load_vars` on a synthetic large `.ci3/vars` tree.
+
+    python benchmarks/load_vars.py --containers 2000 --clusters 6
+
+Cold runs parse the yaml files (pure python and libyaml loader), warm runs
+are served from the pickled vars cache in `.ci3/.cache`.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import yaml
+
+from ci3.commands.dotci3 import DotCi3Mixin
+
+
+def write_vars_tree(root, containers, clusters, config_keys):
+    """Write `.ci3/vars` with global.yaml and per cluster files into root."""
+    clusters_path = os.path.join(root, '.ci3', 'vars', 'clusters')
+    os.makedirs(clusters_path)
+    global_vars = {'containers': dict(
+        ('service-{}'.format(i), {
+            'build': {'dockerfile': 'Dockerfile'},
+            'image': {'name': 'service-{}'.format(i), 'tag': 'last'},
+            'config': dict(('KEY_{}'.format(k), 'value-{}-{}'.format(i, k))
+                           for k in range(config_keys)),
+        }) for i in range(containers))}
+    with open(os.path.join(root, '.ci3', 'vars', 'global.yaml'), 'w') as stream:
+        yaml.safe_dump(global_vars, stream, default_flow_style=False)
+    for c in range(clusters):
+        cluster_vars = {'cluster': {'type': 'gke', 'image_registry_url': 'eu.gcr.io/p{}'.format(c)},
+                        'replicas': dict(('service-{}'.format(i), c + 1) for i in range(containers))}
+        with open(os.path.join(clusters_path, 'cluster-{}.yaml'.format(c)), 'w') as stream:
+            yaml.safe_dump(cluster_vars, stream, default_flow_style=False)
+
+
+def timed_load(repeat, pure_python=False):
+    """Return best time in ms of `load_vars` for the first cluster."""
+    best = None
+    csafe_loader = getattr(yaml, 'CSafeLoader', None)
+    for _ in range(repeat):
+        if pure_python and csafe_loader:
+            del yaml.CSafeLoader
+        try:
+            start = time.time()
+            DotCi3Mixin().load_vars('cluster-0')
+            elapsed = (time.time() - start) * 1000
+        finally:
+            if pure_python and csafe_loader:
+                yaml.CSafeLoader = csafe_loader
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """Entry point of the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--containers', type=int, default=1000)
+    parser.add_argument('--clusters', type=int, default=3)
+    parser.add_argument('--config-keys', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    root = tempfile.mkdtemp(prefix='kubic-bench-')
+    cwd = os.getcwd()
+    os.environ.setdefault('CI_COMMIT_REF_NAME', 'bench')
+    try:
+        write_vars_tree(root, args.containers, args.clusters, args.config_keys)
+        os.chdir(root)
+        size = sum(os.path.getsize(os.path.join(path, name))
+                   for path, _, names in os.walk(os.path.join(root, '.ci3', 'vars')) for name in names)
+        print('vars tree: {:.1f}MB, libyaml: {}'.format(size / 1e6, hasattr(yaml, 'CSafeLoader')))
+        cache = os.path.join(root, '.ci3', '.cache')
+        results = []
+        for label, pure_python in (('cold, pure python', True), ('cold, libyaml', False)):
+            best = None
+            for _ in range(args.repeat):
+                shutil.rmtree(cache, ignore_errors=True)
+                elapsed = timed_load(1, pure_python)
+                best = elapsed if best is None else min(best, elapsed)
+            results.append((label, best))
+        results.append(('warm, cached', timed_load(args.repeat)))
+        for label, elapsed in results:
+            print('{:<20} {:>9.1f}ms'.format(label, elapsed))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
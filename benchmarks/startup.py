@@ -0,0 +1,67 @@
+"""
+Measure `kubic` startup cost per subcommand.
+
+Run from a kubic-ci project folder (with `.ci3`), e.g.:
+
+    python benchmarks/startup.py --repeat 5 status access:minikube -h
+
+Each subcommand is run in a fresh interpreter with `python -X importtime`.
+Reported are the wall time and the cumulative import time (in ms) of the
+modules imported by kubic, together with the most expensive of them.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+DEFAULT_SUBCOMMANDS = ['-h', 'status', 'access:minikube', 'show:.ci3/deploy.yaml', 'build:-h']
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+RUN_KUBIC = 'import sys; from ci3.cli import main; sys.argv[0] = "kubic"; main()'
+
+
+def measure(argv):
+    """Run kubic with argv once, return wall time and import times in ms."""
+    start = time.time()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', RUN_KUBIC] + argv,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, env=dict(os.environ, CI3_CLUSTER_NAME='minikube'))
+    wall = (time.time() - start) * 1000
+    top_level = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        # Only top level imports, i.e. not nested, carry cumulative time.
+        if match and len(match.group(3)) == 1:
+            top_level[match.group(4)] = int(match.group(2)) / 1000.0
+    return {'wall_ms': wall, 'import_ms': sum(top_level.values()), 'imports': top_level}
+
+
+def main():
+    """Entry point of the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subcommands', nargs='*', default=DEFAULT_SUBCOMMANDS,
+                        help="Subcommands with args separated by `:`, e.g. `access:minikube`.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', dest='json_path', help="Write results to this file.")
+    args = parser.parse_args()
+    results = {}
+    for subcommand in args.subcommands:
+        runs = [measure(subcommand.split(':')) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run['wall_ms'])
+        heaviest = sorted(best['imports'].items(), key=lambda item: -item[1])[:5]
+        results[subcommand] = {'wall_ms': best['wall_ms'], 'import_ms': best['import_ms'],
+                               'heaviest_imports': dict(heaviest)}
+        print('{:<28} wall {:>7.1f}ms  imports {:>7.1f}ms  ({})'.format(
+            subcommand, best['wall_ms'], best['import_ms'],
+            ', '.join('{} {:.1f}'.format(name, ms) for name, ms in heaviest)))
+    if args.json_path:
+        with open(args.json_path, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Benchmark kubic commands and hot functions on a synthetic project.
+
+    python benchmarks/suite.py --services 100 --json before.json
+    git checkout my-branch
+    python benchmarks/suite.py --services 100 --json after.json --compare before.json
+
+End-to-end benchmarks run `kubic` in a fresh interpreter with fake external
+tools (see `synthetic.py`) on PATH. Function benchmarks call `load_vars`,
+`render`, manifest parsing and build context hashing in process. Reported
+is the best and the median of `--repeat` runs in ms.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import write_project, write_shims  # noqa: E402
+from ci3.buildcontext import FileHashCache, context_hash  # noqa: E402
+from ci3.commands.dotci3 import DotCi3Mixin  # noqa: E402
+from ci3.manifests import DigestStore, iter_objects, load_objects  # noqa: E402
+from ci3.repo import RepoContext  # noqa: E402
+from ci3 import templates  # noqa: E402
+
+
+RUN_KUBIC = 'import sys; from ci3.cli import main; sys.argv[0] = "kubic"; main()'
+COMMANDS = [
+    ('startup', ['-h']),
+    ('show', ['show', '.ci3/deploy.yaml']),
+    ('apply', ['apply', '.ci3/deploy.yaml']),
+    ('build', ['build', '--jobs', '4']),
+    ('push', ['push', '--push-jobs', '4']),
+    ('redo', ['redo', '--jobs', '4', '--push-jobs', '4', '--all', '--force-full']),
+]
+
+
+def summarize(timings):
+    """Return best and median of timings in ms."""
+    timings = sorted(timings)
+    return {'best_ms': timings[0], 'median_ms': timings[len(timings) // 2], 'runs': len(timings)}
+
+
+def run_command(argv, env):
+    """Run kubic with argv once, return wall time in ms."""
+    start = time.time()
+    proc = subprocess.run([sys.executable, '-c', RUN_KUBIC] + argv, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode:
+        raise RuntimeError('kubic {} failed: {}'.format(' '.join(argv), proc.stderr[-2000:]))
+    return (time.time() - start) * 1000
+
+
+def bench_commands(repeat, env, only):
+    """Measure end-to-end commands, return results by name."""
+    results = {}
+    for name, argv in COMMANDS:
+        if only and name not in only:
+            continue
+        results['command.' + name] = summarize([run_command(argv, env) for _ in range(repeat)])
+    return results
+
+
+def timed(function, repeat, setup=None):
+    """Call function repeat times, return summary of timings in ms."""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.time()
+        function()
+        timings.append((time.time() - start) * 1000)
+    return summarize(timings)
+
+
+def bench_functions(root, repeat, only):
+    """Measure hot functions in process, expect cwd to be the project root."""
+    dotci3_path = os.path.join(root, '.ci3')
+    cache_path = os.path.join(dotci3_path, '.cache')
+
+    def clear_cache():
+        shutil.rmtree(cache_path, ignore_errors=True)
+        # Also drop templates parsed in memory.
+        templates._environments.clear()
+
+    def load_vars():
+        command = DotCi3Mixin()
+        command.repo = RepoContext(root)
+        command.load_vars('minikube')
+        return command
+
+    command = load_vars()
+    text = command.render('.ci3/deploy.yaml')
+    objects = load_objects(text)
+    cluster = command.config_vars['cluster']
+
+    def render_full():
+        command.incremental_render = False
+        try:
+            command.render('.ci3/deploy.yaml')
+        finally:
+            command.incremental_render = True
+
+    service_path = os.path.join(dotci3_path, 'services', 'service-0.yaml')
+    edits = []
+
+    def edit_one_service():
+        # A commit touching a single service.
+        edits.append(None)
+        with open(service_path, 'a') as stream:
+            stream.write('# edit {}\n'.format(len(edits)))
+
+    def digests_changed():
+        DigestStore(dotci3_path, cluster['name'], cluster['namespace']).changed(objects)
+
+    def hash_context():
+        context_hash('.', 'Dockerfile', FileHashCache(dotci3_path))
+
+    def hash_context_cached():
+        hash_cache = FileHashCache(dotci3_path)
+        context_hash('.', 'Dockerfile', hash_cache)
+        hash_cache.save()
+
+    benchmarks = [
+        ('load_vars.cold', load_vars, clear_cache),
+        ('load_vars.warm', load_vars, None),
+        ('render.cold', lambda: command.render('.ci3/deploy.yaml'), clear_cache),
+        ('render.warm', lambda: command.render('.ci3/deploy.yaml'), None),
+        ('render.full', render_full, None),
+        ('render.one_changed', lambda: command.render('.ci3/deploy.yaml'), edit_one_service),
+        ('render_stream', lambda: ''.join(command.render_stream('.ci3/deploy.yaml')), None),
+        ('load_objects', lambda: load_objects(text), None),
+        ('load_objects.stream',
+         lambda: list(iter_objects(command.render_stream('.ci3/deploy.yaml'))), None),
+        ('digests_changed', digests_changed, None),
+        ('context_hash.cold', hash_context, clear_cache),
+        ('context_hash.warm', hash_context_cached, None),
+    ]
+    results = {}
+    for name, function, setup in benchmarks:
+        if only and name.split('.')[0] not in only:
+            continue
+        results['function.' + name] = timed(function, repeat, setup)
+    return results
+
+
+def compare(results, baseline):
+    """Print ratio of best times to baseline results."""
+    print('\n{:<28} {:>10} {:>10} {:>8}  (vs {})'.format(
+        'benchmark', 'baseline', 'current', 'ratio', baseline.get('revision') or '?'))
+    for name, result in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if not before:
+            continue
+        ratio = result['best_ms'] / before['best_ms'] if before['best_ms'] else float('inf')
+        print('{:<28} {:>8.1f}ms {:>8.1f}ms {:>7.2f}x'.format(
+            name, before['best_ms'], result['best_ms'], ratio))
+
+
+def revision():
+    """Return SHA of the checkout being benchmarked, None if unknown."""
+    try:
+        return RepoContext(os.path.dirname(os.path.abspath(__file__))).head_sha
+    except Exception:
+        return None
+
+
+def main():
+    """Entry point of the benchmark suite."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--clusters', type=int, default=3)
+    parser.add_argument('--config-keys', type=int, default=20)
+    parser.add_argument('--context-files', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds each fake tool invocation takes.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help="Comma separated benchmarks, e.g. `show,redo,load_vars`.")
+    parser.add_argument('--json', dest='json_path', help="Write results to this file.")
+    parser.add_argument('--compare', help="Results file of a previous run to compare with.")
+    args = parser.parse_args()
+    only = set(args.only.split(',')) if args.only else None
+    params = dict((key, getattr(args, key))
+                  for key in ('services', 'clusters', 'config_keys', 'context_files', 'latency'))
+    workdir = tempfile.mkdtemp(prefix='kubic-bench-')
+    root = os.path.join(workdir, 'project')
+    cwd = os.getcwd()
+    try:
+        sha = write_project(root, args.services, args.clusters, args.config_keys,
+                            args.context_files)
+        bin_path = write_shims(os.path.join(workdir, 'bin'), sha)
+        env = dict(os.environ, CI3_CLUSTER_NAME='minikube', FAKE_LATENCY=str(args.latency),
+                   PATH=bin_path + os.pathsep + os.environ.get('PATH', ''))
+        env.pop('CI_COMMIT_REF_NAME', None)
+        os.environ.pop('CI_COMMIT_REF_NAME', None)
+        os.chdir(root)
+        results = {}
+        results.update(bench_functions(root, args.repeat, only))
+        # Commands start from a cold cache, like in a fresh CI checkout.
+        shutil.rmtree(os.path.join(root, '.ci3', '.cache'), ignore_errors=True)
+        results.update(bench_commands(args.repeat, env, only))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'params': params,
+        'results': results,
+    }
+    for name, result in sorted(results.items()):
+        print('{:<28} best {:>9.1f}ms  median {:>9.1f}ms'.format(
+            name, result['best_ms'], result['median_ms']))
+    if args.json_path:
+        with open(args.json_path, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as stream:
+            compare(report, json.load(stream))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Synthetic kubic-ci projects and fake external tools for benchmarks.
+
+    python benchmarks/synthetic.py /tmp/bench-project --services 200 --clusters 4
+
+The project starts from the layout of `kubic init` and is scaled up to N
+services, M clusters and large vars files. Fake `docker`, `kubectl`, `git`,
+`gcloud` and `minikube` executables only sleep for the configured latency,
+so commands can be measured without a docker daemon or a cluster.
+"""
+import os
+import sys
+import stat
+import hashlib
+import argparse
+
+import yaml
+
+from ci3.commands.dotci3 import InitCommand
+
+
+BRANCH = 'bench'
+SERVICE_TEMPLATE = """
+---
+kind: Deployment
+apiVersion: apps/v1
+metadata:
+  name: {name}
+  namespace: {{{{ cluster.namespace }}}}
+spec:
+  replicas: {{{{ replicas['{name}'] }}}}
+  selector:
+    matchLabels:
+      app: {name}
+  template:
+    metadata:
+      labels:
+        app: {name}
+    spec:
+      containers:
+        - name: {name}
+          image: {{{{ cluster.image_registry_url }}}}/{{{{ containers['{name}'].image.name }}}}:{{{{ containers['{name}'].image.tag }}}}
+          env:
+          {{% for key, value in containers['{name}'].config.items() %}}
+            - name: {{{{ key }}}}
+              value: '{{{{ value }}}}'
+          {{% endfor %}}
+---
+kind: Service
+apiVersion: v1
+metadata:
+  name: {name}
+  namespace: {{{{ cluster.namespace }}}}
+spec:
+  selector:
+    app: {name}
+  ports:
+    - port: 80
+"""
+# Shims log nothing and print a line of output, `FAKE_<TOOL>_LATENCY` or
+# `FAKE_LATENCY` seconds later.
+SHIM = """#!/bin/sh
+latency=${{FAKE_{upper}_LATENCY:-${{FAKE_LATENCY:-0}}}}
+{body}
+[ "$latency" = 0 ] || sleep "$latency"
+echo "{name} $*"
+"""
+SHIM_BODIES = {
+    'docker': """case "$1" in
+  images) exit 0 ;;
+  image) echo 104857600; exit 0 ;;
+esac""",
+    'kubectl': """case "$*" in
+  *"apply -f -"*) cat > /dev/null ;;
+esac""",
+    'git': """case "$*" in
+  "rev-parse --abbrev-ref HEAD") echo {branch}; exit 0 ;;
+  "rev-parse HEAD") echo {sha}; exit 0 ;;
+  status*) exit 0 ;;
+esac""",
+    'gcloud': '',
+    'minikube': '',
+}
+
+
+def head_sha(services, clusters):
+    """Return fake but stable commit SHA of the synthetic project."""
+    return hashlib.sha1('{}-{}'.format(services, clusters).encode('utf-8')).hexdigest()
+
+
+def write_shims(bin_path, sha=None):
+    """Write fake external tools into bin_path, return it for prepending to PATH."""
+    if not os.path.isdir(bin_path):
+        os.makedirs(bin_path)
+    for name, body in SHIM_BODIES.items():
+        path = os.path.join(bin_path, name)
+        with open(path, 'w') as stream:
+            stream.write(SHIM.format(name=name, upper=name.upper(),
+                                     body=body.format(branch=BRANCH, sha=sha or '0' * 40)))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_path
+
+
+def _write_yaml(path, data):
+    with open(path, 'w') as stream:
+        yaml.safe_dump(data, stream, default_flow_style=False)
+
+
+def write_git(root, sha):
+    """Write minimal `.git` folder, enough for kubic to read branch and HEAD."""
+    heads_path = os.path.join(root, '.git', 'refs', 'heads')
+    os.makedirs(heads_path)
+    with open(os.path.join(root, '.git', 'HEAD'), 'w') as stream:
+        stream.write('ref: refs/heads/{}\n'.format(BRANCH))
+    with open(os.path.join(heads_path, BRANCH), 'w') as stream:
+        stream.write(sha + '\n')
+
+
+def write_project(root, services=50, clusters=3, config_keys=20, context_files=200):
+    """
+    Write synthetic project into root, return its commit SHA.
+
+    `config_keys` sets the size of vars per service, `context_files` the
+    number of files in the docker build context.
+    """
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        # Layout of `kubic init`, scaled up below.
+        InitCommand().run(None)
+    finally:
+        os.chdir(cwd)
+    dotci3_path = os.path.join(root, '.ci3')
+    names = ['service-{}'.format(i) for i in range(services)]
+    containers = {}
+    for i, name in enumerate(names):
+        containers[name] = {
+            'build': {'dockerfile': 'Dockerfile'},
+            'image': {'name': name, 'tag': 'last'},
+            'config': dict(('KEY_{}'.format(k), 'value-{}-{}'.format(i, k))
+                           for k in range(config_keys)),
+        }
+        if i % 10:
+            # Every tenth service is a base image of the following ones.
+            containers[name]['build']['depends_on'] = names[i - i % 10]
+    _write_yaml(os.path.join(dotci3_path, 'vars', 'global.yaml'), {
+        'containers': containers,
+        'replicas': dict((name, 1) for name in names),
+    })
+    clusters_path = os.path.join(dotci3_path, 'vars', 'clusters')
+    _write_yaml(os.path.join(clusters_path, 'minikube.yaml'), {
+        'cluster': {'type': 'minikube', 'image_registry_url': 'localhost:5000'}})
+    for c in range(clusters):
+        _write_yaml(os.path.join(clusters_path, 'cluster-{}.yaml'.format(c)), {
+            'cluster': {'type': 'gke', 'project': 'bench', 'zone': 'europe-west1-b',
+                        'image_registry_url': 'eu.gcr.io/bench-{}'.format(c)},
+            'replicas': dict((name, c + 1) for name in names),
+        })
+    services_path = os.path.join(dotci3_path, 'services')
+    includes = ["{% include 'namespace.yaml' %}"]
+    for name in names:
+        with open(os.path.join(services_path, name + '.yaml'), 'w') as stream:
+            stream.write(SERVICE_TEMPLATE.format(name=name).lstrip())
+        includes.append("{{% include 'services/{}.yaml' %}}".format(name))
+    with open(os.path.join(dotci3_path, 'deploy.yaml'), 'w') as stream:
+        stream.write('\n'.join(includes) + '\n')
+    # Docker build context.
+    with open(os.path.join(root, 'Dockerfile'), 'w') as stream:
+        stream.write('FROM scratch\nCOPY src /src\n')
+    src_path = os.path.join(root, 'src')
+    os.makedirs(src_path)
+    for i in range(context_files):
+        with open(os.path.join(src_path, 'module_{}.py'.format(i)), 'w') as stream:
+            stream.write('VALUE = {!r}\n'.format('x' * 4096))
+    sha = head_sha(services, clusters)
+    write_git(root, sha)
+    return sha
+
+
+def main():
+    """Write synthetic project and shims, print env to use them."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', help="Folder to create the project in.")
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--clusters', type=int, default=3)
+    parser.add_argument('--config-keys', type=int, default=20)
+    parser.add_argument('--context-files', type=int, default=200)
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+    sha = write_project(root, args.services, args.clusters, args.config_keys, args.context_files)
+    bin_path = write_shims(root + '-bin', sha)
+    print('cd {} && export PATH={}:$PATH CI3_CLUSTER_NAME=minikube'.format(root, bin_path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""
+Apply k8s objects in dependency tiers, objects of a tier concurrently in batches.
+
+Namespaces and CRDs come first, then configuration and RBAC workloads refer
+to, then the workloads and finally Services and Ingresses routing to them.
+Objects of other kinds, e.g. custom resources, are applied last. A tier
+starts only once the previous one has been applied without errors.
+"""
+import math
+import logging
+from collections import OrderedDict
+from functools import partial
+
+from ci3.error import Ci3Error
+from ci3.jobs import run_jobs
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+TIERS = (
+    ('namespaces', ('Namespace', 'CustomResourceDefinition', 'PriorityClass', 'StorageClass')),
+    ('config', ('ServiceAccount', 'Secret', 'ConfigMap', 'Role', 'ClusterRole', 'RoleBinding',
+                'ClusterRoleBinding', 'PersistentVolume', 'PersistentVolumeClaim', 'LimitRange',
+                'ResourceQuota', 'NetworkPolicy')),
+    ('workloads', ('Deployment', 'StatefulSet', 'DaemonSet', 'ReplicaSet', 'ReplicationController',
+                   'Pod', 'Job', 'CronJob', 'HorizontalPodAutoscaler', 'PodDisruptionBudget')),
+    ('services', ('Service', 'Endpoints', 'Ingress', 'IngressClass')),
+)
+OTHER_TIER = 'other'
+
+
+class ApplyError(Ci3Error):
+    """Raised if objects of a tier failed to apply, lists (object, error) in `failures`."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(ApplyError, self).__init__('Failed to apply {} object(s):\n{}'.format(
+            len(failures), '\n'.join('  {}: {}'.format(describe(obj), error)
+                                     for obj, error in failures)))
+
+
+def describe(obj):
+    """Return `kind/name` of k8s object, e.g. for error messages."""
+    return '{}/{}'.format(str(obj.get('kind')).lower(), (obj.get('metadata') or {}).get('name'))
+
+
+def tiers(objects):
+    """Return list of (tier name, objects) in apply order, objects keep their order."""
+    tier_of_kind = dict((kind, name) for name, kinds in TIERS for kind in kinds)
+    grouped = OrderedDict((name, []) for name, _ in TIERS + ((OTHER_TIER, ()),))
+    for obj in objects:
+        grouped[tier_of_kind.get(obj.get('kind'), OTHER_TIER)].append(obj)
+    return [(name, tier_objects) for name, tier_objects in grouped.items() if tier_objects]
+
+
+def apply_objects(backend, objects, max_workers=4):
+    """
+    Apply objects tier by tier with `backend.apply_batch`, batches of a tier concurrently.
+
+    Batches hold at most `backend.batch_size` objects, fewer if that keeps
+    all workers busy. Raise `ApplyError` with all failed objects of the
+    first tier with failures.
+    """
+    max_workers = max(1, max_workers)
+    for tier, tier_objects in tiers(objects):
+        size = max(1, min(getattr(backend, 'batch_size', 1),
+                          int(math.ceil(len(tier_objects) / float(max_workers)))))
+        jobs = OrderedDict(
+            ('{}:{}'.format(tier, start // size),
+             partial(backend.apply_batch, tier_objects[start:start + size]))
+            for start in range(0, len(tier_objects), size))
+        with span('apply ' + tier, 'deploy', objects=len(tier_objects), batches=len(jobs)):
+            results = run_jobs(jobs, max_workers=max_workers)
+        failures = [(obj, error) for result in results.values()
+                    for obj, error in result if error is not None]
+        if failures:
+            raise ApplyError(failures)
+        logger.info('Applied %d %s object(s) in %d batch(es)' % (len(tier_objects), tier, len(jobs)))
@@ -0,0 +1,189 @@
+"""Content hash of docker build contexts, used to skip builds of unchanged images."""
+import os
+import re
+import json
+import stat
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ci3.cache import atomic_write, cache_path
+
+
+logger = logging.getLogger(__name__)
+# Label set on built images, holds the context hash they were built from.
+CONTEXT_HASH_LABEL = 'ci3.context-hash'
+HASH_WORKERS = 8
+
+
+def _pattern_to_regex(pattern):
+    """Translate `.dockerignore` pattern into regex matching a relative path."""
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        else:
+            regex += re.escape(char)
+        i += 1
+    # A pattern matching a folder excludes all of its content as well.
+    return re.compile(regex + '(?:/.*)?$')
+
+
+def read_dockerignore(context_path):
+    """Return list of (regex, is_exception) rules from `.dockerignore` of the context."""
+    rules = []
+    path = os.path.join(context_path, '.dockerignore')
+    if not os.path.isfile(path):
+        return rules
+    with open(path) as stream:
+        for line in stream:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            is_exception = line.startswith('!')
+            pattern = os.path.normpath(line.lstrip('!').strip()).lstrip('/')
+            if pattern == '.':
+                continue
+            rules.append((_pattern_to_regex(pattern), is_exception))
+    return rules
+
+
+def is_ignored(relpath, rules):
+    """Return True if the context relative path is excluded, last matching rule wins."""
+    ignored = False
+    for regex, is_exception in rules:
+        if regex.match(relpath):
+            ignored = not is_exception
+    return ignored
+
+
+class FileHashCache(object):
+    """
+    SHA256 of files keyed by path, inode, size and mtime.
+
+    Stored in `.ci3/.cache/file-hashes.json`, so unchanged files are not read again.
+    """
+
+    def __init__(self, dotci3_path):
+        self.path = cache_path(dotci3_path, 'file-hashes.json')
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as stream:
+                self._hashes = json.load(stream)
+        except (IOError, OSError, ValueError):
+            self._hashes = {}
+        self._dirty = False
+
+    @staticmethod
+    def _hash_file(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as stream:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def hash_file(self, path, file_stat):
+        """Return SHA256 of the file, from cache if its stat is unchanged."""
+        signature = [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns]
+        entry = self._hashes.get(path)
+        if entry and entry[:3] == signature:
+            return entry[3]
+        digest = self._hash_file(path)
+        with self._lock:
+            self._hashes[path] = signature + [digest]
+            self._dirty = True
+        return digest
+
+    def save(self):
+        """Write cache to disk if anything has changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            atomic_write(self.path, json.dumps(self._hashes))
+            self._dirty = False
+
+
+def container_context(values):
+    """
+    Return (context path, Dockerfile path) of container vars, relative to the project root.
+
+    `build.context` defaults to the project root, `build.dockerfile` is
+    relative to the context and defaults to `Dockerfile`.
+    """
+    build = values.get('build') or {}
+    context = os.path.normpath(build.get('context') or '.')
+    return context, os.path.normpath(os.path.join(context, build.get('dockerfile') or 'Dockerfile'))
+
+
+def _walk_context(context_path, rules, exclude):
+    """Yield (relpath, stat) of all files in the context not excluded by `.dockerignore`."""
+    # Exceptions may re-include files from excluded folders, then folders can't be pruned.
+    prune = not any(is_exception for _, is_exception in rules)
+    for root, dirs, files in os.walk(context_path):
+        relroot = os.path.relpath(root, context_path)
+        relroot = '' if relroot == '.' else relroot.replace(os.path.sep, '/') + '/'
+        dirs[:] = [name for name in dirs
+                   if os.path.abspath(os.path.join(root, name)) not in exclude]
+        if prune:
+            dirs[:] = [name for name in dirs if not is_ignored(relroot + name, rules)]
+        dirs.sort()
+        for name in sorted(files):
+            relpath = relroot + name
+            if is_ignored(relpath, rules):
+                continue
+            file_stat = os.lstat(os.path.join(root, name))
+            if stat.S_ISREG(file_stat.st_mode) or stat.S_ISLNK(file_stat.st_mode):
+                yield relpath, file_stat
+
+
+def context_hash(context_path, dockerfile_path, hash_cache):
+    """
+    Return SHA256 over the build context and Dockerfile.
+
+    Covered are paths, modes and content of all files not excluded by `.dockerignore`.
+    The `.ci3/.cache` folder is always left out, it changes with every run.
+    """
+    rules = read_dockerignore(context_path)
+    exclude = set([os.path.abspath(os.path.dirname(hash_cache.path))])
+    entries = list(_walk_context(context_path, rules, exclude))
+
+    def hash_entry(entry):
+        relpath, file_stat = entry
+        path = os.path.join(context_path, relpath)
+        if stat.S_ISLNK(file_stat.st_mode):
+            return hashlib.sha256(os.readlink(path).encode('utf-8')).hexdigest()
+        return hash_cache.hash_file(os.path.abspath(path), file_stat)
+
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        digests = list(executor.map(hash_entry, entries))
+    sha = hashlib.sha256()
+    for (relpath, file_stat), digest in zip(entries, digests):
+        sha.update('{}\0{:o}\0{}\n'.format(relpath, file_stat.st_mode & 0o777, digest).encode('utf-8'))
+    dockerfile_stat = os.stat(dockerfile_path)
+    sha.update('dockerfile\0{}\n'.format(
+        hash_cache.hash_file(os.path.abspath(dockerfile_path), dockerfile_stat)).encode('utf-8'))
+    logger.debug('Hashed %d files of build context %s' % (len(entries), context_path))
+    return sha.hexdigest()
+
+
+def with_dependencies(ctx_hash, dependency_hashes):
+    """Return context hash also covering hashes of images built first, e.g. a base image."""
+    if not dependency_hashes:
+        return ctx_hash
+    sha = hashlib.sha256(ctx_hash.encode('utf-8'))
+    for dependency_hash in sorted(dependency_hashes):
+        sha.update('\0{}'.format(dependency_hash).encode('utf-8'))
+    return sha.hexdigest()
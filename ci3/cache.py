@@ -0,0 +1,102 @@
+"""Local cache folder `.ci3/.cache` for data derived from the project."""
+import os
+import pickle
+import tempfile
+
+
+CACHE_FOLDER = '.cache'
+# Pickled entries already read in this process, by pickle path.
+_loaded = {}
+
+
+def cache_path(dotci3_path, *parts):
+    """
+    Return path to `.ci3/.cache/<parts..>`, make sure its folder exists.
+
+    The cache folder ignores itself in git, so it never gets committed.
+    """
+    root = os.path.join(dotci3_path, CACHE_FOLDER)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+        with open(os.path.join(root, '.gitignore'), 'w') as gitignore:
+            gitignore.write('*\n')
+    path = os.path.join(root, *parts)
+    folder = os.path.dirname(path) if parts else path
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return path
+
+
+def atomic_write(path, data):
+    """
+    Replace file at path with data, str or bytes, in one step.
+
+    Data is written to a temporary file of its own next to path first, so
+    concurrent writers, e.g. threads of a fan-out, never clash and readers
+    never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path) or os.curdir)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data.encode('utf-8') if isinstance(data, str) else data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def file_signature(path):
+    """Return cheap signature of the file content: inode, size and mtime."""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime))
+
+
+def file_signatures(paths):
+    """Return JSON friendly list of (path, signature) of paths, signature None if missing."""
+    signatures = []
+    for path in paths:
+        try:
+            signatures.append([path, list(file_signature(path))])
+        except OSError:
+            signatures.append([path, None])
+    return signatures
+
+
+def cached_load(dotci3_path, path, load):
+    """
+    Return `load(path)`, served from a pickle in `.ci3/.cache` while path is unchanged.
+
+    The cache entry is invalidated as soon as the file signature changes.
+    Entries are also kept in memory as pickled bytes, so long running
+    processes skip the disk and every caller still gets its own copy.
+    """
+    relpath = os.path.relpath(os.path.abspath(path), dotci3_path)
+    if relpath.startswith(os.pardir):
+        return load(path)
+    pickle_path = cache_path(dotci3_path, 'pickle', relpath + '.pickle')
+    signature = file_signature(path)
+    try:
+        raw = _loaded.get(pickle_path)
+        if raw is None:
+            with open(pickle_path, 'rb') as stream:
+                raw = stream.read()
+        cached_signature, data = pickle.loads(raw)
+        if cached_signature == signature:
+            _loaded[pickle_path] = raw
+            return data
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    data = load(path)
+    raw = pickle.dumps((signature, data), pickle.HIGHEST_PROTOCOL)
+    atomic_write(pickle_path, raw)
+    _loaded[pickle_path] = raw
+    return data
+
+
+def forget_loaded():
+    """Drop entries kept in memory by `cached_load`."""
+    _loaded.clear()
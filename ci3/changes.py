@@ -0,0 +1,172 @@
+"""
+Find containers affected by git changes, so monorepos build and push only those.
+
+A container is affected if a changed path is in its build context, is its
+Dockerfile or is under one of its `build.watch` paths. Changes are diffed
+against the commit the container was last built (or pushed) at, recorded in
+`.ci3/.cache/changes.json`. Containers never recorded are diffed against the
+merge base with the base branch, and are affected if there is none.
+"""
+import os
+import json
+import logging
+import threading
+
+from ci3.buildcontext import container_context
+from ci3.cache import atomic_write, cache_path
+from ci3.error import Ci3Error
+
+
+logger = logging.getLogger(__name__)
+# Branches others are diffed against, first one found, unless `CI_DEFAULT_BRANCH` of
+# gitlab-runner is set or the default branch of `origin` is known.
+DEFAULT_BASE_BRANCHES = ('master', 'main')
+# Symbolic ref to the default branch of `origin`, set by `git clone`.
+ORIGIN_HEAD = 'refs/remotes/origin/HEAD'
+
+
+def image_repository(config_vars, name):
+    """Return `<registry>/<image name>` of container, changes are recorded per repository."""
+    return '{}/{}'.format(config_vars['cluster']['image_registry_url'],
+                          config_vars['containers'][name]['image']['name'])
+
+
+def watched_paths(values):
+    """Return project relative paths whose changes affect the image of container vars."""
+    build = values.get('build') or {}
+    watch = build.get('watch') or []
+    if not isinstance(watch, list):
+        watch = [watch]
+    return list(container_context(values)) + [os.path.normpath(path) for path in watch]
+
+
+def _is_under(path, watched):
+    return watched == '.' or path == watched or path.startswith(watched + '/')
+
+
+def with_dependents(names, depends_on):
+    """Return names extended by all names depending on them, e.g. images built on a base."""
+    selected = set(names)
+    added = True
+    while added:
+        added = False
+        for name, deps in depends_on.items():
+            if name not in selected and selected.intersection(deps):
+                selected.add(name)
+                added = True
+    return selected
+
+
+class ChangeDetector(object):
+    """
+    Diff the working tree against the last commit a stage (`build`, `push`) succeeded at.
+
+    With `since` given, all containers are diffed against that ref instead.
+    """
+
+    def __init__(self, dotci3_path, repo, stage, since=None):
+        self.path = cache_path(dotci3_path, 'changes.json')
+        self.project_path = os.path.dirname(dotci3_path)
+        self.repo = repo
+        self.stage = stage
+        self.since = since
+        self._recorded = {}
+        self._changed = {}
+        self._merge_base = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as stream:
+                return json.load(stream)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def base_branches(self):
+        """Return names of branches to look for the base branch, most likely first."""
+        if os.environ.get('CI_DEFAULT_BRANCH'):
+            return [os.environ['CI_DEFAULT_BRANCH']]
+        branches = []
+        target = self.repo.symbolic_ref(ORIGIN_HEAD)
+        prefix = ORIGIN_HEAD[:-len('HEAD')]
+        if target and target.startswith(prefix):
+            branches.append(target[len(prefix):])
+        return branches + [branch for branch in DEFAULT_BASE_BRANCHES if branch not in branches]
+
+    def _base_branch_merge_base(self):
+        """Return merge base of HEAD with the base branch, None on the base branch itself."""
+        if self._merge_base is None:
+            self._merge_base = ''
+            for branch in self.base_branches():
+                ref = next((ref for ref in ('origin/' + branch, branch)
+                            if self.repo.resolve(ref)), None)
+                if ref is None:
+                    continue
+                if self.repo.branch not in (branch, 'HEAD'):
+                    self._merge_base = self.repo.merge_base(ref) or ''
+                break
+        return self._merge_base or None
+
+    def base(self, key, recorded):
+        """Return commit to diff the image repository `key` against, None if unknown."""
+        if self.since:
+            sha = self.repo.resolve(self.since)
+            if sha is None:
+                raise Ci3Error("Unknown git ref `{}`".format(self.since))
+            return sha
+        sha = recorded.get(key)
+        if sha and self.repo.resolve(sha):
+            return sha
+        return self._base_branch_merge_base()
+
+    def changed_paths(self, base):
+        """Return paths changed since commit `base`, relative to the project root."""
+        if base not in self._changed:
+            toplevel = self.repo.toplevel
+            self._changed[base] = [
+                os.path.relpath(os.path.join(toplevel, path), self.project_path).replace(os.sep, '/')
+                for path in self.repo.changed_files(base)]
+        return self._changed[base]
+
+    def affected(self, config_vars, names=None):
+        """Return set of containers (default: all) affected by changes since their base."""
+        recorded = self._load().get(self.stage) or {}
+        containers = config_vars['containers']
+        affected = set()
+        for name in names or containers:
+            base = self.base(image_repository(config_vars, name), recorded)
+            if base is None:
+                logger.debug('No %s of %s to diff against' % (self.stage, name))
+                affected.add(name)
+                continue
+            watched = watched_paths(containers[name])
+            for path in self.changed_paths(base):
+                if any(_is_under(path, prefix) for prefix in watched):
+                    logger.debug('%s affected by %s since %s' % (name, path, base[:12]))
+                    affected.add(name)
+                    break
+        return affected
+
+    def record(self, key):
+        """Remember HEAD as the commit the stage succeeded at for image repository `key`."""
+        try:
+            sha = self.repo.head_sha
+        except Ci3Error as error:
+            # E.g. building from a source tarball, nothing to diff against later.
+            logger.debug('Not recording %s of %s: %s' % (self.stage, key, error))
+            return
+        with self._lock:
+            self._recorded[key] = sha
+
+    def save(self):
+        """Write recorded commits, unless the working tree has uncommitted changes."""
+        with self._lock:
+            recorded, self._recorded = self._recorded, {}
+        if not recorded:
+            return
+        if self.repo.is_dirty:
+            logger.debug('Working tree is dirty, not recording %s commits' % self.stage)
+            return
+        state = self._load()
+        state.setdefault(self.stage, {}).update(recorded)
+        atomic_write(self.path, json.dumps(state, indent=2, sort_keys=True))
@@ -5,12 +5,11 @@ See:
     setup.py
 """
 import argparse
+from collections import OrderedDict
+from functools import partial
 
 from ci3.commands.base import CommandLineInterface, CliCommand
-from ci3.commands.dotci3 import StatusCommand, InitCommand, ShowCommand
-from ci3.commands.k8s import ApplyCommand, AccessCommand, DeployCommand
-from ci3.commands.dkr import BuildCommand, PushCommand
-from ci3.commands.gke import GkeCommand
+from ci3.commands.dotci3 import DotCi3Mixin
 from ci3.version import __version__
 
 
@@ -18,18 +17,95 @@ BOX = u'\u2B1C'
 PROMPT = u'{box}: kubic CI {version}'.format(box=BOX, version=__version__)
 
 
-class RedoCommand(CliCommand):
-    """Shorthand for `kubic build && kubic push && kubic deploy`."""
+class RedoCommand(CliCommand, DotCi3Mixin):
+    """
+    Shorthand for `kubic build && kubic push && kubic deploy`.
+
+    Stages are pipelined per container: an image is pushed as soon as it is
+    built, while other images are still building. Deploy starts once all
+    images are pushed. All stages share the vars loaded once. With
+    `--changed` only containers affected by git changes since their last
+    build or push go through the stages, deploy patches only their
+    deployments. Images for minikube are not pushed, see `PushCommand`.
+    `--clusters` and `--canary` of deploy are not supported.
+    """
+
+    def add_arguments(self, subparser):
+        """Accept arguments of all chained commands."""
+        from ci3.commands.dkr import BuildCommand, PushCommand
+        from ci3.commands.k8s import DeployCommand
+        BuildCommand().add_arguments(subparser)
+        PushCommand().add_arguments(subparser)
+        DeployCommand().add_arguments(subparser)
 
     def run(self, args):
         """Chain three commands."""
-        BuildCommand().run(args)
-        PushCommand().run(args)
-        DeployCommand().run(args)
+        from ci3.changes import ChangeDetector
+        from ci3.commands.dkr import (BuildCommand, PushCommand, build_depends_on,
+                                      check_local_docker, push_strategy, select_changed,
+                                      stats_store)
+        from ci3.commands.k8s import DeployCommand
+        from ci3.error import Ci3Error
+        from ci3.jobs import JobOutput, run_jobs
+        if args.clusters or args.canary:
+            # Images are pushed to the registry of the current cluster only.
+            raise Ci3Error('`redo` deploys to the current cluster only, use '
+                           '`kubic push` per cluster and `kubic deploy --clusters` instead')
+        self.load_vars()
+        build, push, deploy = BuildCommand(), PushCommand(), DeployCommand()
+        for command in (build, push, deploy):
+            command.config_vars = self.config_vars
+            command.repo = self.repo
+        push.push_retries = args.push_retries
+        push.dedupe = not args.no_dedupe
+        build.registry_cache = push.registry_cache = args.registry_cache
+        build.change_detector = ChangeDetector(self.dotci3_path, self.repo, 'build', args.since)
+        push.change_detector = ChangeDetector(self.dotci3_path, self.repo, 'push', args.since)
+        build.stats = push.stats = stats_store(self)
+        if push_strategy(self.config_vars['cluster']) == 'local':
+            check_local_docker()
+        names = list(self.config_vars['containers'])
+        container_deps = dict((name, build_depends_on(self.config_vars, name)) for name in names)
+        if args.changed:
+            # Built but not pushed last time counts as well.
+            names = select_changed(names, container_deps, self.config_vars,
+                                   build.change_detector, push.change_detector)
+            deploy.only_containers = names
+        buffered = args.jobs > 1 or args.push_jobs > 1
+        jobs = OrderedDict()
+        depends_on = {}
+        groups = {}
+        for name in names:
+            build_job, push_job = 'build:' + name, 'push:' + name
+            jobs[build_job] = partial(build._build, name, JobOutput(build_job, buffered))
+            depends_on[build_job] = ['build:' + dep for dep in container_deps[name]
+                                     if dep in names]
+            groups[build_job] = 'build'
+            jobs[push_job] = partial(push._push_container, name, JobOutput(push_job, buffered))
+            depends_on[push_job] = [build_job]
+            groups[push_job] = 'push'
+        depends_on['deploy'] = [job for job in jobs if job.startswith('push:')]
+        jobs['deploy'] = partial(deploy.deploy, args)
+        # Containers which took longest to build and push so far start first.
+        durations = dict(('build:' + name, seconds)
+                         for name, seconds in build.stats.expected('build').items())
+        durations.update(('push:' + name, seconds)
+                         for name, seconds in push.stats.expected('push').items())
+        try:
+            results = run_jobs(jobs, max_workers=args.jobs + args.push_jobs, depends_on=depends_on,
+                               groups=groups, limits={'build': args.jobs, 'push': args.push_jobs},
+                               durations=durations)
+        finally:
+            build.hash_cache.save()
+            build.change_detector.save()
+            push.change_detector.save()
+            build.stats.save()
+        push.report(OrderedDict((job[len('push:'):], result) for job, result in results.items()
+                                if job.startswith('push:')))
 
 
-def main():
-    """Entry point for the CLI."""
+def build_cli():
+    """Return CLI with all commands registered."""
     # Print prompt at the start, always.
     parser = argparse.ArgumentParser(description=PROMPT)
     cli = CommandLineInterface(parser)
@@ -37,19 +113,29 @@ def main():
     # Add arguments shared between commands.
     cli.parser.add_argument('-v', '--verbose', dest='verbose',
                             action='count', default=1)
+    cli.parser.add_argument('--trace', metavar='FILE',
+                            help='write timings as Chrome trace JSON, open in ui.perfetto.dev')
 
     # Add commands with respective subcommands. See run method of each class.
-    cli.add_command('status', StatusCommand)
-    cli.add_command('init', InitCommand)
-    cli.add_command('show', ShowCommand)
-    cli.add_command('apply', ApplyCommand)
-    cli.add_command('access', AccessCommand)
-    cli.add_command('build', BuildCommand)
-    cli.add_command('push', PushCommand)
-    cli.add_command('deploy', DeployCommand)
+    # Commands are given by import path, only the selected one gets imported.
+    cli.add_command('status', 'ci3.commands.dotci3:StatusCommand')
+    cli.add_command('init', 'ci3.commands.dotci3:InitCommand')
+    cli.add_command('show', 'ci3.commands.dotci3:ShowCommand')
+    cli.add_command('apply', 'ci3.commands.k8s:ApplyCommand')
+    cli.add_command('access', 'ci3.commands.k8s:AccessCommand')
+    cli.add_command('build', 'ci3.commands.dkr:BuildCommand')
+    cli.add_command('push', 'ci3.commands.dkr:PushCommand')
+    cli.add_command('deploy', 'ci3.commands.k8s:DeployCommand')
     cli.add_command('redo', RedoCommand)
+    cli.add_command('stats', 'ci3.commands.dkr:StatsCommand')
+    cli.add_command('serve', 'ci3.commands.serve:ServeCommand')
     # TODO: implement
-    # cli.add_command('gke', GkeCommand)
+    # cli.add_command('gke', 'ci3.commands.gke:GkeCommand')
 
+    return cli
+
+
+def main():
+    """Entry point for the CLI."""
     # Parse cli arguments and execute respective command to handle them.
-    cli.run()
+    build_cli().run()
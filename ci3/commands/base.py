@@ -1,8 +1,11 @@
 """Base classes for cli."""
+import os
 import sys
+import importlib
 
 from ci3.error import Ci3Error
 from ci3.log import LogConfigurator
+from ci3.trace import span, tracer
 
 
 class CliCommand(object):
@@ -23,32 +26,92 @@ class CliCommand(object):
 class CommandLineInterface(object):
     """CLI abstraction."""
 
+    # Forward cheap commands to `kubic serve` of the project if it's running.
+    use_daemon = True
+
     def __init__(self, parser):
         """Initialize CLI class."""
         self.parser = parser
         self.subparsers = self.parser.add_subparsers()
+        self.commands = {}
 
     def add_command(self, name, cls):
-        """Add command to handle subparsed results of the cli."""
+        """
+        Add command to handle subparsed results of the cli.
+
+        `cls` is either the command class or its import path `module:Class`.
+        The latter is imported only if the command is selected on the cli, so
+        that other commands do not pay for importing their dependencies.
+        """
+        # Chained commands, e.g. redo, may add the same option more than once.
+        subparser = self.subparsers.add_parser(name, conflict_handler='resolve')
+        self.commands[name] = (cls, subparser)
+
+    @staticmethod
+    def _import_command(cls):
+        if not isinstance(cls, str):
+            return cls
+        module_name, cls_name = cls.split(':')
+        return getattr(importlib.import_module(module_name), cls_name)
+
+    def _selected_command(self, argv):
+        """Return name of the subcommand in argv, i.e. first positional matching one."""
+        takes_value = False
+        for arg in argv:
+            if takes_value:
+                takes_value = False
+                continue
+            if arg in self.commands:
+                return arg
+            if not arg.startswith('-'):
+                return None
+            # Skip value of top level options, e.g. `--trace FILE`.
+            action = self.parser._option_string_actions.get(arg)
+            takes_value = action is not None and action.nargs != 0
+        return None
+
+    def _load_command(self, name):
         # Instantiate passed command class. It will get the parsed arguments
         # passed in case the command is invoked from the cli.
-        command = cls()
-        subparser = self.subparsers.add_parser(name)
+        cls, subparser = self.commands[name]
+        command = self._import_command(cls)()
         command.add_arguments(subparser)
         subparser.set_defaults(func=command.run)
 
-    def run(self):
+    def _forward(self, name, argv):
+        """Let `kubic serve` of the project run the command, return exit code or None."""
+        from ci3.daemon import NO_DAEMON_ENV, SERVED_COMMANDS, forward
+        if not self.use_daemon or name not in SERVED_COMMANDS \
+                or os.environ.get(NO_DAEMON_ENV) or '--trace' in argv:
+            return None
+        return forward(argv, os.path.join(os.getcwd(), '.ci3'))
+
+    def run(self, argv=None):
         """Run respective command to handle parsed arguments."""
-        args = self.parser.parse_args()
+        argv = sys.argv[1:] if argv is None else argv
+        name = self._selected_command(argv)
+        if name is not None:
+            exit_code = self._forward(name, argv)
+            if exit_code is not None:
+                sys.exit(exit_code)
+            self._load_command(name)
+        args = self.parser.parse_args(argv)
         try:
             log = LogConfigurator()
-            if 'access' in sys.argv:
+            if 'access' in argv:
                 log.set_console_handler(0)
             else:
                 log.set_console_handler(args.verbose)
             if not getattr(args, 'func', None):
                 raise Ci3Error("Unknown command. See kubic -h for help")
-            args.func(args)
+            if getattr(args, 'trace', None):
+                tracer.enable()
+            try:
+                with span('kubic {}'.format(name)):
+                    args.func(args)
+            finally:
+                if tracer.enabled:
+                    tracer.save(args.trace)
         except Ci3Error as error:
             # Report ci3 errors rather as a message, not stack trace.
             print(error)
@@ -1,79 +1,529 @@
 """Docker commands."""
-import sys
+import time
 import logging
-from sh import docker, ErrorReturnCode
+from collections import OrderedDict
+from functools import partial
 
 from .base import CliCommand
 from .dotci3 import DotCi3Mixin
+from ci3.buildcontext import (CONTEXT_HASH_LABEL, FileHashCache, container_context, context_hash,
+                              with_dependencies)
+from ci3.changes import ChangeDetector, image_repository, with_dependents
 from ci3.error import Ci3Error
+from ci3.jobs import JobOutput, run_jobs
+from ci3.process import ProcessError
+from ci3.registry import RegistryError, get_registry, parse_reference
+from ci3.stats import StatsStore
+from ci3.tools import Tool
+from ci3.trace import span
 
 
 logger = logging.getLogger(__name__)
+docker = Tool('docker')
+# Substrings of docker/gcloud errors worth to retry a push for.
+TRANSIENT_REGISTRY_ERRORS = (
+    'TLS handshake timeout',
+    'i/o timeout',
+    'connection reset by peer',
+    'connection refused',
+    'net/http: request canceled',
+    'unexpected EOF',
+    '500 Internal Server Error',
+    '502 Bad Gateway',
+    '503 Service Unavailable',
+    '504 Gateway Timeout',
+    'toomanyrequests',
+)
+# Seconds to wait before the first retry, doubled with every next one.
+RETRY_BACKOFF = 2
+# How images get to clusters of a `cluster.type`: pushed to the `registry` or
+# built right into the `local` docker daemon of the cluster node.
+PUSH_STRATEGIES = {
+    'minikube': 'local',
+}
+
+
+def add_changed_arguments(subparser):
+    """Add arguments selecting containers affected by git changes."""
+    subparser.add_argument('--changed', action='store_true',
+                           help="Only containers affected by git changes since they were last "
+                                "built or pushed, see `build.context` and `build.watch` vars.")
+    subparser.add_argument('--since', metavar='REF',
+                           help="With --changed, diff against this git ref instead.")
+
+
+def stats_store(command):
+    """Return `StatsStore` recording runs of the command's cluster at HEAD, if any."""
+    def head_sha():
+        try:
+            return command.get_head_sha()
+        except Ci3Error as error:
+            logger.debug('No HEAD to record stats at: %s' % error)
+            return None
+    return StatsStore(command.dotci3_path, command.config_vars['cluster']['name'], head_sha)
+
+
+def push_strategy(cluster):
+    """Return `registry` or `local` for cluster vars, `cluster.push` overrides the type default."""
+    strategy = cluster.get('push') or PUSH_STRATEGIES.get(cluster.get('type'), 'registry')
+    if strategy not in ('registry', 'local'):
+        raise Ci3Error("Unknown push strategy `{}`, use `registry` or `local`".format(strategy))
+    return strategy
+
+
+def context_tag(tag):
+    """Return `ctx-<hash>` tag of local image labelled with its build context hash, or None."""
+    ctx_hash = str(docker.image('inspect', '--format', '{{{{ index .Config.Labels "{}" }}}}'
+                                .format(CONTEXT_HASH_LABEL), tag)).strip()
+    if not ctx_hash or ctx_hash == '<no value>':
+        return None
+    return '{}:ctx-{}'.format(tag.rsplit(':', 1)[0], ctx_hash)
+
+
+def check_local_docker():
+    """Warn if docker does not talk to the minikube node, images would not be found there."""
+    import os
+    if not os.environ.get('MINIKUBE_ACTIVE_DOCKERD'):
+        logger.warning('Docker does not use the minikube daemon, run '
+                       '`source <(kubic access <clustername>)` or set `cluster.push: registry`')
+
+
+def build_depends_on(config_vars, name):
+    """Return list of containers the build of `name` depends on (`build.depends_on`)."""
+    build = config_vars['containers'][name].get('build') or {}
+    depends_on = build.get('depends_on') or []
+    if not isinstance(depends_on, list):
+        depends_on = [depends_on]
+    for dep in depends_on:
+        if dep not in config_vars['containers']:
+            raise Ci3Error("Container `{}` depends on unknown container `{}`".format(name, dep))
+    return depends_on
+
+
+def select_changed(names, depends_on, config_vars, *detectors):
+    """Return names affected by changes found by any of the detectors, with their dependents."""
+    affected = set()
+    for detector in detectors:
+        affected.update(detector.affected(config_vars, names))
+    affected = with_dependents(affected, depends_on)
+    selected = [name for name in names if name in affected]
+    logger.info('Containers affected by changes: %s (%d unchanged)' % (
+        ', '.join(selected) or 'none', len(names) - len(selected)))
+    return selected
 
 
 class BuildCommand(CliCommand, DotCi3Mixin):
-    """Build container images with docker."""
+    """
+    Build container images with docker.
 
-    def run(self, args):
-        """Call docker to build image."""
-        self.load_vars()
-        for name in self.config_vars['containers']:
-            values = self.config_vars['containers'][name]
-            image_registry_url = self.config_vars['cluster']['image_registry_url']
-            # Tag with branch name.
-            tag = "{}/{}:{}".format(
-                image_registry_url,
-                values['image']['name'],
-                self.git_branch_ending())
+    Images are labelled with the content hash of their build context. If an
+    image of the same hash exists already, it is re-tagged instead of built.
+    Each container builds from its `build.context` folder with
+    `build.dockerfile` in it. With `--changed` only containers affected by
+    git changes since their last build are built, see `ci3.changes`.
+    Build durations are recorded, containers which took longest so far
+    start first.
+    """
+
+    registry_cache = False
+    # `ChangeDetector` recording successful builds, if any.
+    change_detector = None
+    # `StatsStore` recording build runs, if any.
+    stats = None
+    _hash_cache = None
+    _context_hashes = None
+
+    def add_arguments(self, subparser):
+        """Add cli arguments to command subparser."""
+        subparser.add_argument('-j', '--jobs', type=int, default=1,
+                               help="Number of container images to build concurrently.")
+        subparser.add_argument('--registry-cache', action='store_true',
+                               help="Look for an image of unchanged build context in the registry.")
+        add_changed_arguments(subparser)
+
+    @property
+    def hash_cache(self):
+        """Return file hash cache shared by all builds of the invocation."""
+        if self._hash_cache is None:
+            self._hash_cache = FileHashCache(self.dotci3_path)
+        return self._hash_cache
+
+    def _context_hash(self, name, path=()):
+        """Return hash of the build context of container and of those it depends on."""
+        if name in path:
+            raise Ci3Error("Cyclic dependency: {}".format(' -> '.join(path + (name,))))
+        if self._context_hashes is None:
+            self._context_hashes = {}
+        if name not in self._context_hashes:
+            context, dockerfile = container_context(self.config_vars['containers'][name])
+            with span('hash context', 'build', container=name):
+                ctx_hash = context_hash(context, dockerfile, self.hash_cache)
+            # Images built on an image of a changed context change as well.
+            dependency_hashes = [self._context_hash(dep, path + (name,))
+                                 for dep in build_depends_on(self.config_vars, name)]
+            self._context_hashes[name] = with_dependencies(ctx_hash, dependency_hashes)
+        return self._context_hashes[name]
+
+    def _find_cached_image(self, repository, ctx_hash, output):
+        """Return id or tag of an existing image built from the same context, or None."""
+        image_id = str(docker.images('-q', '--filter', 'label={}={}'.format(
+            CONTEXT_HASH_LABEL, ctx_hash))).split()
+        if image_id:
+            return image_id[0]
+        if self.registry_cache:
+            ctx_tag = '{}:ctx-{}'.format(repository, ctx_hash)
             try:
+                docker.pull(ctx_tag, _out=output, _err=output)
+                return ctx_tag
+            except ProcessError:
+                logger.debug('Image %s not found in registry' % ctx_tag)
+        return None
+
+    def _build(self, name, output):
+        """Build image of a single container, report output via `output` callback."""
+        values = self.config_vars['containers'][name]
+        repository = image_repository(self.config_vars, name)
+        # Tag with branch name.
+        tag = "{}:{}".format(repository, self.git_branch_ending())
+        context, dockerfile = container_context(values)
+        start = time.time()
+        cached_image = None
+        try:
+            ctx_hash = self._context_hash(name)
+            cached_image = self._find_cached_image(repository, ctx_hash, output)
+            if cached_image:
+                logger.info('Build context of %s unchanged, tagging %s' % (name, cached_image))
+                docker.tag(cached_image, tag, _out=output, _err=output)
+                # The image may come from another repository, deploys to local clusters use it.
+                ctx_tag = '{}:ctx-{}'.format(repository, ctx_hash)
+                if cached_image != ctx_tag:
+                    docker.tag(cached_image, ctx_tag, _out=output, _err=output)
+            else:
                 logger.info('Building %s..' % name)
-                docker.build('-t', tag, '.', _out=sys.stdout, _err=sys.stderr)
-                logger.info('Done')
-            except ErrorReturnCode as error:
-                raise Ci3Error("Failed to build docker image `{}`: {}"
-                               .format(name, error))
+                docker.build('-t', tag, '-t', '{}:ctx-{}'.format(repository, ctx_hash),
+                             '--label', '{}={}'.format(CONTEXT_HASH_LABEL, ctx_hash),
+                             '-f', dockerfile, context, _out=output, _err=output)
+            logger.info('Done')
+            if self.change_detector:
+                self.change_detector.record(repository)
+        except ProcessError as error:
+            if self.stats:
+                self.stats.record(name, 'build', time.time() - start, success=False)
+            raise Ci3Error("Failed to build docker image `{}`: {}"
+                           .format(name, error))
+        finally:
+            output.flush()
+        if self.stats:
+            self.stats.record(name, 'build', time.time() - start, cache_hit=bool(cached_image))
+        return tag
+
+    def run(self, args):
+        """Call docker to build images, independent ones concurrently."""
+        self.load_vars()
+        names = list(self.config_vars['containers'])
+        depends_on = dict((name, build_depends_on(self.config_vars, name)) for name in names)
+        self.change_detector = ChangeDetector(self.dotci3_path, self.repo, 'build', args.since)
+        self.stats = stats_store(self)
+        if args.changed:
+            names = select_changed(names, depends_on, self.config_vars, self.change_detector)
+        buffered = args.jobs > 1
+        jobs = OrderedDict(
+            (name, partial(self._build, name, JobOutput(name, buffered=buffered)))
+            for name in names)
+        # Images of unselected containers are there already.
+        depends_on = dict((name, [dep for dep in depends_on[name] if dep in jobs])
+                          for name in names)
+        self.registry_cache = args.registry_cache
+        try:
+            run_jobs(jobs, max_workers=args.jobs, depends_on=depends_on,
+                     durations=self.stats.expected('build'))
+        finally:
+            self.hash_cache.save()
+            self.change_detector.save()
+            self.stats.save()
 
 
 class PushCommand(CliCommand, DotCi3Mixin):
-    """Push container images to docker registry."""
+    """
+    Push container images to docker registry.
+
+    With `--changed` only containers affected by git changes since their
+    last push are pushed. Push durations and image sizes are recorded,
+    containers which took longest so far start first.
+
+    Images of clusters with `local` push strategy (minikube by default, see
+    `push_strategy`) are built by the docker daemon of the cluster node
+    already. They are only tagged with the commit, nothing is pushed.
+    """
 
-    def _push(self, tag):
+    push_retries = 3
+    registry_cache = False
+    dedupe = True
+    # `ChangeDetector` recording successful pushes, if any.
+    change_detector = None
+    # `StatsStore` recording push runs, if any.
+    stats = None
+
+    def add_arguments(self, subparser):
+        """Add cli arguments to command subparser."""
+        subparser.add_argument('--push-jobs', type=int, default=1,
+                               help="Number of container images to push concurrently.")
+        subparser.add_argument('--push-retries', type=int, default=3,
+                               help="Retries of a push step failed with transient registry error.")
+        subparser.add_argument('--registry-cache', action='store_true',
+                               help="Also push images tagged by build context hash.")
+        subparser.add_argument('--no-dedupe', action='store_true',
+                               help="Always push, don't look for image content in the registry.")
+        add_changed_arguments(subparser)
+
+    def _push(self, tag, output):
         logger.info('Pushing %s..' % tag)
         if self.config_vars['cluster']['type'] == 'gke':
             from .gke import push_image
-            push_image(tag)
+            push_image(tag, output)
         else:
-            docker.push(tag, _out=sys.stdout, _err=sys.stderr)
+            docker.push(tag, _out=output, _err=output)
         logger.info('Done')
 
-    def _tag_remote(self, exising_tag, new_tag):
+    def _tag_remote(self, exising_tag, new_tag, output):
         if self.config_vars['cluster']['type'] == 'gke':
             from .gke import tag_container
             logger.info('Adding tag %s..' % new_tag)
-            tag_container(exising_tag, new_tag)
+            tag_container(exising_tag, new_tag, output)
             logger.info('Done')
 
+    def _registry(self, host):
+        cluster = self.config_vars['cluster']
+        credentials = None
+        if cluster['type'] == 'gke':
+            from .gke import access_token
+            credentials = ('oauth2accesstoken', access_token())
+        return get_registry(host, credentials, cluster.get('registry_insecure', False))
+
+    def _find_pushed(self, tag_sha, tag):
+        """
+        Return (registry, repository, manifest) if the image content is already pushed.
+
+        Looked up are manifests the local image was pushed or pulled as, then
+        manifests of its commit and branch tags. The manifest must refer to
+        the local image config and all its blobs must be in the registry.
+        """
+        inspect = docker.image('inspect', '--format', '{{.Id}} {{join .RepoDigests " "}}', tag_sha)
+        image_id, _, repo_digests = str(inspect).strip().partition(' ')
+        host, repository, commit_tag = parse_reference(tag_sha)
+        name = '{}/{}'.format(host, repository)
+        references = [repo_digest.split('@', 1)[1] for repo_digest in repo_digests.split()
+                      if repo_digest.split('@', 1)[0] == name]
+        references += [commit_tag, parse_reference(tag)[2]]
+        registry = self._registry(host)
+        manifest = registry.find_image(repository, image_id, references)
+        return (registry, repository, manifest) if manifest else None
+
+    def _tag_pushed(self, pushed, tag_sha, output):
+        """Add tag to the manifest already in the registry instead of pushing."""
+        registry, repository, (media_type, raw, digest) = pushed
+        _, _, new_tag = parse_reference(tag_sha)
+        if registry.manifest_digest(repository, new_tag) == digest:
+            logger.info('%s already in the registry' % tag_sha)
+            return
+        logger.info('Content of %s already in the registry, adding tag..' % tag_sha)
+        if self.config_vars['cluster']['type'] == 'gke':
+            from .gke import tag_container
+            tag_container('{}/{}@{}'.format(registry.host, repository, digest), tag_sha, output)
+        else:
+            registry.put_manifest(repository, new_tag, media_type, raw)
+        logger.info('Done')
+
+    @staticmethod
+    def _image_size(tag):
+        """Return size of the local image in bytes, or None if unknown."""
+        try:
+            return int(str(docker.image('inspect', '--format', '{{.Size}}', tag)).strip())
+        except (ProcessError, ValueError):
+            return None
+
+    def _push_context_tag(self, tag_sha, output):
+        """Publish `ctx-<hash>` tag of the image, so `build --registry-cache` finds it."""
+        ctx_tag = context_tag(tag_sha)
+        if not ctx_tag:
+            return
+        if self.config_vars['cluster']['type'] == 'gke':
+            self._tag_remote(tag_sha, ctx_tag, output)
+        else:
+            docker.tag(tag_sha, ctx_tag, _out=output, _err=output)
+            self._push(ctx_tag, output)
+
+    def _retry(self, step, output, *step_args):
+        """Call `step`, retry with exponential backoff on transient registry errors."""
+        attempt = 0
+        while True:
+            attempt += 1
+            output.tail.clear()
+            try:
+                step(*step_args, output=output)
+                return attempt
+            except ProcessError as error:
+                failure = '\n'.join(output.tail) + str(error)
+                if attempt > self.push_retries or not any(
+                        pattern in failure for pattern in TRANSIENT_REGISTRY_ERRORS):
+                    raise
+                delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+                logger.warning('Transient registry error, retrying in %ss: %s'
+                               % (delay, error))
+                time.sleep(delay)
+
+    def _tag_local(self, name, tag, tag_sha, output):
+        """Tag image in the cluster's docker daemon with git sha, the cluster uses it from there."""
+        start = time.time()
+        try:
+            docker.tag(tag, tag_sha, _out=output, _err=output)
+        except ProcessError as error:
+            raise Ci3Error("Failed to tag docker image `{}`: {}".format(tag, error))
+        finally:
+            output.flush()
+        if self.change_detector:
+            self.change_detector.record(image_repository(self.config_vars, name))
+        return {
+            'tag': tag_sha,
+            'seconds': time.time() - start,
+            'bytes': self._image_size(tag_sha),
+            'attempts': 1,
+            'pushed': None,
+        }
+
+    def _push_container(self, name, output):
+        """Tag image of a single container with git sha and push it."""
+        values = self.config_vars['containers'][name]
+        image_registry_url = self.config_vars['cluster']['image_registry_url']
+        # Tag with branch name.
+        tag = "{}/{}:{}".format(
+            image_registry_url,
+            values['image']['name'],
+            self.git_branch_ending())
+        # Tag with git sha
+        tag_sha = "{}/{}:{}".format(
+            image_registry_url,
+            values['image']['name'],
+            'commit-' + self.get_head_sha())
+        if push_strategy(self.config_vars['cluster']) == 'local':
+            return self._tag_local(name, tag, tag_sha, output)
+        start = time.time()
+        try:
+            docker.tag(tag, tag_sha, _out=output, _err=output)
+            # .. and then push, unless the registry has the content already.
+            pushed = None
+            if self.dedupe:
+                try:
+                    pushed = self._find_pushed(tag_sha, tag)
+                    if pushed:
+                        attempts = self._retry(self._tag_pushed, output, pushed, tag_sha)
+                except (RegistryError, ProcessError, OSError, ValueError) as error:
+                    logger.warning('Registry lookup of %s failed, pushing: %s' % (tag_sha, error))
+                    pushed = None
+            if not pushed:
+                attempts = self._retry(self._push, output, tag_sha)
+            attempts += self._retry(self._tag_remote, output, tag_sha, tag) - 1
+            if self.registry_cache:
+                attempts += self._retry(self._push_context_tag, output, tag_sha) - 1
+        except ProcessError as error:
+            if self.stats:
+                self.stats.record(name, 'push', time.time() - start, success=False)
+            raise Ci3Error("Failed to push docker image `{}`: {}"
+                           .format(tag, error))
+        finally:
+            output.flush()
+        if self.change_detector:
+            self.change_detector.record(image_repository(self.config_vars, name))
+        result = {
+            'tag': tag_sha,
+            'seconds': time.time() - start,
+            'bytes': self._image_size(tag_sha),
+            'attempts': attempts,
+            'pushed': not pushed,
+        }
+        if self.stats:
+            self.stats.record(name, 'push', result['seconds'], cache_hit=bool(pushed),
+                              size=result['bytes'])
+        return result
+
+    @staticmethod
+    def report(results):
+        """
+        Print per image push timing and size.
+
+        The size is that of the local image, not what was uploaded: `tagged`
+        images were in the registry already, `local` ones are not pushed.
+        """
+        print('{:<30} {:>9} {:>10} {:>14} {:>7}  {}'.format(
+            'container', 'time', 'image size', 'attempts', 'result', 'tag'))
+        for name, result in results.items():
+            size = result['bytes']
+            print('{:<30} {:>8.1f}s {:>10} {:>3} attempt(s) {:>7}  {}'.format(
+                name, result['seconds'],
+                '?' if size is None else '{:.1f}MB'.format(size / 1e6),
+                result['attempts'], 'local' if result['pushed'] is None
+                else 'pushed' if result['pushed'] else 'tagged', result['tag']))
+
     def run(self, args):
-        """Call docker to push image."""
+        """Call docker to push images, concurrently with bounded number of jobs."""
         self.load_vars()
-        for name in self.config_vars['containers']:
-            values = self.config_vars['containers'][name]
-            image_registry_url = self.config_vars['cluster']['image_registry_url']
-            # Tag with branch name.
-            tag = "{}/{}:{}".format(
-                image_registry_url,
-                values['image']['name'],
-                self.git_branch_ending())
-            try:
-                # Tag with git sha
-                tag_sha = "{}/{}:{}".format(
-                    image_registry_url,
-                    values['image']['name'],
-                    'commit-' + self.get_head_sha())
-                docker.tag(tag, tag_sha, _out=sys.stdout, _err=sys.stderr)
-                # .. and then push
-                self._push(tag_sha)
-                self._tag_remote(tag_sha, tag)
-            except ErrorReturnCode as error:
-                raise Ci3Error("Failed to push docker image `{}`: {}"
-                               .format(tag, error))
+        self.push_retries = args.push_retries
+        self.registry_cache = args.registry_cache
+        self.dedupe = not args.no_dedupe
+        names = list(self.config_vars['containers'])
+        self.change_detector = ChangeDetector(self.dotci3_path, self.repo, 'push', args.since)
+        self.stats = stats_store(self)
+        if push_strategy(self.config_vars['cluster']) == 'local':
+            check_local_docker()
+        if args.changed:
+            depends_on = dict((name, build_depends_on(self.config_vars, name)) for name in names)
+            names = select_changed(names, depends_on, self.config_vars, self.change_detector)
+        buffered = args.push_jobs > 1
+        jobs = OrderedDict(
+            (name, partial(self._push_container, name, JobOutput(name, buffered=buffered)))
+            for name in names)
+        try:
+            self.report(run_jobs(jobs, max_workers=args.push_jobs,
+                                 durations=self.stats.expected('push')))
+        finally:
+            self.change_detector.save()
+            self.stats.save()
+
+
+class StatsCommand(CliCommand, DotCi3Mixin):
+    """
+    Report recorded build and push runs of containers.
+
+    Per container and stage shown are the number of runs, failures, median
+    and 95th percentile seconds, how often the image was reused (build) or
+    already in the registry (push), the last image size and how much slower
+    recent runs got, if noticeably.
+    """
+
+    def add_arguments(self, subparser):
+        """Add cli arguments to command subparser."""
+        subparser.add_argument('--stage', choices=('build', 'push'),
+                               help="Report only runs of this stage.")
+        subparser.add_argument('--runs', type=int, default=50,
+                               help="Number of last runs per container to report on.")
+
+    def run(self, args):
+        """Print summary of runs per container and stage."""
+        from ci3.stats import summarize
+        runs = StatsStore(self.get_dotci3_path()).runs(args.stage, args.runs)
+        if not runs:
+            print('No runs recorded yet, run `kubic build` or `kubic push` first.')
+            return
+        row = '{:<30} {:<6} {:>5} {:>6} {:>9} {:>9} {:>6} {:>10}  {}'
+        print(row.format('container', 'stage', 'runs', 'failed', 'p50', 'p95', 'hits', 'size',
+                         '').rstrip())
+        for (container, stage), container_runs in sorted(runs.items()):
+            summary = summarize(container_runs)
+            print(row.format(
+                container, stage, summary['runs'], summary['failures'],
+                '-' if summary['p50'] is None else '{:.1f}s'.format(summary['p50']),
+                '-' if summary['p95'] is None else '{:.1f}s'.format(summary['p95']),
+                '{:.0%}'.format(summary['hit_rate']),
+                '-' if summary['bytes'] is None else '{:.1f}MB'.format(summary['bytes'] / 1e6),
+                'SLOWER {:.1f}x'.format(summary['regression']) if summary['regression'] else ''
+            ).rstrip())
@@ -1,11 +1,15 @@
 """Basic Cli commands to interact with the content of `.ci3` folder."""
 import os
 import re
-import yaml
+import copy
+import sys
 import logging
-import jinja2
 
+from ci3.cache import cached_load
 from ci3.error import Ci3Error
+from ci3.repo import get_repo_context
+from ci3.templates import buffered, get_template
+from ci3.trace import span
 from .base import CliCommand
 
 
@@ -20,6 +24,10 @@ class MissingDotCi3Folder(Ci3Error):
 class DotCi3Mixin(object):
     """Help with `.ci3` folder project configuration."""
 
+    # Render templates made of includes include by include, reusing cached
+    # output of unchanged ones. See `ci3.incremental`.
+    incremental_render = True
+
     @property
     def dotci3_path(self):
         """Return fullpath string to `.ci3` folder."""
@@ -58,25 +66,25 @@ class DotCi3Mixin(object):
         """Return fullpath string to `.ci3/deploy.yaml` jinja2 template."""
         return os.path.join(self.dotci3_path, 'deploy.yaml')
 
-    @staticmethod
-    def git_branch_ending():
+    @property
+    def repo(self):
+        """Return git `RepoContext` of the project, shared within the invocation."""
+        if getattr(self, '_repo', None) is None:
+            self._repo = get_repo_context()
+        return self._repo
+
+    @repo.setter
+    def repo(self, value):
+        self._repo = value
+
+    def git_branch_ending(self):
         """
         Lookup and return currently checkout git branch.
 
         Pick the postfix ending matching [alphanumerical, "_", "-"]. Function strictly cuts any
         prefix that does not match those criteria. E.g. "feature/foo-bar" -> "-feat"
         """
-        if 'CI_COMMIT_REF_NAME' in os.environ:
-            # We are inside gitlab-runner, so branches are not checkout.
-            # Solution is to pick the name for them ENV variable.
-            name = os.environ['CI_COMMIT_REF_NAME'].strip()
-        else:
-            from sh import git, ErrorReturnCode
-            try:
-                result = git('rev-parse', '--abbrev-ref', 'HEAD')
-            except ErrorReturnCode as error:
-                raise Ci3Error("Failed to get the name of the current git branch: %s" % error)
-            name = result.strip()
+        name = self.repo.branch
         # Cutting the non-matching prefix.
         ending = re.search('[a-zA-Z0-9_\-]*$', name)
         if ending is None:
@@ -84,23 +92,25 @@ class DotCi3Mixin(object):
                            "underscore, minus")
         return ending.group()
 
-    @staticmethod
-    def get_head_sha():
+    def get_head_sha(self):
         """Get SHA1 of the local git HEAD."""
-        from sh import git, ErrorReturnCode
-        try:
-            result = git('rev-parse', 'HEAD')
-        except ErrorReturnCode as error:
-            raise Ci3Error("Failed to get SHA1 of the local git HEAD: %s" % error)
-        return result.strip()
+        return self.repo.head_sha
+
+    def _load_yaml(self, path):
+        """Load yaml file with libyaml if available, cached while the file is unchanged."""
+        def load(path):
+            import yaml
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            with span('parse yaml', 'vars', path=path), open(path) as vars_stream:
+                return yaml.load(vars_stream, Loader=loader)
+        return cached_load(self.dotci3_path, path, load)
 
     def _load_global_vars(self):
         """Load global vars from `.ci3` project folder."""
         global_vars_path = os.path.join(self.vars_path, 'global.yaml')
         if not os.path.exists(global_vars_path):
             raise IOError('Path does not exists: %s' % global_vars_path)
-        with open(global_vars_path) as vars_stream:
-            self.config_vars = yaml.load(vars_stream)
+        self.config_vars = self._load_yaml(global_vars_path)
         if self.config_vars is None:
             self.config_vars = {}
 
@@ -118,20 +128,28 @@ class DotCi3Mixin(object):
         self.config_vars['cluster']['name'] = cluster_name
         cluster_vars = self.config_vars['cluster']
         # Finally load vars and update config.
-        with open(os.path.join(self.cluster_vars_path,
-                               self.config_vars['cluster']['name']) + '.yaml') as vars_stream:
-            self.config_vars.update(yaml.load(vars_stream))
+        self.config_vars.update(self._load_yaml(os.path.join(
+            self.cluster_vars_path, self.config_vars['cluster']['name']) + '.yaml') or {})
         self.config_vars['cluster'].update(cluster_vars)
 
-    def load_vars(self, cluster_name=None):
-        """Load vars from `.ci3` project folder."""
+    def load_vars(self, cluster_name=None, global_vars=None):
+        """
+        Load vars from `.ci3` project folder.
+
+        Optional `global_vars` already loaded (e.g. for other cluster) are used
+        instead of loading `global.yaml` again.
+        """
         if not cluster_name:
             if (CI3_CLUSTER_NAME not in os.environ):
                 raise Ci3Error('Missing variable CI3_CLUSTER_NAME in ENV. '
                                'Have you run `kubic access <cluster_name>?`')
             cluster_name = os.environ[CI3_CLUSTER_NAME]
-        self._load_global_vars()
-        self._load_cluster_vars(cluster_name)
+        with span('load vars', 'vars', cluster=cluster_name):
+            if global_vars is None:
+                self._load_global_vars()
+            else:
+                self.config_vars = copy.deepcopy(global_vars)
+            self._load_cluster_vars(cluster_name)
         # Add ENV vars
         self.config_vars['env'] = os.environ
         # Add git branch.
@@ -139,15 +157,49 @@ class DotCi3Mixin(object):
             self.config_vars['git'] = dict()
         self.config_vars['git'].update({'branch': self.git_branch_ending()})
 
+    def _render_parts(self, template_path, template_vars):
+        """Return rendered parts of template made of includes, None if not incremental."""
+        if not self.incremental_render:
+            return None
+        from ci3.incremental import IncrementalRenderer
+        return IncrementalRenderer(self.dotci3_path, template_path).parts(template_vars)
+
     def render(self, template_path, template_vars=None):
         """Render jinja2 template, apply template_vars (optional) or `self.config_vars`."""
         logger.debug('Path to k8s templates: %s' % self.dotci3_path)
-        env = jinja2.Environment()
-        env.loader = jinja2.FileSystemLoader(self.dotci3_path)
-        template_str = open(template_path).read()
         if not template_vars:
             template_vars = self.config_vars
-        return env.from_string(template_str).render(template_vars)
+        parts = self._render_parts(template_path, template_vars)
+        if parts is not None:
+            return ''.join(parts)
+        template = get_template(self.dotci3_path, template_path)
+        with span('render', 'template', template=template_path):
+            return template.render(template_vars)
+
+    def render_stream(self, template_path, template_vars=None):
+        """
+        Render jinja2 template lazily, yield pieces of the output.
+
+        Unlike `render` the whole output is never held in memory, so it can be
+        fed into a pipe while the rest of the template is still rendering.
+        """
+        if not template_vars:
+            template_vars = self.config_vars
+        parts = self._render_parts(template_path, template_vars)
+        if parts is not None:
+            return buffered(parts)
+        template = get_template(self.dotci3_path, template_path)
+        return self._traced_chunks(template_path, buffered(template.generate(template_vars)))
+
+    @staticmethod
+    def _traced_chunks(template_path, chunks):
+        # Rendering happens while the chunks are consumed, so time that.
+        with span('render', 'template', template=template_path) as record:
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+            record.args['chars'] = size
 
 
 class StatusCommand(CliCommand, DotCi3Mixin):
@@ -186,7 +238,11 @@ class InitCommand(CliCommand, DotCi3Mixin):
 containers:
   homepage:
     build:
+      # Build context folder, relative to the project root, and Dockerfile in it.
+      context: .
       dockerfile: Dockerfile
+      # Other paths whose changes affect the image, for `--changed` builds.
+      # watch: [lib/]
     image:
       name: homepage
       tag: last
@@ -199,6 +255,9 @@ containers:
 ---
 cluster:
   type: minikube
+  # Images are built into the minikube docker daemon, not pushed. Set to
+  # `registry` to push to `image_registry_url` instead.
+  # push: local
 """.strip())
         # `.ci3/namespace.yaml`
         with open(os.path.join(self.dotci3_path, 'namespace.yaml'), 'w+') as namespace_yaml:
@@ -247,7 +306,7 @@ spec:
       containers:
         - name: homepage
           image: {{ cluster.image_registry_url }}/{{ containers.homepage.image.name }}:{{ containers.homepage.image.tag }}
-          imagePullPolicy: Always
+          imagePullPolicy: {% if cluster.type == 'minikube' %}IfNotPresent{% else %}Always{% endif %}
           ports:
             - containerPort: 80
           {% if cluster.type == 'minikube' %}
@@ -298,4 +357,6 @@ class ShowCommand(CliCommand, DotCi3Mixin):
         """
         self.load_vars()
         logger.debug('Config vars: %s' % self.config_vars)
-        print(self.render(args.tpl_path))
+        for chunk in self.render_stream(args.tpl_path):
+            sys.stdout.write(chunk)
+        sys.stdout.write('\n')
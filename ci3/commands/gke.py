@@ -1,18 +1,74 @@
 """Google Container Engine (GKE) cli command."""
+import os
 import sys
-from sh import ErrorReturnCode, gcloud
+import json
+from functools import lru_cache
+
+from ci3.process import ProcessError
+from ci3.tools import Tool
 from .base import CliCommand
 
 
-def push_image(tag):
+gcloud = Tool('gcloud')
+
+
+def push_image(tag, output=None):
     """Push docker image via gcloud context to resolve permission issues."""
-    gcloud.docker('--', 'push', tag, _out=sys.stdout, _err=sys.stderr)
+    gcloud.docker('--', 'push', tag,
+                  _out=output or sys.stdout, _err=output or sys.stderr)
 
 
-def tag_container(existing_tag, new_tag):
+def tag_container(existing_tag, new_tag, output=None):
     """Add tag to a remote container image via gcloud."""
     gcloud.container('images', 'add-tag', existing_tag, new_tag, '--quiet',
-                     _out=sys.stdout, _err=sys.stderr)
+                     _out=output or sys.stdout, _err=output or sys.stderr)
+
+
+def gcloud_config_path():
+    """Return gcloud configuration folder, `CLOUDSDK_CONFIG` or `~/.config/gcloud`."""
+    return os.environ.get('CLOUDSDK_CONFIG') or os.path.expanduser(
+        os.path.join('~', '.config', 'gcloud'))
+
+
+def active_configuration_path():
+    """Return path of the properties file of the active gcloud configuration."""
+    config_path = gcloud_config_path()
+    name = os.environ.get('CLOUDSDK_ACTIVE_CONFIG_NAME')
+    if not name:
+        try:
+            with open(os.path.join(config_path, 'active_config')) as stream:
+                name = stream.read().strip()
+        except (IOError, OSError):
+            name = None
+    return os.path.join(config_path, 'configurations', 'config_' + (name or 'default'))
+
+
+def active_account():
+    """Return account gcloud is authenticated as, read from its config without forking."""
+    if os.environ.get('CLOUDSDK_CORE_ACCOUNT'):
+        return os.environ['CLOUDSDK_CORE_ACCOUNT']
+    from configparser import ConfigParser, Error
+    parser = ConfigParser()
+    try:
+        parser.read(active_configuration_path())
+        return parser.get('core', 'account', fallback=None)
+    except Error:
+        return None
+
+
+def key_account(key_path):
+    """Return `client_email` of a service account key file, None if not readable."""
+    try:
+        with open(key_path) as stream:
+            return json.load(stream).get('client_email')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+@lru_cache()
+def access_token():
+    """Return OAuth access token of the active gcloud account, e.g. for gcr.io."""
+    return str(gcloud.auth('print-access-token')).strip()
 
 
 class GkeCommand(CliCommand):
@@ -29,5 +85,5 @@ class GkeCommand(CliCommand):
         """Execute command."""
         try:
             res = gcloud('container')
-        except ErrorReturnCode as error:
+        except ProcessError as error:
             print(error)
@@ -1,21 +1,36 @@
 """More advanced ci3 commands that interact with `kubectl`."""
 import os
 import json
+import time
 import logging
-from sh import kubectl
-from jinja2 import Template
+from collections import OrderedDict
+from functools import partial
 
+from ci3.apply import apply_objects
 from ci3.error import Ci3Error
+from ci3.jobs import run_jobs
+from ci3.cache import atomic_write, cache_path, file_signatures
+from ci3.kube import BACKENDS, get_backend
+from ci3.manifests import DigestStore, iter_objects
+from ci3.rollout import RolloutWatcher
+from ci3.tools import Tool
+from ci3.trace import span
 from .base import CliCommand
 from .dotci3 import DotCi3Mixin, ShowCommand, CI3_CLUSTER_NAME
 
 
 logger = logging.getLogger(__name__)
+kubectl = Tool('kubectl')
 
 
 def access_cluster(cluster_name, cluster_namespace='default',
-                   cluster_type='minikube', echo=False):
-    """Access cluster by name, type."""
+                   cluster_type='minikube', echo=False, use_context=None):
+    """
+    Access cluster by name, type.
+
+    With `use_context` of still valid kubeconfig credentials given, the shell
+    code switches to it instead of authenticating with gcloud again.
+    """
     if (CI3_CLUSTER_NAME not in os.environ):
         raise Ci3Error('Missing variable CI3_CLUSTER_NAME in ENV. '
                        'Have you run `kubic access <cluster_name>?`')
@@ -25,7 +40,10 @@ def access_cluster(cluster_name, cluster_namespace='default',
         cluster_context = "$( kubectl config 'current-context' )"
     if echo:
         command = "export CI3_CLUSTER_NAME={{ cluster.name }}\n"
-        if cluster_type == 'gke':
+        if cluster_type == 'gke' and use_context:
+            command += "export CLOUDSDK_CONTAINER_USE_CLIENT_CERTIFICATE=True\n"
+            command += "kubectl config use-context %s\n" % use_context
+        elif cluster_type == 'gke':
             command += """
 export CLOUDSDK_CONTAINER_USE_CLIENT_CERTIFICATE=True
 gcloud auth activate-service-account --key-file {{ cluster.key_path }}
@@ -41,14 +59,43 @@ gcloud container clusters get-credentials {{ cluster.name }} \
         kubectl.config('set-context', cluster_context, '--namespace=%s' % cluster_namespace)
 
 
+def kube_context(cluster_vars):
+    """Return name of the kubeconfig context of the cluster, see `cluster.context` var."""
+    if cluster_vars.get('context'):
+        return cluster_vars['context']
+    if cluster_vars.get('type') == 'minikube':
+        return 'minikube'
+    if cluster_vars.get('type') == 'gke':
+        # Context name created by `gcloud container clusters get-credentials`.
+        return 'gke_{}_{}_{}'.format(cluster_vars['project'], cluster_vars['zone'],
+                                     cluster_vars['name'])
+    raise Ci3Error("Unknown kubeconfig context of cluster `{}`, set `cluster.context`"
+                   .format(cluster_vars.get('name')))
+
+
+def add_backend_argument(subparser):
+    """Add options to select the cluster backend and how many objects it applies at once."""
+    subparser.add_argument('--backend', choices=BACKENDS,
+                           help="Talk to the cluster via kubectl or directly to its API server. "
+                                "Defaults to `cluster.backend` var or kubectl.")
+    subparser.add_argument('--apply-jobs', type=int, default=4,
+                           help="Number of batches of objects of a tier to apply concurrently.")
+
+
 class ApplyCommand(ShowCommand):
     """
     Render and apply k8s configuration from the jinja2 template.
 
     Use current kubectl context. Make sure to run `source <(kubic access <clustername>)>`.
+    Objects are applied in dependency order, see `ci3.apply`.
     See also `ci3.dotci3.ShowCommand`.
     """
 
+    def add_arguments(self, subparser):
+        """Add cli arguments to command subparser."""
+        super(ApplyCommand, self).add_arguments(subparser)
+        add_backend_argument(subparser)
+
     def run(self, args):
         """
         Apply k8s configuration from the jinja2 template.
@@ -56,8 +103,11 @@ class ApplyCommand(ShowCommand):
         Rednder template with substituted ci3 vars. Pass k8s configuration to `kubectl`.
         """
         self.load_vars()
-        k8s_config = self.render(args.tpl_path)
-        kubectl.apply('-f', '-', _in=k8s_config)
+        cluster = self.config_vars['cluster']
+        backend = get_backend(args.backend or cluster.get('backend') or 'kubectl',
+                              namespace=cluster['namespace'],
+                              cache_dir=cache_path(self.dotci3_path, 'discovery', ''))
+        apply_objects(backend, iter_objects(self.render_stream(args.tpl_path)), args.apply_jobs)
 
 
 class AccessCommand(CliCommand, DotCi3Mixin):
@@ -66,61 +116,245 @@ class AccessCommand(CliCommand, DotCi3Mixin):
 
     Access switch needs to modify shell ENV. This requires executing
     `source <(kubic access <clustername>)>`
+
+    The shell code is cached in `.ci3/.cache/access` until vars, branch,
+    kubeconfig, gcloud configuration or the key file change, or until the
+    credentials it relies on expire. GKE credentials still valid in
+    kubeconfig are reused instead of calling gcloud again.
     """
 
+    # Seconds credentials have to stay valid to be reused.
+    credentials_margin = 300
+
     def add_arguments(self, subparser):
         """Add cli arguments to command subparser."""
         subparser.add_argument('cluster_name', help="Name of the cluster")
         subparser.add_argument('-n', '--namespace', default='default',
                                help="Cluster namespace")
 
-    def run(self, args):
+    def _cache_key(self, args):
+        """Return what the shell code is derived from, besides files it depends on."""
+        from ci3.version import __version__
+        try:
+            branch = self.git_branch_ending()
+        except Ci3Error:
+            branch = None
+        vars_paths = [os.path.join(self.vars_path, 'global.yaml'),
+                      os.path.join(self.cluster_vars_path, args.cluster_name + '.yaml')]
+        return [__version__, args.cluster_name, args.namespace, branch,
+                file_signatures(vars_paths)]
+
+    def _reusable_context(self):
         """
-        Apply k8s configuration from the jinja2 template.
+        Return (kubeconfig context, expiry) of GKE credentials still valid, None if not.
 
-        Render template with substituted ci3 vars. Pass k8s configuration to `kubectl`.
+        Valid means the context has unexpired credentials and gcloud is
+        authenticated with the service account of `cluster.key_path`.
         """
-        self.load_vars(args.cluster_name)
-        os.environ[CI3_CLUSTER_NAME] = args.cluster_name
+        from ci3.kube import credentials_expiry
+        from .gke import active_account, key_account
+        cluster = self.config_vars['cluster']
+        account = key_account(cluster.get('key_path') or '')
+        if not account or account != active_account():
+            return None
+        context = kube_context(cluster)
+        try:
+            usable, expiry = credentials_expiry(context)
+        except Ci3Error:
+            return None
+        if not usable or (expiry is not None and expiry - self.credentials_margin < time.time()):
+            return None
+        return context, expiry
+
+    def access_code(self, args):
+        """Return shell code, files it depends on and time it's valid until (None: no limit)."""
+        from jinja2 import Template
+        from ci3.kube import kubeconfig_path
+        cluster = self.config_vars['cluster']
+        depends, valid_until, use_context = [], None, None
+        if cluster['type'] == 'gke':
+            from .gke import active_configuration_path
+            depends = [kubeconfig_path(), active_configuration_path(), cluster.get('key_path') or '']
+            reusable = self._reusable_context()
+            if reusable:
+                use_context, expiry = reusable
+                if expiry is not None:
+                    valid_until = expiry - self.credentials_margin
         template = Template(access_cluster(
             cluster_name=args.cluster_name,
             cluster_namespace=args.namespace,
-            cluster_type=self.config_vars['cluster']['type'],
-            echo=True))
-        print(template.render(self.config_vars))
+            cluster_type=cluster['type'],
+            echo=True,
+            use_context=use_context))
+        return template.render(self.config_vars), depends, valid_until
+
+    def run(self, args):
+        """Print shell code switching to the cluster, cached while it stays valid."""
+        os.environ[CI3_CLUSTER_NAME] = args.cluster_name
+        path = cache_path(self.dotci3_path, 'access', args.cluster_name + '.json')
+        key = self._cache_key(args)
+        try:
+            with open(path) as stream:
+                entry = json.load(stream)
+            if entry['key'] == key and entry['depends'] == file_signatures(
+                    [depend for depend, _ in entry['depends']]) \
+                    and (entry['valid_until'] is None or time.time() < entry['valid_until']):
+                print(entry['code'])
+                return
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        self.load_vars(args.cluster_name)
+        code, depends, valid_until = self.access_code(args)
+        entry = {'key': key, 'depends': file_signatures(depends),
+                 'valid_until': valid_until, 'code': code}
+        atomic_write(path, json.dumps(entry))
+        print(code)
 
 
 class DeployCommand(CliCommand, DotCi3Mixin):
     """Deploy CI cycle by applying changed configuration to k8s cluster."""
 
+    # Explicit kubeconfig context to use, current context if None.
+    kube_context = None
+    # Name of cluster backend to use, `cluster.backend` var or kubectl if None.
+    backend_name = None
+    # Patch only these of the selected containers if set, e.g. the rebuilt ones.
+    only_containers = None
+    _backend = None
+
     def add_arguments(self, subparser):
         """Add cli arguments to command subparser."""
         subparser.add_argument('-d', '--deployment',
                                help="Name of k8s deployment to patch with built container tag.")
+        subparser.add_argument('--all', action='store_true', dest='all_containers',
+                               help="Patch deployments of all containers with built tags.")
+        subparser.add_argument('--containers',
+                               help="Comma separated containers to patch deployments of.")
+        subparser.add_argument('--patch-jobs', type=int, default=4,
+                               help="Number of deployments to patch concurrently.")
+        subparser.add_argument('--wait', action='store_true',
+                               help="Wait until all deployed deployments are rolled out.")
+        subparser.add_argument('--timeout', type=int, default=300,
+                               help="Seconds to wait for rollouts with --wait.")
+        subparser.add_argument('--force-full', action='store_true',
+                               help="Apply all objects, not only those changed since last deploy.")
+        subparser.add_argument('--clusters',
+                               help="Comma separated cluster names to deploy to concurrently.")
+        subparser.add_argument('--canary',
+                               help="Cluster of --clusters to deploy to first, others only if it "
+                                    "succeeds.")
+        add_backend_argument(subparser)
+
+    @property
+    def backend(self):
+        """Return cluster backend, kubectl or direct API access."""
+        if self._backend is None:
+            cluster = self.config_vars['cluster']
+            self._backend = get_backend(
+                self.backend_name or cluster.get('backend') or 'kubectl',
+                self.kube_context, cluster['namespace'], cache_path(self.dotci3_path, 'discovery', ''))
+        return self._backend
 
-    def _patch_deployment(self, name):
-        """Get tag id of last container build and patch deployment."""
-        values = self.config_vars['containers'][name]
+    def _local_image(self, tag_sha):
+        """Return `ctx-<hash>` tag of image in the cluster's docker, changes with its content."""
+        from ci3.process import ProcessError
+        from .dkr import context_tag, docker
+        try:
+            ctx_tag = context_tag(tag_sha)
+            if ctx_tag is None:
+                return tag_sha
+            # Make sure the tag exists, images built by older versions may lack it.
+            docker.image('inspect', '--format', '{{.Id}}', ctx_tag)
+            return ctx_tag
+        except ProcessError as error:
+            logger.warning('Failed to inspect local image %s: %s' % (tag_sha, error))
+            return tag_sha
+
+    def _patch_deployment(self, name, containers):
+        """Get tag id of last container builds and patch deployment in one request."""
+        from .dkr import push_strategy
         image_registry_url = self.config_vars['cluster']['image_registry_url']
-        # We expect that actually this tag with git sha is already pushed to remote repository.
-        tag_sha = "{}/{}:{}".format(
-            image_registry_url,
-            values['image']['name'],
-            'commit-' + self.get_head_sha())
+        local = push_strategy(self.config_vars['cluster']) == 'local'
+        patched = []
+        for container in containers:
+            values = self.config_vars['containers'][container]
+            # We expect that actually this tag with git sha is already pushed to remote repository.
+            tag_sha = "{}/{}:{}".format(
+                image_registry_url,
+                values['image']['name'],
+                'commit-' + self.get_head_sha())
+            if local:
+                # Not pushed, but in the node's docker. Commit tags of a dirty tree get
+                # rebuilt, the content tag makes sure the pod spec changes with the image.
+                patched.append({
+                    "name": container,
+                    "image": self._local_image(tag_sha),
+                    "imagePullPolicy": "IfNotPresent",
+                })
+                continue
+            patched.append({
+                "name": container,
+                "image": tag_sha,
+            })
         # Actual patching
         payload = {
             "spec": {
                 "template": {
                     "spec": {
-                        "containers": [{
-                            "name": name,
-                            "image": tag_sha,
-                        }],
+                        "containers": patched,
                     },
                 },
             },
         }
-        kubectl.patch('deployment', name, '-p', json.dumps(payload))
+        start = time.time()
+        try:
+            self.backend.patch_deployment(name, payload)
+            error = None
+        except Exception as exc:
+            # Failure of one deployment must not hide results of the others.
+            logger.debug('Patching %s failed' % name, exc_info=True)
+            error = exc
+        return {'containers': containers, 'seconds': time.time() - start, 'error': error}
+
+    def _containers_to_patch(self, args):
+        """Return containers selected by `--deployment`, `--containers` or `--all`."""
+        if args.all_containers:
+            names = list(self.config_vars['containers'])
+        else:
+            names = []
+            if args.containers:
+                names += [name.strip() for name in args.containers.split(',') if name.strip()]
+            if args.deployment:
+                names.append(args.deployment)
+            for name in names:
+                if name not in self.config_vars['containers']:
+                    raise Ci3Error("Container not found: %s" % name)
+        if self.only_containers is not None:
+            names = [name for name in names if name in self.only_containers]
+        return names
+
+    def patch_deployments(self, containers, max_workers=4):
+        """
+        Patch deployments with the built images of containers, report results.
+
+        Containers are grouped by deployment (`containers.<name>.deployment` var,
+        defaults to the container name), each deployment is patched once.
+        """
+        deployments = OrderedDict()
+        for name in containers:
+            deployment = self.config_vars['containers'][name].get('deployment') or name
+            deployments.setdefault(deployment, []).append(name)
+        jobs = OrderedDict((deployment, partial(self._patch_deployment, deployment, names))
+                           for deployment, names in deployments.items())
+        reports = run_jobs(jobs, max_workers=max_workers)
+        for deployment, report in reports.items():
+            print('{:<30} {:>7.1f}s {}  ({})'.format(
+                deployment, report['seconds'],
+                'FAILED: {}'.format(report['error']) if report['error'] else 'patched',
+                ', '.join(report['containers'])))
+        failed = [deployment for deployment, report in reports.items() if report['error']]
+        if failed:
+            raise Ci3Error('Failed to patch deployments: {}'.format(', '.join(failed)))
 
     def run(self, args):
         """
@@ -128,14 +362,100 @@ class DeployCommand(CliCommand, DotCi3Mixin):
 
         Shorthand to `kubic apply .ci3/deploy.yaml`
         """
+        if args.clusters:
+            self.fan_out(args)
+            return
         self.load_vars()
-        k8s_config = self.render(".ci3/deploy.yaml")
-        kubectl.apply('-f', '-', _in=k8s_config)
+        self.deploy(args)
+
+    def _deploy_cluster(self, args, cluster_name, global_vars):
+        """Deploy to a single cluster of fan-out, return report."""
+        start = time.time()
+        command = DeployCommand()
+        command.repo = self.repo
+        try:
+            command.load_vars(cluster_name, global_vars)
+            command.kube_context = kube_context(command.config_vars['cluster'])
+            command.backend_name = args.backend
+            command.deploy(args)
+            error = None
+        except Exception as exc:
+            # Failure of one cluster must not hide results of the others.
+            logger.debug('Deploy to %s failed' % cluster_name, exc_info=True)
+            error = exc
+        return {'cluster': cluster_name, 'seconds': time.time() - start, 'error': error}
+
+    def fan_out(self, args):
+        """Deploy to all `--clusters` concurrently, report per cluster results."""
+        clusters = [name.strip() for name in args.clusters.split(',') if name.strip()]
+        if args.canary and args.canary not in clusters:
+            raise Ci3Error("Canary cluster `{}` is not in --clusters".format(args.canary))
+        self._load_global_vars()
+        global_vars = self.config_vars
+        waves = [[args.canary], [name for name in clusters if name != args.canary]] \
+            if args.canary else [clusters]
+        reports = []
+        for wave in waves:
+            jobs = OrderedDict((name, partial(self._deploy_cluster, args, name, global_vars))
+                               for name in wave)
+            reports += run_jobs(jobs, max_workers=len(jobs)).values()
+            if any(report['error'] for report in reports):
+                break
+        failed = False
+        for name in clusters:
+            report = next((report for report in reports if report['cluster'] == name), None)
+            if report is None:
+                print('{:<30} {:>8} skipped, canary failed'.format(name, ''))
+                failed = True
+            elif report['error']:
+                print('{:<30} {:>7.1f}s FAILED: {}'.format(name, report['seconds'], report['error']))
+                failed = True
+            else:
+                print('{:<30} {:>7.1f}s ok'.format(name, report['seconds']))
+        if failed:
+            raise Ci3Error('Deploy failed on some of the clusters')
+
+    def deploy(self, args):
+        """Apply `.ci3/deploy.yaml` and patch deployment, expect vars to be loaded."""
+        self.backend_name = self.backend_name or args.backend
+        start = time.time()
+        cluster = self.config_vars['cluster']
+        store = DigestStore(self.dotci3_path, cluster['name'], cluster['namespace'])
+        # Objects are parsed and compared while the template is still rendering.
+        objects, changed = [], []
+        for obj in iter_objects(self.render_stream(".ci3/deploy.yaml")):
+            objects.append(obj)
+            if args.force_full or store.is_changed(obj):
+                changed.append(obj)
+        if changed:
+            logger.info('Applying %d of %d objects' % (len(changed), len(objects)))
+            with span('apply', 'deploy', objects=len(changed)):
+                apply_objects(self.backend, changed, args.apply_jobs)
+        else:
+            logger.info('No objects changed since last deploy')
+        store.save(objects)
 
         # Always patch deployment
-        if not args.deployment:
+        containers = self._containers_to_patch(args)
+        if not containers:
             logging.info('Not patching any containers')
         else:
-            if args.deployment not in self.config_vars['containers']:
-                raise Ci3Error("Container not found: %s", args.deployment)
-            self._patch_deployment(args.deployment)
+            self.patch_deployments(containers, args.patch_jobs)
+
+        if args.wait:
+            touched = set(obj['metadata']['name'] for obj in changed
+                          if obj.get('kind') == 'Deployment')
+            touched.update(self.config_vars['containers'][name].get('deployment') or name
+                           for name in containers)
+            self.wait_for_rollout(touched, args.timeout, since=start)
+
+    def wait_for_rollout(self, deployments, timeout, since=None):
+        """Wait for deployments to become ready, report time to ready of each."""
+        if not deployments:
+            logger.info('No deployments to wait for')
+            return
+        watcher = RolloutWatcher(self.backend, sorted(deployments), timeout, since)
+        with span('wait for rollout', 'deploy', deployments=len(deployments)):
+            ready = watcher.wait()
+        for name, seconds in sorted(ready.items(), key=lambda item: item[1]):
+            print('{:<30} {:>7.1f}s ready'.format(name, seconds))
@@ -0,0 +1,34 @@
+"""Keep kubic warm for the project, see `ci3.daemon`."""
+from ci3.daemon import Daemon
+from .base import CliCommand
+from .dotci3 import DotCi3Mixin
+
+
+class ServeCommand(CliCommand, DotCi3Mixin):
+    """
+    Serve kubic commands of the project from a long running process.
+
+    While it runs, `kubic status`, `show` and `access` of the project are
+    executed by it, without paying for interpreter startup, imports, vars
+    parsing and template compilation again. Run it in a spare terminal or
+    in background.
+    """
+
+    def add_arguments(self, subparser):
+        """Add cli arguments to command subparser."""
+        subparser.add_argument('--idle-timeout', type=int, default=0,
+                               help="Stop after this many seconds without a command, 0 never.")
+
+    @staticmethod
+    def warm_up():
+        """Import modules of the served commands upfront."""
+        import jinja2  # noqa: F401
+        import yaml  # noqa: F401
+        import ci3.commands.k8s  # noqa: F401
+
+    def run(self, args):
+        """Serve commands until interrupted."""
+        from ci3.cli import build_cli
+        dotci3_path = self.get_dotci3_path()
+        self.warm_up()
+        Daemon(dotci3_path, build_cli, idle_timeout=args.idle_timeout).serve()
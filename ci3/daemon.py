@@ -0,0 +1,297 @@
+"""
+Long running `kubic serve` process per project and its Unix socket client.
+
+The daemon keeps modules imported, vars loaded, templates compiled and git
+state resolved between commands. A watcher thread polls the `.ci3` folder
+and git refs and drops the warm state when they change.
+"""
+import io
+import os
+import sys
+import json
+import stat
+import time
+import signal
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+from ci3.cache import CACHE_FOLDER
+from ci3.error import Ci3Error
+
+
+logger = logging.getLogger(__name__)
+# Commands cheap enough to be served by the daemon. Others run in-process,
+# they are dominated by docker/kubectl anyway.
+SERVED_COMMANDS = ('status', 'show', 'access')
+# Set to run commands in-process even if the daemon is running.
+NO_DAEMON_ENV = 'KUBIC_NO_DAEMON'
+POLL_INTERVAL = 0.5
+
+
+def socket_folder():
+    """
+    Return folder for daemon sockets only the current user can access.
+
+    It is created with mode 0700, raise error if it exists but is not owned
+    by the user or is accessible by others.
+    """
+    path = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                        'kubic-{}'.format(os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+            or stat.S_IMODE(info.st_mode) & 0o077:
+        raise Ci3Error('Unsafe socket folder {}, it must be a folder of the user with mode 0700'
+                       .format(path))
+    return path
+
+
+def socket_path(dotci3_path):
+    """Return path of the daemon socket of the project, short enough for Unix sockets."""
+    digest = hashlib.sha1(os.path.abspath(dotci3_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(socket_folder(), '{}.sock'.format(digest))
+
+
+def _read_all(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(64 * 1024)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def forward(argv, dotci3_path):
+    """
+    Run command by the daemon, print its output and return its exit code.
+
+    Return None if no daemon serves the project, the caller then runs the
+    command in-process. The environment, credentials included, is only sent
+    to sockets of the current user.
+    """
+    try:
+        path = socket_path(dotci3_path)
+        if os.stat(path).st_uid != os.getuid():
+            logger.warning('Ignoring kubic socket %s of another user' % path)
+            return None
+    except (OSError, Ci3Error) as error:
+        logger.debug('Not forwarding to daemon: %s' % error)
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        request = {'argv': argv, 'env': dict(os.environ)}
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        connection.shutdown(socket.SHUT_WR)
+        response = json.loads(_read_all(connection).decode('utf-8'))
+    except (OSError, ValueError):
+        # Stale socket of a daemon gone away.
+        return None
+    finally:
+        connection.close()
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['exit_code']
+
+
+class Watcher(object):
+    """Poll modification times of project files, remember if any changed."""
+
+    def __init__(self, paths, interval=POLL_INTERVAL):
+        self.paths = paths
+        self.interval = interval
+        self._snapshot = self.snapshot()
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """Return signature of all files under watched paths."""
+        signature = {}
+        for root in self.paths:
+            if os.path.isfile(root):
+                stat = os.stat(root)
+                signature[root] = (stat.st_mtime_ns, stat.st_size)
+                continue
+            for path, folders, names in os.walk(root):
+                if CACHE_FOLDER in folders and os.path.basename(path) == '.ci3':
+                    folders.remove(CACHE_FOLDER)
+                for name in names:
+                    full_path = os.path.join(path, name)
+                    try:
+                        stat = os.stat(full_path)
+                    except OSError:
+                        continue
+                    signature[full_path] = (stat.st_mtime_ns, stat.st_size)
+        return signature
+
+    def poll(self):
+        """Compare files to the previous snapshot."""
+        snapshot = self.snapshot()
+        if snapshot != self._snapshot:
+            self._snapshot = snapshot
+            with self._lock:
+                self._changed = True
+
+    def run(self):
+        """Poll forever, meant as daemon thread."""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.debug('Watcher poll failed', exc_info=True)
+
+    def pop_changed(self):
+        """Return True if files changed since the last call."""
+        with self._lock:
+            changed, self._changed = self._changed, False
+        return changed
+
+
+class Daemon(object):
+    """
+    Serve commands of a project over a Unix socket, one at a time.
+
+    `make_cli` returns a fresh `CommandLineInterface` for every request.
+    Commands run in this process with the client's environment, their output
+    is captured and sent back.
+    """
+
+    def __init__(self, dotci3_path, make_cli, idle_timeout=0):
+        self.dotci3_path = dotci3_path
+        self.make_cli = make_cli
+        self.idle_timeout = idle_timeout
+        self.path = socket_path(dotci3_path)
+        self.watcher = Watcher([dotci3_path] + self.git_paths(os.path.dirname(dotci3_path)))
+        self._last_env = None
+
+    @staticmethod
+    def git_paths(project_path):
+        """Return HEAD and index of the worktree, refs of it and of the shared git folder."""
+        from ci3.repo import RepoContext
+        repo = RepoContext(project_path)
+        if not repo.git_dir:
+            return []
+        paths = []
+        for folder, names in ((repo.git_dir, ('HEAD', 'index', 'refs')),
+                              (repo.common_dir, ('refs', 'packed-refs'))):
+            for name in names:
+                path = os.path.join(folder, name)
+                if os.path.exists(path) and path not in paths:
+                    paths.append(path)
+        return paths
+
+    def _bind(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                raise Ci3Error('kubic is already served at {}'.format(self.path))
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(16)
+        server.settimeout(1)
+        return server
+
+    @staticmethod
+    def invalidate():
+        """Drop all warm state, it is rebuilt by the next command."""
+        from ci3.cache import forget_loaded
+        from ci3.repo import forget_repo_contexts
+        from ci3.templates import forget_environments
+        forget_loaded()
+        forget_repo_contexts()
+        forget_environments()
+
+    def execute(self, argv, env):
+        """Run command with argv in env, return its exit code and output."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        root_logger = logging.getLogger()
+        handlers, level = list(root_logger.handlers), root_logger.level
+        environ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(env)
+        # The command configures its own logging to the captured stderr.
+        root_logger.handlers[:] = []
+        exit_code = 0
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                try:
+                    cli = self.make_cli()
+                    cli.use_daemon = False
+                    cli.run(argv)
+                except SystemExit as error:
+                    if isinstance(error.code, int):
+                        exit_code = error.code
+                    elif error.code is not None:
+                        print(error.code, file=sys.stderr)
+                        exit_code = 1
+                except Exception:
+                    traceback.print_exc()
+                    exit_code = 1
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            root_logger.handlers[:] = handlers
+            root_logger.setLevel(level)
+        return {'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+    def _handle(self, connection):
+        try:
+            request = json.loads(_read_all(connection).decode('utf-8'))
+            if self.watcher.pop_changed():
+                logger.info('Project files changed, dropping warm state')
+                self.invalidate()
+            elif request['env'] != self._last_env:
+                # Git state may depend on it, e.g. `CI_COMMIT_REF_NAME`.
+                from ci3.repo import forget_repo_contexts
+                forget_repo_contexts()
+            self._last_env = request['env']
+            start = time.time()
+            response = self.execute(request['argv'], request['env'])
+            logger.info('kubic %s: exit %d in %.1fms' % (
+                ' '.join(request['argv']), response['exit_code'], (time.time() - start) * 1000))
+            connection.sendall(json.dumps(response).encode('utf-8'))
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning('Bad request: %s' % error)
+        finally:
+            connection.close()
+
+    def serve(self):
+        """Accept commands until interrupted or idle for `idle_timeout` seconds."""
+        server = self._bind()
+        # Clean up the socket on `kill` too.
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        thread = threading.Thread(target=self.watcher.run, name='watcher')
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving kubic at %s' % self.path)
+        last_request = time.time()
+        try:
+            while not self.idle_timeout or time.time() - last_request < self.idle_timeout:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                self._handle(connection)
+                last_request = time.time()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            server.close()
+            os.unlink(self.path)
+            logger.info('Stopped serving kubic')
@@ -0,0 +1,127 @@
+"""Thread-safe pool of keep-alive HTTP(S) connections to a single host."""
+import ssl
+import socket
+import logging
+import threading
+
+from http import client as http_client
+from urllib.parse import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+
+class HttpResponse(object):
+    """Status, headers and body of a completed request."""
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def header(self, name, default=None):
+        """Return value of the header, case-insensitive."""
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive connections to the server of `base_url`, reused across requests.
+
+    Each thread takes an idle connection or opens a new one, so TLS handshakes
+    are paid once per connection, not once per request.
+    """
+
+    def __init__(self, base_url, ssl_context=None, timeout=30, maxsize=10):
+        url = urlparse(base_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return http_client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=self.ssl_context or ssl.create_default_context())
+        return http_client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _put_connection(self, connection):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """Send request, return `HttpResponse`. Retry once if a reused connection went stale."""
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        while True:
+            connection, reused = self._get_connection()
+            try:
+                connection.request(method, self.base_path + path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                result = HttpResponse(response.status, response.reason,
+                                      response.getheaders(), response.read())
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    logger.debug('Stale connection to %s, reconnecting' % self.host)
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(connection)
+            return result
+
+    def stream(self, method, path, headers=None, read_timeout=None):
+        """
+        Send request on a dedicated connection, return (response, close function).
+
+        Meant for long running responses read incrementally, e.g. watches.
+        The response is read with `read_timeout` seconds, None waits forever.
+        The caller calls `close` when done, it also wakes up a thread blocked
+        reading the response.
+        """
+        connection = self._new_connection()
+        connection.connect()
+        sock = connection.sock
+        sock.settimeout(read_timeout)
+
+        def close():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+            sock.close()
+        try:
+            connection.request(method, self.base_path + path, headers=headers or {})
+            return connection.getresponse(), close
+        except BaseException:
+            close()
+            raise
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
@@ -0,0 +1,274 @@
+"""
+Incremental rendering of templates made of `{% include %}` statements.
+
+Each include is rendered on its own with vars wrapped to record which values
+it reads. Its output is cached in `.ci3/.cache/renders` under the hash of its
+sources (with nested includes) together with the recorded values, so only
+includes whose sources or values changed are rendered again.
+"""
+import os
+import json
+import pickle
+import hashlib
+import logging
+from collections.abc import Mapping
+
+from ci3.cache import atomic_write, cache_path, file_signature
+from ci3.templates import get_environment, template_name
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+# Cached outputs kept per include, e.g. one per cluster.
+MAX_VARIANTS = 4
+_MISSING = object()
+
+
+class _Recorder(object):
+    """Collect paths of vars read while rendering."""
+
+    def __init__(self):
+        self.paths = set()
+
+    def dependencies(self, template_vars):
+        """Return (path, fingerprint of value) of recorded paths, covered ones dropped."""
+        paths = sorted(self.paths, key=len)
+        kept = []
+        for path in paths:
+            if not any(path[:len(prefix)] == prefix for prefix in kept):
+                kept.append(path)
+        return [(path, fingerprint(lookup(template_vars, path))) for path in kept]
+
+
+class _TrackedMapping(Mapping):
+    """Read-only view of a mapping in vars, records what the template reads."""
+
+    def __init__(self, data, path, recorder):
+        self._data = data
+        self._path = path
+        self._recorder = recorder
+
+    def _whole(self):
+        self._recorder.paths.add(self._path)
+        return self._data
+
+    def __getitem__(self, key):
+        path = self._path + (key,)
+        try:
+            value = self._data[key]
+        except (KeyError, TypeError):
+            self._recorder.paths.add(path)
+            raise
+        return _track(value, path, self._recorder)
+
+    def __getattr__(self, name):
+        # Jinja2 tries attributes before items, e.g. `cluster.name`.
+        if name.startswith('_') or name not in self._data:
+            raise AttributeError(name)
+        return self[name]
+
+    def __contains__(self, key):
+        self._recorder.paths.add(self._path + (key,))
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._whole())
+
+    def __len__(self):
+        return len(self._whole())
+
+    def __str__(self):
+        return str(self._whole())
+
+    __repr__ = __str__
+
+
+def _track(value, path, recorder):
+    if isinstance(value, Mapping):
+        return _TrackedMapping(value, path, recorder)
+    recorder.paths.add(path)
+    return value
+
+
+def lookup(template_vars, path):
+    """Return value at path of nested mappings, `_MISSING` if not there."""
+    value = template_vars
+    for key in path:
+        if not isinstance(value, Mapping):
+            return _MISSING
+        try:
+            value = value[key]
+        except (KeyError, TypeError):
+            return _MISSING
+    return value
+
+
+def _plain(value):
+    return dict(value) if isinstance(value, Mapping) else str(value)
+
+
+def fingerprint(value):
+    """Return comparable fingerprint of value read by a template: scalar itself or digest."""
+    if value is _MISSING:
+        return ('missing',)
+    if value is None or isinstance(value, (str, int, float)):
+        # Type included, as 1 == True but they render differently.
+        return (type(value).__name__, value)
+    text = json.dumps(value, sort_keys=True, default=_plain)
+    return ('sha1', hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+
+def _parse_parts(environment, source):
+    """
+    Return top level parts of template source, None if it's more than includes.
+
+    Parts are `(text, None)` for plain text and `(None, include)` for
+    `{% include %}` of a constant name, include given as (name, with_context,
+    ignore_missing).
+    """
+    from jinja2 import nodes
+    parts = []
+    for node in environment.parse(source).body:
+        if isinstance(node, nodes.Output) \
+                and all(isinstance(child, nodes.TemplateData) for child in node.nodes):
+            parts.append((''.join(child.data for child in node.nodes), None))
+        elif isinstance(node, nodes.Include) and isinstance(node.template, nodes.Const) \
+                and isinstance(node.template.value, str):
+            parts.append((None, (node.template.value, node.with_context, node.ignore_missing)))
+        else:
+            return None
+    return parts
+
+
+def _nested_names(environment, source):
+    """Return names of templates included, imported or extended by source, None if dynamic."""
+    from jinja2 import meta
+    names = list(meta.find_referenced_templates(environment.parse(source)))
+    return None if None in names else names
+
+
+class IncrementalRenderer(object):
+    """Render template of includes, reuse cached output of unchanged includes."""
+
+    def __init__(self, dotci3_path, template_path):
+        self.environment = get_environment(dotci3_path)
+        self.name = template_name(dotci3_path, template_path)
+        self.path = cache_path(dotci3_path, 'renders', self.name + '.pickle')
+        self._cache = None
+        self._sources = {}
+        self._changed = False
+
+    @property
+    def cache(self):
+        """Return cached sources and outputs of includes, loaded on first use."""
+        if self._cache is None:
+            try:
+                with open(self.path, 'rb') as stream:
+                    self._cache = pickle.load(stream)
+            except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+                self._cache = {'sources': {}, 'includes': {}}
+        return self._cache
+
+    def _template_file(self, name):
+        """Return path of the file the loader would read for the template, None if unknown."""
+        loader = self.environment.loader
+        for file_loader in getattr(loader, 'loaders', [loader]):
+            for search_path in getattr(file_loader, 'searchpath', []):
+                path = os.path.join(search_path, *name.split('/'))
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def _source(self, name):
+        """
+        Return (digest, nested template names, parts) of template source.
+
+        Source is read only if the file signature changed, parsed only if its
+        digest changed.
+        """
+        if name in self._sources:
+            return self._sources[name]
+        path = self._template_file(name)
+        signature = file_signature(path) if path else None
+        cached = self.cache['sources'].get(name)
+        if signature is None or cached is None or cached[0] != signature:
+            source = self.environment.loader.get_source(self.environment, name)[0]
+            digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+            if cached is None or cached[1] != digest:
+                parts = _parse_parts(self.environment, source) if name == self.name else None
+                cached = (signature, digest, _nested_names(self.environment, source), parts)
+            else:
+                cached = (signature,) + cached[1:]
+            self.cache['sources'][name] = cached
+            self._changed = True
+        self._sources[name] = cached[1:]
+        return self._sources[name]
+
+    def _sources_key(self, name):
+        """Return digest of the include with all templates it uses, None if unknown."""
+        digests, pending, seen = [], [name], set()
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            digest, nested, _ = self._source(current)
+            if nested is None:
+                return None
+            digests.append((current, digest))
+            pending.extend(nested)
+        return hashlib.sha1(repr(sorted(digests)).encode('utf-8')).hexdigest()
+
+    def _render_include(self, include, template_vars):
+        from jinja2 import TemplateNotFound
+        name, with_context, ignore_missing = include
+        template_vars = template_vars if with_context else {}
+        try:
+            key = self._sources_key(name)
+        except TemplateNotFound:
+            if ignore_missing:
+                return ''
+            raise
+        # Set of available top level names decides what is undefined.
+        key = (key, tuple(sorted(template_vars)))
+        variants = self.cache['includes'].setdefault(name, [])
+        for variant_key, dependencies, output in variants:
+            if variant_key == key and all(fingerprint(lookup(template_vars, path)) == value
+                                          for path, value in dependencies):
+                return output
+        template = self.environment.get_template(name)
+        recorder = _Recorder()
+        tracked = dict((var, _track(value, (var,), recorder))
+                       for var, value in template_vars.items())
+        try:
+            output = template.render(tracked)
+        except Exception:
+            # E.g. filters expecting plain dicts, render without caching.
+            logger.debug('Include %s not cacheable' % name, exc_info=True)
+            return template.render(template_vars)
+        if key[0] is not None:
+            variants.insert(0, (key, recorder.dependencies(template_vars), output))
+            del variants[MAX_VARIANTS:]
+            self._changed = True
+        return output
+
+    def parts(self, template_vars):
+        """Return rendered parts of the template, None if it's not made of includes only."""
+        with span('incremental render', 'template', template=self.name) as record:
+            parts = self._source(self.name)[2]
+            if parts is None:
+                return None
+            rendered = []
+            for text, include in parts:
+                rendered.append(text if include is None
+                                else self._render_include(include, template_vars))
+            record.args['includes'] = sum(1 for _, include in parts if include)
+            self.save()
+            return rendered
+
+    def save(self):
+        """Write cache if anything changed."""
+        if not self._changed:
+            return
+        atomic_write(self.path, pickle.dumps(self.cache, pickle.HIGHEST_PROTOCOL))
+        self._changed = False
@@ -0,0 +1,194 @@
+"""Run named jobs concurrently while respecting dependencies between them."""
+import sys
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from ci3.error import Ci3Error
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+_output_lock = threading.Lock()
+
+
+class JobError(Ci3Error):
+    """Raised if one or more jobs have failed."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(JobError, self).__init__('\n'.join(
+            '{}: {}'.format(name, error) for name, error in failures.items()))
+
+
+class JobOutput(object):
+    """
+    Collect output lines of a single job and prefix them with the job name.
+
+    In buffered mode lines are held back until `flush` is called, so output
+    of concurrent jobs does not interleave on the console.
+    """
+
+    def __init__(self, name, buffered=True, stream=None, tail_size=50):
+        self.name = name
+        self.buffered = buffered
+        self.stream = stream
+        self.lines = []
+        self.tail = deque(maxlen=tail_size)
+
+    def _write(self, lines):
+        stream = self.stream or sys.stdout
+        with _output_lock:
+            for line in lines:
+                stream.write('[{}] {}\n'.format(self.name, line.rstrip('\n')))
+            stream.flush()
+
+    def __call__(self, line):
+        """Accept a single line, e.g. as `Tool` `_out`/`_err` callback."""
+        self.tail.append(line)
+        if self.buffered:
+            self.lines.append(line)
+        else:
+            self._write([line])
+
+    def flush(self):
+        """Write out all buffered lines."""
+        lines, self.lines = self.lines, []
+        if lines:
+            self._write(lines)
+
+
+def _check_dependencies(jobs, depends_on):
+    """Raise error for unknown or cyclic dependencies."""
+    for name, deps in depends_on.items():
+        for dep in deps:
+            if dep not in jobs:
+                raise Ci3Error("Job `{}` depends on unknown job `{}`".format(name, dep))
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise Ci3Error("Cyclic dependency: {}".format(' -> '.join(path + [name])))
+        visiting.add(name)
+        for dep in depends_on.get(name, ()):
+            visit(dep, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in jobs:
+        visit(name, [])
+
+
+def path_lengths(jobs, depends_on, durations):
+    """
+    Return expected seconds from the start of each job to the end of its dependents.
+
+    Of the dependents the longest chain counts, i.e. the critical path.
+    Jobs without known duration are expected to take the average of the known ones.
+    """
+    known = [durations[name] for name in jobs if durations.get(name) is not None]
+    default = sum(known) / len(known) if known else 0
+    dependents = dict((name, []) for name in jobs)
+    for name, deps in depends_on.items():
+        for dep in deps:
+            dependents[dep].append(name)
+    lengths = {}
+
+    def length(name):
+        if name not in lengths:
+            own = durations.get(name)
+            lengths[name] = (default if own is None else own) + max(
+                [length(dependent) for dependent in dependents[name]] or [0])
+        return lengths[name]
+
+    return dict((name, length(name)) for name in jobs)
+
+
+def _traced(name, job, scope):
+    with span(name, 'job'), scope:
+        return job()
+
+
+def run_jobs(jobs, max_workers=1, depends_on=None, groups=None, limits=None,
+             cancel_on_failure=True, durations=None):
+    """
+    Run jobs, i.e. ordered mapping of name to callable, in a thread pool.
+
+    A job is started only after all of its `depends_on[name]` jobs have
+    succeeded. Optionally jobs are assigned to `groups[name]` and at most
+    `limits[group]` jobs of a group run at the same time. After the first
+    failure no new jobs are started, processes of jobs already running are
+    terminated (or the jobs drained, if not `cancel_on_failure`) and
+    `JobError` is raised with all failures. Processes of running jobs are
+    terminated as well when the caller is interrupted, e.g. by Ctrl-C.
+    Given expected `durations[name]` in seconds, ready jobs on the longest
+    path to the end start first, otherwise jobs start in order.
+    Return mapping of job name to the value returned by the job.
+    """
+    from ci3.process import CancelScope
+    max_workers = max(1, max_workers)
+    depends_on = dict((name, list(depends_on.get(name, ())) if depends_on else [])
+                      for name in jobs)
+    groups = groups or {}
+    limits = limits or {}
+    _check_dependencies(jobs, depends_on)
+    pending = list(jobs)
+    if durations:
+        lengths = path_lengths(jobs, depends_on, durations)
+        pending.sort(key=lambda name: -lengths[name])
+    running = {}
+    scopes = {}
+    results = {}
+    failures = {}
+    cancelled = []
+
+    def is_ready(name):
+        group = groups.get(name)
+        if group in limits:
+            in_group = sum(1 for other in running.values() if groups.get(other) == group)
+            if in_group >= max(1, limits[group]):
+                return False
+        return all(dep in results for dep in depends_on[name])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while pending or running:
+                if not failures:
+                    for name in list(pending):
+                        if len(running) >= max_workers:
+                            break
+                        if is_ready(name):
+                            pending.remove(name)
+                            scopes[name] = CancelScope()
+                            future = executor.submit(_traced, name, jobs[name], scopes[name])
+                            running[future] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        results[name] = future.result()
+                    elif scopes[name].cancelled:
+                        cancelled.append(name)
+                    else:
+                        logger.error('Job %s failed: %s' % (name, error))
+                        failures[name] = error
+                if failures and cancel_on_failure:
+                    for name in running.values():
+                        scopes[name].cancel()
+        except BaseException:
+            # E.g. KeyboardInterrupt: processes run in sessions of their own and
+            # don't get the terminal's SIGINT, so stop them before re-raising.
+            for name in running.values():
+                scopes[name].cancel()
+            raise
+    if failures:
+        if pending or cancelled:
+            logger.warning('Cancelled jobs: %s' % ', '.join(cancelled + pending))
+        raise JobError(failures)
+    return OrderedDict((name, results[name]) for name in jobs)
@@ -0,0 +1,524 @@
+"""
+Cluster backends used by kubic to change k8s state.
+
+`KubectlBackend` shells out to `kubectl`. `ApiBackend` talks to the API server
+directly over pooled keep-alive connections, with cached API discovery, and
+saves process startup, kubeconfig parsing and TLS handshake per call.
+"""
+import os
+import re
+import ssl
+import json
+import math
+import time
+import base64
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from http import client as http_client
+
+from ci3.cache import atomic_write
+from ci3.error import Ci3Error
+from ci3.httppool import ConnectionPool
+from ci3.manifests import dump_objects
+from ci3.tools import Tool
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+kubectl = Tool('kubectl')
+FIELD_MANAGER = 'kubic'
+# Seconds API discovery cached on disk is considered fresh.
+DISCOVERY_TTL = 600
+# Seconds before its expiry a credential plugin token is renewed.
+TOKEN_RENEW_MARGIN = 60
+# Seconds a watch with timeout is read longer than the server is asked to keep it open.
+WATCH_TIMEOUT_MARGIN = 10
+# Seconds to wait before resuming a watch the server ended right away.
+WATCH_RETRY_DELAY = 1
+BACKENDS = ('kubectl', 'api')
+
+
+class KubeApiError(Ci3Error):
+    """Raised if the API server rejects a request."""
+
+
+def kubeconfig_path():
+    """Return path to kubeconfig, i.e. first of `KUBECONFIG` or `~/.kube/config`."""
+    paths = [path for path in os.environ.get('KUBECONFIG', '').split(os.pathsep) if path]
+    return paths[0] if paths else os.path.expanduser(os.path.join('~', '.kube', 'config'))
+
+
+def load_kubeconfig(path=None):
+    """Parse kubeconfig yaml, return dict."""
+    import yaml
+    path = path or kubeconfig_path()
+    try:
+        with open(path) as stream:
+            return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+    except (IOError, OSError) as error:
+        raise Ci3Error("Failed to read kubeconfig {}: {}".format(path, error))
+
+
+def _named(items, name, what):
+    for item in items or []:
+        if item.get('name') == name:
+            return item.get(what) or {}
+    raise Ci3Error("No {} `{}` in kubeconfig".format(what, name))
+
+
+def parse_timestamp(value):
+    """Return epoch seconds of RFC 3339 timestamp, e.g. `2024-01-02T03:04:05.123456789Z`."""
+    from datetime import datetime, timezone
+    match = re.match(r'(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$',
+                     str(value).strip())
+    if not match:
+        raise ValueError('Invalid timestamp: {}'.format(value))
+    timestamp = datetime.strptime(match.group(1).replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S')
+    offset = match.group(3) or 'Z'
+    seconds = timestamp.replace(tzinfo=timezone.utc).timestamp()
+    if offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60)
+    return seconds + float('0.' + (match.group(2) or '0'))
+
+
+def credentials_expiry(context_name, kubeconfig=None):
+    """
+    Return (usable, expiry) of the credentials of a kubeconfig context.
+
+    Not usable are credentials of a missing context or user. Expiry is in
+    epoch seconds, None if unknown, e.g. for static tokens, client
+    certificates and credential plugins, which renew tokens on their own.
+    """
+    config = kubeconfig if kubeconfig is not None else load_kubeconfig()
+    try:
+        context = _named(config.get('contexts'), context_name, 'context')
+        user = _named(config.get('users'), context.get('user'), 'user')
+    except Ci3Error:
+        return False, None
+    if not user:
+        return False, None
+    provider = user.get('auth-provider') or {}
+    expiry = (provider.get('config') or {}).get('expiry')
+    if expiry:
+        try:
+            return True, parse_timestamp(expiry)
+        except ValueError:
+            return False, None
+    return True, None
+
+
+class KubeContext(object):
+    """Server, TLS and credentials of a kubeconfig context."""
+
+    def __init__(self, context_name=None, kubeconfig=None):
+        config = kubeconfig if kubeconfig is not None else load_kubeconfig()
+        self.name = context_name or config.get('current-context')
+        context = _named(config.get('contexts'), self.name, 'context')
+        self.cluster = _named(config.get('clusters'), context.get('cluster'), 'cluster')
+        self.user = _named(config.get('users'), context.get('user'), 'user')
+        self.namespace = context.get('namespace') or 'default'
+        self.server = self.cluster['server']
+        self._token = None
+        self._token_expiry = None
+        self._lock = threading.Lock()
+        self._tmp_files = []
+
+    def _data_file(self, data):
+        """Write base64 encoded kubeconfig `*-data` into a temporary file, return its path."""
+        handle, path = tempfile.mkstemp(prefix='kubic-')
+        with os.fdopen(handle, 'wb') as stream:
+            stream.write(base64.b64decode(data))
+        self._tmp_files.append(path)
+        return path
+
+    def ssl_context(self):
+        """Return SSL context validating the server and presenting the client cert, if any."""
+        if self.cluster.get('insecure-skip-tls-verify'):
+            context = ssl._create_unverified_context()
+        elif self.cluster.get('certificate-authority-data'):
+            context = ssl.create_default_context(
+                cadata=base64.b64decode(self.cluster['certificate-authority-data']).decode('ascii'))
+        else:
+            context = ssl.create_default_context(cafile=self.cluster.get('certificate-authority'))
+        cert = self.user.get('client-certificate')
+        key = self.user.get('client-key')
+        if self.user.get('client-certificate-data'):
+            cert = self._data_file(self.user['client-certificate-data'])
+        if self.user.get('client-key-data'):
+            key = self._data_file(self.user['client-key-data'])
+        try:
+            if cert:
+                context.load_cert_chain(cert, key)
+        finally:
+            for path in self._tmp_files:
+                os.remove(path)
+            self._tmp_files = []
+        return context
+
+    def _exec_token(self):
+        """Run client-go credential plugin, e.g. `gke-gcloud-auth-plugin`, return token."""
+        from ci3.process import ProcessError
+        spec = self.user['exec']
+        env = dict(os.environ)
+        env.update(dict((item['name'], item['value']) for item in spec.get('env') or []))
+        try:
+            output = Tool(spec['command'])(*(spec.get('args') or []), _env=env, _timeout=60)
+        except ProcessError as error:
+            raise Ci3Error("Credential plugin `{}` failed: {}".format(spec['command'], error))
+        status = json.loads(str(output)).get('status') or {}
+        self._token_expiry = None
+        if status.get('expirationTimestamp'):
+            try:
+                self._token_expiry = parse_timestamp(status['expirationTimestamp'])
+            except ValueError:
+                logger.warning('Credential plugin `%s` returned invalid expiry %s'
+                               % (spec['command'], status['expirationTimestamp']))
+        return status.get('token')
+
+    def auth_headers(self):
+        """Return HTTP headers authenticating the user, credential plugin tokens are renewed."""
+        with self._lock:
+            return self._auth_headers()
+
+    def _auth_headers(self):
+        if self._token_expiry is not None \
+                and time.time() > self._token_expiry - TOKEN_RENEW_MARGIN:
+            self._token = self._token_expiry = None
+        if self._token is None:
+            if self.user.get('token'):
+                self._token = self.user['token']
+            elif self.user.get('tokenFile') or self.user.get('token-file'):
+                with open(self.user.get('tokenFile') or self.user.get('token-file')) as stream:
+                    self._token = stream.read().strip()
+            elif self.user.get('auth-provider'):
+                self._token = (self.user['auth-provider'].get('config') or {}).get('access-token')
+            elif self.user.get('exec'):
+                self._token = self._exec_token()
+            else:
+                self._token = ''
+        if self._token:
+            return {'Authorization': 'Bearer ' + self._token}
+        if self.user.get('username'):
+            basic = '{}:{}'.format(self.user['username'], self.user.get('password', ''))
+            return {'Authorization': 'Basic ' + base64.b64encode(basic.encode('utf-8')).decode('ascii')}
+        return {}
+
+
+class Watch(object):
+    """Iterable of objects reported by a watch, `close` stops watching."""
+
+    def __init__(self, objects, close):
+        self._objects = objects
+        self._close = close
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def close(self):
+        """Stop watching, release process or connection."""
+        try:
+            self._close()
+        except Exception:
+            logger.debug('Failed to close watch', exc_info=True)
+
+
+def _iter_json_objects(chunks):
+    """Yield JSON values from a stream of text chunks with values concatenated."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except ValueError:
+                break
+            yield value
+            buffer = buffer[end:]
+
+
+# `kubectl apply` output line of an applied object, e.g. `deployment.apps/web configured`.
+_APPLIED = re.compile(r'^([\w.-]+)/(\S+) (?:created|configured|unchanged|serverside-applied)')
+
+
+class KubectlBackend(object):
+    """Change cluster state by calling `kubectl`."""
+
+    # Objects per `kubectl apply` process, see `ci3.apply`.
+    batch_size = 50
+
+    def __init__(self, context_name=None, namespace=None, **_):
+        self.context_name = context_name
+        self.namespace = namespace
+
+    def kubectl(self, *args, **kwargs):
+        """Call kubectl with the explicit context of the cluster, if any."""
+        if self.context_name:
+            args = ('--context', self.context_name) + args
+        return kubectl(*args, **kwargs)
+
+    def _namespace_args(self, namespace=None):
+        namespace = namespace or self.namespace
+        return ('--namespace', namespace) if namespace else ()
+
+    def apply_batch(self, objects):
+        """
+        Apply k8s objects with `kubectl apply`, return list of (object, error or None).
+
+        There is one `kubectl apply --namespace` per namespace, objects without
+        one get the cluster namespace. kubectl ignores it for cluster scoped
+        objects, the same way `ApiBackend.object_path` does.
+        """
+        by_namespace = OrderedDict()
+        for obj in objects:
+            namespace = (obj.get('metadata') or {}).get('namespace') or self.namespace
+            by_namespace.setdefault(namespace, []).append(obj)
+        results = {}
+        for namespace, namespace_objects in by_namespace.items():
+            for obj, error in self._apply_namespace(namespace_objects, namespace):
+                results[id(obj)] = error
+        return [(obj, results[id(obj)]) for obj in objects]
+
+    def _apply_namespace(self, objects, namespace):
+        """
+        Apply objects of a namespace with one `kubectl apply`.
+
+        kubectl goes on after an object fails. Objects it does not report as
+        applied get the errors mentioning them, or all errors if none does.
+        """
+        from ci3.process import ProcessError
+        errors = []
+        try:
+            self.kubectl(*self._namespace_args(namespace) + ('apply', '-f', '-'),
+                         _in=dump_objects(objects), _err=errors.append)
+            return [(obj, None) for obj in objects]
+        except ProcessError as error:
+            output = str(error.result)
+        applied = set()
+        for line in output.splitlines():
+            match = _APPLIED.match(line)
+            if match:
+                applied.add((match.group(1).split('.')[0], match.group(2)))
+        errors = [line.rstrip('\n') for line in errors if line.strip()]
+        results = []
+        for obj in objects:
+            name = (obj.get('metadata') or {}).get('name')
+            if (str(obj.get('kind')).lower(), name) in applied:
+                results.append((obj, None))
+                continue
+            mentions = [line for line in errors if '"{}"'.format(name) in line]
+            results.append((obj, '\n'.join(mentions or errors) or 'kubectl apply failed'))
+        return results
+
+    def patch_deployment(self, name, payload):
+        """Strategic merge patch of a deployment."""
+        self.kubectl(*self._namespace_args() + ('patch', 'deployment', name,
+                                                '-p', json.dumps(payload)))
+
+    def watch(self, api_version, kind, timeout=None):
+        """Watch objects of kind in the namespace, see `Watch`, kubectl watches without timeout."""
+        args = self._namespace_args() + (
+            'get', '{}.{}'.format(kind.lower(), api_version.split('/')[0])
+            if '/' in api_version else kind.lower(), '--watch', '-o', 'json')
+        stream = self.kubectl(*args, _iter=True)
+        return Watch(_iter_json_objects(stream), stream.terminate)
+
+
+class ApiBackend(object):
+    """
+    Change cluster state via the k8s API server directly.
+
+    Objects are applied with server-side apply, field manager `kubic`, forcing
+    ownership of conflicting fields the same way `kubectl apply` overwrites them.
+    """
+
+    # Objects per job of `ci3.apply`, each is a request of its own.
+    batch_size = 5
+
+    def __init__(self, context_name=None, namespace=None, cache_dir=None, kube_context=None):
+        self.context = kube_context or KubeContext(context_name)
+        self.namespace = namespace or self.context.namespace
+        self.cache_dir = cache_dir
+        self.pool = ConnectionPool(self.context.server, ssl_context=self.context.ssl_context())
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        """Send request to the API server, return decoded JSON of the response."""
+        headers = {'Accept': 'application/json', 'User-Agent': 'kubic'}
+        headers.update(self.context.auth_headers())
+        if body is not None:
+            headers['Content-Type'] = content_type
+            body = json.dumps(body)
+        with span('{} {}'.format(method, path.split('?')[0]), 'http') as record:
+            response = self.pool.request(method, path, body, headers)
+            record.args['status'] = response.status
+        try:
+            result = json.loads(response.body.decode('utf-8')) if response.body else {}
+        except ValueError:
+            result = {'message': response.body[:200]}
+        if response.status >= 400:
+            raise KubeApiError("{} {} failed with {}: {}".format(
+                method, path, response.status, result.get('message', response.reason)))
+        return result
+
+    def _discovery_cache_path(self, group_version):
+        if not self.cache_dir:
+            return None
+        server = hashlib.sha1(self.context.server.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, server, group_version.replace('/', '_') + '.json')
+
+    def _discover(self, group_version):
+        """Return resource list of the API group version, cached in memory and on disk."""
+        cache_path = self._discovery_cache_path(group_version)
+        if cache_path and os.path.isfile(cache_path) \
+                and time.time() - os.path.getmtime(cache_path) < DISCOVERY_TTL:
+            try:
+                with open(cache_path) as stream:
+                    return json.load(stream)
+            except (OSError, ValueError) as error:
+                logger.debug('Ignoring discovery cache %s: %s' % (cache_path, error))
+        path = '/api/' + group_version if '/' not in group_version else '/apis/' + group_version
+        resources = self.request('GET', path).get('resources', [])
+        if cache_path:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            atomic_write(cache_path, json.dumps(resources))
+        return resources
+
+    def resource(self, api_version, kind):
+        """Return (plural resource name, is namespaced) of kind in API group version."""
+        key = (api_version, kind)
+        with self._lock:
+            if key not in self._resources:
+                for resource in self._discover(api_version):
+                    if '/' not in resource['name']:
+                        self._resources[(api_version, resource['kind'])] = (
+                            resource['name'], resource['namespaced'])
+                if key not in self._resources:
+                    raise KubeApiError("Unknown kind {} in {}".format(kind, api_version))
+        return self._resources[key]
+
+    def collection_path(self, api_version, kind, namespace=None):
+        """Return API path of all objects of kind (in the namespace)."""
+        plural, namespaced = self.resource(api_version, kind)
+        prefix = '/api/' if '/' not in api_version else '/apis/'
+        path = prefix + api_version
+        if namespaced:
+            path += '/namespaces/' + (namespace or self.namespace)
+        return '{}/{}'.format(path, plural)
+
+    def object_path(self, api_version, kind, name, namespace=None):
+        """Return API path of the named object."""
+        return '{}/{}'.format(self.collection_path(api_version, kind, namespace), name)
+
+    def apply_object(self, obj):
+        """Apply k8s object with a server-side apply request."""
+        metadata = obj.get('metadata') or {}
+        path = self.object_path(obj['apiVersion'], obj['kind'], metadata['name'],
+                                metadata.get('namespace'))
+        self.request('PATCH', path + '?fieldManager={}&force=true'.format(FIELD_MANAGER),
+                     obj, content_type='application/apply-patch+yaml')
+        logger.info('%s/%s applied' % (obj['kind'].lower(), metadata['name']))
+
+    def apply_batch(self, objects):
+        """Apply k8s objects one by one, return list of (object, error or None)."""
+        results = []
+        for obj in objects:
+            try:
+                self.apply_object(obj)
+                results.append((obj, None))
+            except (KubeApiError, OSError, KeyError) as error:
+                results.append((obj, error))
+        return results
+
+    def patch_deployment(self, name, payload):
+        """Strategic merge patch of a deployment."""
+        self.request('PATCH', self.object_path('apps/v1', 'Deployment', name), payload,
+                     content_type='application/strategic-merge-patch+json')
+
+    def watch(self, api_version, kind, timeout=None):
+        """
+        Watch objects of kind in the namespace over streaming requests, see `Watch`.
+
+        The response is read without timeout, or until `timeout` seconds plus
+        `WATCH_TIMEOUT_MARGIN` if given, the server ends the watch after
+        `timeout`. A watch ended by the server or timed out is resumed from
+        the last seen resource version, restarted if that is too old.
+        """
+        path = self.collection_path(api_version, kind) + '?watch=1&allowWatchBookmarks=true'
+        if timeout:
+            path += '&timeoutSeconds={}'.format(int(math.ceil(timeout)))
+        state = {'close': None, 'closed': False}
+
+        def connect(resource_version):
+            headers = {'Accept': 'application/json', 'User-Agent': 'kubic'}
+            headers.update(self.context.auth_headers())
+            response, state['close'] = self.pool.stream(
+                'GET', path + ('&resourceVersion=' + resource_version if resource_version else ''),
+                headers, read_timeout=timeout + WATCH_TIMEOUT_MARGIN if timeout else None)
+            if response.status == 410 and resource_version:
+                state['close']()
+                return connect(None)
+            if response.status >= 400:
+                state['close']()
+                raise KubeApiError("Watch of {} failed with {}".format(kind, response.status))
+            return response
+
+        def close():
+            state['closed'] = True
+            if state['close']:
+                state['close']()
+
+        def objects(response):
+            resource_version = None
+            while True:
+                started = time.time()
+                try:
+                    for line in iter(response.readline, b''):
+                        if not line.strip():
+                            continue
+                        event = json.loads(line.decode('utf-8'))
+                        obj = event.get('object') or {}
+                        if event.get('type') == 'ERROR':
+                            if obj.get('code') == 410:
+                                # Resource version too old, start over.
+                                resource_version = None
+                                break
+                            raise KubeApiError("Watch of {} failed: {}".format(
+                                kind, obj.get('message')))
+                        resource_version = (obj.get('metadata') or {}).get(
+                            'resourceVersion') or resource_version
+                        if event.get('type') != 'BOOKMARK':
+                            yield obj
+                except Exception as error:
+                    if state['closed']:
+                        # Reading a closed response fails in various ways.
+                        return
+                    if not isinstance(error, (OSError, http_client.HTTPException)):
+                        raise
+                    logger.debug('Watch of %s interrupted: %s' % (kind, error))
+                if state['closed']:
+                    return
+                state['close']()
+                if time.time() - started < WATCH_RETRY_DELAY:
+                    time.sleep(WATCH_RETRY_DELAY)
+                logger.debug('Resuming watch of %s at %s' % (kind, resource_version))
+                response = connect(resource_version)
+        return Watch(objects(connect(None)), close)
+
+
+def get_backend(name, context_name=None, namespace=None, cache_dir=None):
+    """Return cluster backend by name, see `BACKENDS`."""
+    if name == 'api':
+        return ApiBackend(context_name, namespace, cache_dir=cache_dir)
+    if name == 'kubectl':
+        return KubectlBackend(context_name, namespace)
+    raise Ci3Error("Unknown cluster backend `{}`, use one of: {}".format(name, ', '.join(BACKENDS)))
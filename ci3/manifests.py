@@ -0,0 +1,115 @@
+"""Split rendered k8s configuration into objects and track what has been applied."""
+import json
+import hashlib
+import logging
+
+from ci3.cache import atomic_write, cache_path
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_objects(k8s_config):
+    """Parse multi-document yaml string, return list of k8s objects (dicts)."""
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return [obj for obj in yaml.load_all(k8s_config, Loader=loader) if obj]
+
+
+class ChunkReader(object):
+    """Read-only file-like object over an iterable of text chunks, consumed as read."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        """Return up to size characters, all remaining ones if size is negative."""
+        pieces = []
+        while size != 0:
+            if self._offset == len(self._chunk):
+                self._chunk, self._offset = next(self._chunks, None), 0
+                if self._chunk is None:
+                    self._chunk = ''
+                    break
+                continue
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            pieces.append(self._chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return ''.join(pieces)
+
+
+def iter_objects(chunks):
+    """
+    Parse multi-document yaml from text chunks, e.g. `render_stream`, yield k8s objects.
+
+    Parsing goes along with rendering, each object is yielded as soon as its
+    document is complete and the whole text is never held in memory.
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    for obj in yaml.load_all(ChunkReader(chunks), Loader=loader):
+        if obj:
+            yield obj
+
+
+def dump_objects(objects):
+    """Return multi-document yaml string of k8s objects."""
+    import yaml
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    return yaml.dump_all(objects, Dumper=dumper, default_flow_style=False,
+                         explicit_start=True)
+
+
+def object_key(obj, namespace='default'):
+    """Return identity of k8s object, i.e. `apiVersion/kind/namespace/name`."""
+    metadata = obj.get('metadata') or {}
+    return '/'.join([str(obj.get('apiVersion')), str(obj.get('kind')),
+                     str(metadata.get('namespace') or namespace), str(metadata.get('name'))])
+
+
+def object_digest(obj):
+    """Return SHA256 of the normalized k8s object, independent of key order and formatting."""
+    normalized = json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class DigestStore(object):
+    """
+    Digests of the objects last applied successfully to cluster and namespace.
+
+    Stored locally in `.ci3/.cache/applied/<cluster>/<namespace>.json`.
+    """
+
+    def __init__(self, dotci3_path, cluster_name, namespace):
+        self.namespace = namespace
+        self.path = cache_path(dotci3_path, 'applied', cluster_name, namespace + '.json')
+        self._digests = None
+
+    @property
+    def digests(self):
+        """Return mapping of object key to digest of the last applied object."""
+        if self._digests is None:
+            try:
+                with open(self.path) as stream:
+                    self._digests = json.load(stream)
+            except (IOError, OSError, ValueError):
+                self._digests = {}
+        return self._digests
+
+    def is_changed(self, obj):
+        """Return whether object is new or differs from the last applied one."""
+        return self.digests.get(object_key(obj, self.namespace)) != object_digest(obj)
+
+    def changed(self, objects):
+        """Return objects which are new or differ from the last applied ones."""
+        return [obj for obj in objects if self.is_changed(obj)]
+
+    def save(self, objects):
+        """Remember digests of objects, call after they have been applied successfully."""
+        self._digests = dict((object_key(obj, self.namespace), object_digest(obj))
+                             for obj in objects)
+        atomic_write(self.path, json.dumps(self._digests, indent=1, sort_keys=True))
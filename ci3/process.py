@@ -0,0 +1,339 @@
+"""
+Run external processes on a shared asyncio event loop.
+
+The loop runs in a background thread, so commands and jobs running in
+threads call `run` as a blocking function while reading process output,
+feeding input, timeouts and termination all happen in one place. At most
+`MAX_PROCESSES` processes run at once.
+
+Jobs started by `ci3.jobs.run_jobs` run in a `CancelScope`. When a sibling
+job fails, the scope is cancelled and processes of the job are terminated.
+"""
+import os
+import time
+import atexit
+import signal
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import CancelledError
+
+from ci3.error import Ci3Error
+
+
+logger = logging.getLogger(__name__)
+MAX_PROCESSES = int(os.environ.get('KUBIC_MAX_PROCESSES') or 16)
+# Seconds a terminated process gets to exit before it is killed.
+KILL_GRACE = 5
+READ_SIZE = 64 * 1024
+TAIL_SIZE = 50
+_END = object()
+_local = threading.local()
+
+
+class ProcessError(Ci3Error):
+    """Raised if a process exits with non-zero code, times out or is cancelled."""
+
+    def __init__(self, result, reason=None):
+        self.result = result
+        self.exit_code = result.exit_code
+        reason = reason or 'exited with {}'.format(result.exit_code)
+        message = '`{}` {}'.format(' '.join(result.argv), reason)
+        if result.tail:
+            message += ':\n' + '\n'.join(result.tail)
+        super(ProcessError, self).__init__(message)
+
+
+class ProcessTimeout(ProcessError):
+    """Raised if a process did not finish in time."""
+
+
+class ProcessCancelled(ProcessError):
+    """Raised if a process was terminated as its job got cancelled."""
+
+
+class ProcessResult(object):
+    """Exit code, duration and output of a finished process, `str` of it is stdout."""
+
+    def __init__(self, argv, exit_code, duration, stdout, tail):
+        self.argv = argv
+        self.exit_code = exit_code
+        self.duration = duration
+        self.stdout = stdout
+        self.tail = tail
+
+    def __str__(self):
+        return self.stdout
+
+    def __repr__(self):
+        return '<ProcessResult `{}` exit {} in {:.2f}s>'.format(
+            ' '.join(self.argv), self.exit_code, self.duration)
+
+
+class CancelScope(object):
+    """Processes started by a thread, e.g. a job, terminated together on `cancel`."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def add(self, future):
+        """Track future of a running process, cancel it at once if the scope is cancelled."""
+        with self._lock:
+            if self.cancelled:
+                future.cancel()
+            else:
+                self._futures.add(future)
+
+    def discard(self, future):
+        """Stop tracking finished process."""
+        with self._lock:
+            self._futures.discard(future)
+
+    def cancel(self):
+        """Terminate running processes, refuse to start new ones."""
+        with self._lock:
+            self.cancelled = True
+            futures, self._futures = self._futures, set()
+        for future in futures:
+            future.cancel()
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'scope', None)
+        _local.scope = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.scope = self._outer
+
+
+def current_scope():
+    """Return `CancelScope` of the calling thread, None outside of jobs."""
+    return getattr(_local, 'scope', None)
+
+
+class _Engine(object):
+    """Event loop thread started on first use."""
+
+    def __init__(self):
+        self._loop = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.processes = set()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._serve, args=(loop,), name='process-engine')
+                thread.daemon = True
+                thread.start()
+                self._loop = loop
+        return self._loop
+
+    @staticmethod
+    def _serve(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    @property
+    def slots(self):
+        """Return semaphore bounding running processes, created in the loop thread."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(MAX_PROCESSES)
+        return self._slots
+
+    def submit(self, coroutine):
+        """Schedule coroutine on the loop, return `concurrent.futures.Future`."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def spawn(self, argv, stdin, env, cwd):
+        """Start process in its own process group, so `_signal` reaches its children."""
+        process = await asyncio.create_subprocess_exec(
+            *argv, stdin=stdin, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            env=env, cwd=cwd, start_new_session=True)
+        self.processes.add(process)
+        return process
+
+    def shutdown(self):
+        """Terminate processes still running at exit, e.g. on Ctrl-C."""
+        for process in list(self.processes):
+            if process.returncode is None:
+                _signal(process, signal.SIGTERM)
+
+
+_engine = _Engine()
+atexit.register(_engine.shutdown)
+
+
+def _signal(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _read_lines(stream, callbacks):
+    """Pass each line of stream, newline included, to all callbacks."""
+    pending = b''
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            text = line.decode('utf-8', 'replace') + '\n'
+            for callback in callbacks:
+                callback(text)
+    if pending:
+        text = pending.decode('utf-8', 'replace')
+        for callback in callbacks:
+            callback(text)
+
+
+async def _write_input(loop, stream, stdin):
+    """Write str, bytes or iterable of chunks to stream, then close it."""
+    chunks = iter([stdin] if isinstance(stdin, (str, bytes)) else stdin)
+    try:
+        while True:
+            # Chunks may be produced by rendering templates, keep the loop responsive.
+            chunk = await loop.run_in_executor(None, next, chunks, _END)
+            if chunk is _END:
+                break
+            stream.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # Process exited without reading all input, its exit code tells why.
+        logger.debug('Process closed its input early')
+    finally:
+        stream.close()
+
+
+async def _terminate(process):
+    """Terminate process group, kill it if it does not exit in `KILL_GRACE` seconds."""
+    if process.returncode is not None:
+        return
+    _signal(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_GRACE)
+    except asyncio.TimeoutError:
+        _signal(process, signal.SIGKILL)
+        await process.wait()
+
+
+async def _run(argv, stdin, on_stdout, on_stderr, timeout, env, cwd):
+    """Run process to completion, return (`ProcessResult`, None or failure reason)."""
+    loop = asyncio.get_running_loop()
+    stdout, tail = [], deque(maxlen=TAIL_SIZE)
+    stdout_callbacks = [tail.append, on_stdout or stdout.append]
+    stderr_callbacks = [tail.append] + ([on_stderr] if on_stderr else [])
+    async with _engine.slots:
+        start = time.time()
+        try:
+            process = await _engine.spawn(argv, asyncio.subprocess.PIPE if stdin is not None
+                                          else asyncio.subprocess.DEVNULL, env, cwd)
+        except OSError as error:
+            raise Ci3Error('Failed to run `{}`: {}'.format(' '.join(argv), error))
+        tasks = [_read_lines(process.stdout, stdout_callbacks),
+                 _read_lines(process.stderr, stderr_callbacks)]
+        if stdin is not None:
+            tasks.append(_write_input(loop, process.stdin, stdin))
+        reason = None
+        try:
+            await asyncio.wait_for(asyncio.gather(process.wait(), *tasks), timeout)
+        except asyncio.TimeoutError:
+            reason = 'timed out after {}s'.format(timeout)
+            await _terminate(process)
+        except asyncio.CancelledError:
+            await _terminate(process)
+            raise
+        finally:
+            _engine.processes.discard(process)
+        result = ProcessResult(argv, process.returncode, time.time() - start,
+                               ''.join(stdout), list(line.rstrip('\n') for line in tail))
+        return result, reason
+
+
+def run(argv, stdin=None, on_stdout=None, on_stderr=None, timeout=None, env=None, cwd=None):
+    """
+    Run process with argv, wait for it and return `ProcessResult`.
+
+    `stdin` is str, bytes or iterable of chunks fed to the process. Output
+    lines are passed to `on_stdout`/`on_stderr` callbacks as they come,
+    stdout not passed to a callback is captured in the result. Raise
+    `ProcessError` on non-zero exit code, `ProcessTimeout` if the process
+    takes longer than `timeout` seconds and `ProcessCancelled` if the scope
+    of the calling job gets cancelled.
+    """
+    argv = [str(arg) for arg in argv]
+    future = _engine.submit(_run(argv, stdin, on_stdout, on_stderr, timeout, env, cwd))
+    scope = current_scope()
+    if scope:
+        scope.add(future)
+    start = time.time()
+    try:
+        result, reason = future.result()
+    except CancelledError:
+        raise ProcessCancelled(ProcessResult(argv, None, time.time() - start, '', []),
+                               'cancelled')
+    finally:
+        if scope:
+            scope.discard(future)
+    if reason:
+        raise ProcessTimeout(result, reason)
+    if result.exit_code != 0:
+        raise ProcessError(result)
+    return result
+
+
+class ProcessStream(object):
+    """
+    Lines of stdout of a running process, e.g. `kubectl get --watch`.
+
+    Iteration ends when the process exits, `terminate` stops it early.
+    """
+
+    def __init__(self, argv, env=None, cwd=None):
+        import queue
+        self.argv = [str(arg) for arg in argv]
+        self.exit_code = None
+        self._lines = queue.Queue()
+        self._process = None
+        self._terminated = False
+        self._started = threading.Event()
+        _engine.submit(self._run(env, cwd))
+        self._started.wait()
+
+    async def _run(self, env, cwd):
+        try:
+            self._process = await _engine.spawn(self.argv, asyncio.subprocess.DEVNULL, env, cwd)
+        except OSError as error:
+            logger.warning('Failed to run `%s`: %s' % (' '.join(self.argv), error))
+            self._lines.put(_END)
+            return
+        finally:
+            self._started.set()
+        try:
+            await asyncio.gather(_read_lines(self._process.stdout, [self._lines.put]),
+                                 _read_lines(self._process.stderr, [logger.debug]))
+            self.exit_code = await self._process.wait()
+        finally:
+            _engine.processes.discard(self._process)
+            self._lines.put(_END)
+
+    def __iter__(self):
+        while True:
+            line = self._lines.get()
+            if line is _END:
+                return
+            yield line
+
+    def terminate(self):
+        """Stop the process, iteration ends once its output is read."""
+        if self._process is not None and not self._terminated:
+            self._terminated = True
+            _engine.submit(_terminate(self._process))
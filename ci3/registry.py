@@ -0,0 +1,192 @@
+"""
+Minimal Docker Registry HTTP API v2 client to find images already pushed.
+
+Only manifests and blob existence are looked up, with HEAD requests where
+possible, so pushing an image whose content is already in the registry can
+be replaced by adding a tag to its manifest.
+"""
+import os
+import json
+import base64
+import logging
+import threading
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from ci3.error import Ci3Error
+from ci3.httppool import ConnectionPool
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+MANIFEST_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+)
+# Registries served over plain HTTP, e.g. `registry:2` container stand-in.
+INSECURE_HOSTS = ('localhost', '127.0.0.1')
+_registries = {}
+_lock = threading.Lock()
+
+
+class RegistryError(Ci3Error):
+    """Raised if the registry refuses or fails a request."""
+
+
+def parse_reference(reference):
+    """Split image reference `host/repository:tag` into (host, repository, tag)."""
+    name, _, digest = reference.partition('@')
+    host, _, path = name.partition('/')
+    if not path or ('.' not in host and ':' not in host and host != 'localhost'):
+        # Docker Hub image, e.g. `library/nginx:latest`.
+        host, path = 'registry-1.docker.io', name
+    repository, tag = path, 'latest'
+    if ':' in path.rsplit('/', 1)[-1]:
+        repository, tag = path.rsplit(':', 1)
+    return host, repository, digest or tag
+
+
+def docker_credentials(host):
+    """Return (user, password) for host from `~/.docker/config.json`, None if not there."""
+    config_path = os.path.join(os.environ.get('DOCKER_CONFIG') or
+                               os.path.expanduser('~/.docker'), 'config.json')
+    try:
+        with open(config_path) as stream:
+            auths = json.load(stream).get('auths') or {}
+    except (IOError, OSError, ValueError):
+        return None
+    for server, entry in auths.items():
+        if server.split('://')[-1].rstrip('/').split('/')[0] == host and entry.get('auth'):
+            user, _, password = base64.b64decode(entry['auth']).decode('utf-8').partition(':')
+            return user, password
+    return None
+
+
+def _parse_challenge(header):
+    """Return scheme and params of `WWW-Authenticate` header."""
+    scheme, _, rest = (header or '').partition(' ')
+    params = {}
+    for part in rest.split(','):
+        key, _, value = part.strip().partition('=')
+        if key:
+            params[key] = value.strip('"')
+    return scheme.lower(), params
+
+
+class Registry(object):
+    """Client of a single registry host, safe to share between threads."""
+
+    def __init__(self, host, credentials=None, insecure=False):
+        self.host = host
+        self.credentials = credentials
+        scheme = 'http' if insecure or host.split(':')[0] in INSECURE_HOSTS else 'https'
+        self.pool = ConnectionPool('{}://{}'.format(scheme, host))
+        self._authorization = {}
+        self._lock = threading.Lock()
+
+    def _basic(self):
+        user, password = self.credentials
+        value = '{}:{}'.format(user, password).encode('utf-8')
+        return 'Basic ' + base64.b64encode(value).decode('ascii')
+
+    def _authorize(self, challenge):
+        """Return `Authorization` header answering the 401 challenge."""
+        scheme, params = _parse_challenge(challenge)
+        if scheme == 'basic':
+            if not self.credentials:
+                raise RegistryError('Registry {} requires credentials'.format(self.host))
+            return self._basic()
+        if scheme != 'bearer' or 'realm' not in params:
+            raise RegistryError('Unsupported registry auth: {}'.format(challenge))
+        query = dict((key, params[key]) for key in ('service', 'scope') if key in params)
+        request = Request('{}?{}'.format(params['realm'], urlencode(query)))
+        if self.credentials:
+            request.add_header('Authorization', self._basic())
+        with span('registry token', 'http'):
+            with urlopen(request, timeout=30) as response:
+                token = json.loads(response.read().decode('utf-8'))
+        return 'Bearer ' + (token.get('token') or token.get('access_token'))
+
+    def request(self, method, path, body=None, headers=None, scope=None):
+        """Send request, authenticate on 401, return `HttpResponse`."""
+        headers = dict(headers or {})
+        with self._lock:
+            authorization = self._authorization.get(scope)
+        retried = False
+        while True:
+            if authorization:
+                headers['Authorization'] = authorization
+            with span('{} {}'.format(method, path), 'http') as record:
+                response = self.pool.request(method, path, body, headers)
+                record.args['status'] = response.status
+            if response.status != 401 or retried:
+                return response
+            authorization = self._authorize(response.header('WWW-Authenticate'))
+            with self._lock:
+                self._authorization[scope] = authorization
+            retried = True
+
+    def manifest(self, repository, reference):
+        """Return (media type, raw manifest, digest), None if not in the registry."""
+        response = self.request('GET', '/v2/{}/manifests/{}'.format(repository, reference),
+                                headers={'Accept': ', '.join(MANIFEST_TYPES)}, scope=repository)
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise RegistryError('Manifest {}:{} lookup failed with {}'.format(
+                repository, reference, response.status))
+        return (response.header('Content-Type'), response.body,
+                response.header('Docker-Content-Digest'))
+
+    def manifest_digest(self, repository, reference):
+        """Return digest of manifest by HEAD request, None if not in the registry."""
+        response = self.request('HEAD', '/v2/{}/manifests/{}'.format(repository, reference),
+                                headers={'Accept': ', '.join(MANIFEST_TYPES)}, scope=repository)
+        if response.status != 200:
+            return None
+        return response.header('Docker-Content-Digest')
+
+    def blob_exists(self, repository, digest):
+        """Return True if the blob (layer or config) is in the repository."""
+        response = self.request('HEAD', '/v2/{}/blobs/{}'.format(repository, digest),
+                                scope=repository)
+        return response.status == 200
+
+    def put_manifest(self, repository, tag, media_type, raw):
+        """Tag manifest by uploading it under the new tag."""
+        response = self.request('PUT', '/v2/{}/manifests/{}'.format(repository, tag), raw,
+                                headers={'Content-Type': media_type},
+                                scope=repository + ':push')
+        if response.status not in (200, 201):
+            raise RegistryError('Tagging {}:{} failed with {}: {}'.format(
+                repository, tag, response.status, response.body[:200]))
+
+    def find_image(self, repository, image_id, references):
+        """
+        Return (media type, raw manifest, digest) of image with config `image_id`.
+
+        Manifests of `references` (tags or digests) are looked up in order.
+        A manifest counts only if all its blobs are in the repository.
+        """
+        for reference in references:
+            found = self.manifest(repository, reference)
+            if found is None:
+                continue
+            try:
+                manifest = json.loads(found[1].decode('utf-8'))
+            except ValueError:
+                continue
+            if (manifest.get('config') or {}).get('digest') != image_id:
+                continue
+            blobs = [manifest['config']] + (manifest.get('layers') or [])
+            if all(self.blob_exists(repository, blob['digest']) for blob in blobs):
+                return found
+        return None
+
+
+def get_registry(host, credentials=None, insecure=False):
+    """Return `Registry` client for host, one per process."""
+    with _lock:
+        if host not in _registries:
+            _registries[host] = Registry(host, credentials or docker_credentials(host), insecure)
+        return _registries[host]
@@ -0,0 +1,227 @@
+"""Git repository state resolved once per invocation, mostly without forking `git`."""
+import os
+import logging
+
+from ci3.error import Ci3Error
+from ci3.tools import Tool
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+_contexts = {}
+git = Tool('git')
+
+
+class RepoContext(object):
+    """
+    Branch, HEAD SHA and dirty state of the git repository at `path`.
+
+    Values are looked up lazily and memoized, except those taken from the
+    environment, which may differ between commands of `kubic serve`. Branch
+    and SHA are read from
+    `.git/HEAD`, loose refs and `packed-refs` directly; `git` is spawned only
+    as a fallback (e.g. for unusual ref storage) and for the dirty state.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._git_dir = None
+        self._common_dir = None
+        self._head = None
+        self._branch = None
+        self._sha = None
+        self._dirty = None
+        self._toplevel = None
+
+    @staticmethod
+    def _git(*args):
+        from ci3.process import ProcessError
+        try:
+            return str(git(*args)).strip()
+        except ProcessError as error:
+            raise Ci3Error("Failed to run `git {}`: {}".format(' '.join(args), error))
+
+    def _find_git_dir(self):
+        """Locate `.git` folder, follow `gitdir:` files of worktrees and submodules."""
+        path = os.path.abspath(self.path)
+        while True:
+            dot_git = os.path.join(path, '.git')
+            if os.path.isdir(dot_git):
+                return dot_git
+            if os.path.isfile(dot_git):
+                with open(dot_git) as stream:
+                    content = stream.read().strip()
+                if content.startswith('gitdir:'):
+                    return os.path.normpath(os.path.join(path, content[len('gitdir:'):].strip()))
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    @property
+    def git_dir(self):
+        """Return path to the git folder or None if not inside a git repository."""
+        if self._git_dir is None:
+            self._git_dir = self._find_git_dir() or ''
+            common_dir = self._git_dir
+            commondir_path = os.path.join(self._git_dir, 'commondir')
+            if self._git_dir and os.path.isfile(commondir_path):
+                with open(commondir_path) as stream:
+                    common_dir = os.path.normpath(
+                        os.path.join(self._git_dir, stream.read().strip()))
+            self._common_dir = common_dir
+        return self._git_dir or None
+
+    @property
+    def common_dir(self):
+        """Return git folder shared by all worktrees, e.g. holding refs, None outside git."""
+        if not self.git_dir:
+            return None
+        return self._common_dir
+
+    def _read_head(self):
+        """Return content of HEAD, i.e. `ref: refs/heads/<name>` or a detached SHA."""
+        if self._head is None:
+            if not self.git_dir or os.path.exists(os.path.join(self._common_dir, 'reftable')):
+                return None
+            with open(os.path.join(self.git_dir, 'HEAD')) as stream:
+                self._head = stream.read().strip()
+        return self._head
+
+    def _resolve_ref(self, ref):
+        """Resolve ref to SHA via loose ref files and `packed-refs`, None if not found."""
+        for _ in range(10):
+            for base in (self.git_dir, self._common_dir):
+                ref_path = os.path.join(base, *ref.split('/'))
+                if os.path.isfile(ref_path):
+                    with open(ref_path) as stream:
+                        value = stream.read().strip()
+                    break
+            else:
+                return self._read_packed_ref(ref)
+            if not value.startswith('ref:'):
+                return value
+            ref = value[len('ref:'):].strip()
+        return None
+
+    def _read_packed_ref(self, ref):
+        packed_refs_path = os.path.join(self._common_dir, 'packed-refs')
+        if not os.path.isfile(packed_refs_path):
+            return None
+        with open(packed_refs_path) as stream:
+            for line in stream:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+        return None
+
+    @property
+    def branch(self):
+        """Return name of the checkout branch, `HEAD` if detached, prefer `CI_COMMIT_REF_NAME`."""
+        if 'CI_COMMIT_REF_NAME' in os.environ:
+            # We are inside gitlab-runner, so branches are not checkout.
+            # Solution is to pick the name for them ENV variable.
+            return os.environ['CI_COMMIT_REF_NAME'].strip()
+        if self._branch is None:
+            with span('git branch', 'git'):
+                self._branch = self._lookup_branch()
+        return self._branch
+
+    def _lookup_branch(self):
+        head = self._read_head()
+        if head is None:
+            return self._git('rev-parse', '--abbrev-ref', 'HEAD')
+        if head.startswith('ref:'):
+            ref = head[len('ref:'):].strip()
+            prefix = 'refs/heads/'
+            return ref[len(prefix):] if ref.startswith(prefix) else ref
+        return 'HEAD'
+
+    @property
+    def head_sha(self):
+        """Return SHA1 of the local git HEAD."""
+        if self._sha is None:
+            with span('git head sha', 'git'):
+                head = self._read_head()
+                sha = None
+                if head is not None:
+                    sha = self._resolve_ref(head[len('ref:'):].strip()) \
+                        if head.startswith('ref:') else head
+                if sha is None:
+                    logger.debug('Falling back to `git rev-parse HEAD`')
+                    sha = self._git('rev-parse', 'HEAD')
+            self._sha = sha
+        return self._sha
+
+    @property
+    def is_dirty(self):
+        """Return True if the working tree has uncommitted changes."""
+        if self._dirty is None:
+            self._dirty = bool(self._git('status', '--porcelain', '--untracked-files=no'))
+        return self._dirty
+
+    @property
+    def toplevel(self):
+        """Return absolute path of the root of the working tree."""
+        if self._toplevel is None:
+            self._toplevel = self._git('rev-parse', '--show-toplevel')
+        return self._toplevel
+
+    def symbolic_ref(self, ref):
+        """Return ref the symbolic ref points to, e.g. `refs/remotes/origin/main`, or None."""
+        if self._read_head() is None:
+            try:
+                return self._git('symbolic-ref', '--quiet', ref) or None
+            except Ci3Error:
+                return None
+        # Symbolic refs are never packed.
+        for base in (self.git_dir, self._common_dir):
+            ref_path = os.path.join(base, *ref.split('/'))
+            if os.path.isfile(ref_path):
+                with open(ref_path) as stream:
+                    value = stream.read().strip()
+                return value[len('ref:'):].strip() if value.startswith('ref:') else None
+        return None
+
+    def resolve(self, ref):
+        """Return SHA of commit `ref`, None if it's not in the repository."""
+        try:
+            return self._git('rev-parse', '--verify', '--quiet', ref + '^{commit}') or None
+        except Ci3Error:
+            return None
+
+    def merge_base(self, ref):
+        """Return SHA of the best common ancestor of HEAD and `ref`, None if there is none."""
+        try:
+            return self._git('merge-base', 'HEAD', ref) or None
+        except Ci3Error:
+            return None
+
+    def changed_files(self, base):
+        """
+        Return paths changed in the working tree since commit `base`, untracked included.
+
+        Paths are relative to `toplevel`. Renamed files count as both paths.
+        """
+        with span('git diff', 'git', base=base):
+            # Don't quote paths with non-ASCII characters.
+            changed = self._git('-c', 'core.quotePath=false', 'diff', '--name-only',
+                                '--no-renames', base, '--').splitlines()
+            changed += self._git('-c', 'core.quotePath=false', 'ls-files', '--others',
+                                 '--exclude-standard', '--full-name').splitlines()
+        return sorted(set(path for path in changed if path))
+
+
+def forget_repo_contexts():
+    """Drop memoized repo contexts, e.g. after a checkout or commit."""
+    _contexts.clear()
+
+
+def get_repo_context(path=None):
+    """Return memoized `RepoContext` for path (default: current folder)."""
+    path = os.path.abspath(path or os.getcwd())
+    if path not in _contexts:
+        _contexts[path] = RepoContext(path)
+    return _contexts[path]
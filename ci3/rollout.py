@@ -0,0 +1,148 @@
+"""Wait for rollouts of deployments by watching deployments and their pods."""
+import time
+import logging
+import calendar
+import threading
+from queue import Queue, Empty
+
+from ci3.error import Ci3Error
+
+
+logger = logging.getLogger(__name__)
+# Seconds of allowed clock skew between kubic and the cluster.
+CLOCK_SKEW = 5
+# Waiting reasons of pod containers that won't resolve without a new rollout.
+FATAL_WAITING_REASONS = (
+    'CrashLoopBackOff',
+    'ImagePullBackOff',
+    'ErrImagePull',
+    'InvalidImageName',
+    'CreateContainerConfigError',
+)
+
+
+class RolloutError(Ci3Error):
+    """Raised if rollout failed or did not finish in time."""
+
+
+def deployment_is_ready(deployment):
+    """Return True if the latest generation of the deployment is fully rolled out."""
+    metadata = deployment.get('metadata') or {}
+    spec = deployment.get('spec') or {}
+    status = deployment.get('status') or {}
+    if status.get('observedGeneration', 0) < metadata.get('generation', 0):
+        return False
+    replicas = spec.get('replicas', 1)
+    updated = status.get('updatedReplicas', 0)
+    return (updated >= replicas
+            and status.get('replicas', 0) <= updated
+            and status.get('availableReplicas', 0) >= updated)
+
+
+def deployment_failure(deployment):
+    """Return reason if the rollout of the deployment has failed, else None."""
+    for condition in (deployment.get('status') or {}).get('conditions') or []:
+        if condition.get('type') == 'Progressing' \
+                and condition.get('reason') == 'ProgressDeadlineExceeded':
+            return condition.get('message') or condition['reason']
+    return None
+
+
+def created_at(obj):
+    """Return creation time of k8s object as unix timestamp, 0 if unknown."""
+    timestamp = (obj.get('metadata') or {}).get('creationTimestamp')
+    try:
+        return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return 0
+
+
+def pod_failure(pod):
+    """Return reason if a container of the pod can't start, else None."""
+    for container in (pod.get('status') or {}).get('containerStatuses') or []:
+        waiting = (container.get('state') or {}).get('waiting') or {}
+        if waiting.get('reason') in FATAL_WAITING_REASONS:
+            return '{}: {} {}'.format(container.get('name'), waiting['reason'],
+                                      waiting.get('message', '')).strip()
+    return None
+
+
+class RolloutWatcher(object):
+    """
+    Follow readiness of several deployments together.
+
+    One watch on deployments and one on pods of the namespace, regardless of
+    the number of deployments waited for. Only pods created `since` (unix time)
+    count as failed rollout, older ones belong to the previous rollout.
+    """
+
+    def __init__(self, backend, deployments, timeout=300, since=None):
+        self.backend = backend
+        self.deployments = list(deployments)
+        self.timeout = timeout
+        self.since = time.time() if since is None else since
+        self._events = Queue()
+        self._selectors = {}
+
+    def _pump(self, kind, watch):
+        try:
+            for obj in watch:
+                self._events.put((kind, obj))
+        except Exception as error:
+            self._events.put(('error', error))
+
+    def _owner_of(self, pod):
+        """Return name of the waited deployment whose selector matches the pod."""
+        labels = (pod.get('metadata') or {}).get('labels') or {}
+        for name, selector in self._selectors.items():
+            if selector and all(labels.get(key) == value for key, value in selector.items()):
+                return name
+        return None
+
+    def wait(self):
+        """Block until all deployments are ready, return mapping name to seconds since `since`."""
+        start = time.time()
+        pending = set(self.deployments)
+        ready = {}
+        watches = [('deployment', self.backend.watch('apps/v1', 'Deployment', self.timeout)),
+                   ('pod', self.backend.watch('v1', 'Pod', self.timeout))]
+        for kind, watch in watches:
+            thread = threading.Thread(target=self._pump, args=(kind, watch))
+            thread.daemon = True
+            thread.start()
+        try:
+            while pending:
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise RolloutError('Timeout after {}s waiting for: {}'.format(
+                        self.timeout, ', '.join(sorted(pending))))
+                try:
+                    kind, obj = self._events.get(timeout=min(remaining, 1))
+                except Empty:
+                    continue
+                if kind == 'error':
+                    raise RolloutError('Watch failed: {}'.format(obj))
+                if kind == 'deployment':
+                    name = (obj.get('metadata') or {}).get('name')
+                    if name not in pending:
+                        continue
+                    self._selectors[name] = ((obj.get('spec') or {}).get('selector') or {}) \
+                        .get('matchLabels')
+                    failure = deployment_failure(obj)
+                    if failure:
+                        raise RolloutError('Deployment {} failed: {}'.format(name, failure))
+                    if deployment_is_ready(obj):
+                        ready[name] = time.time() - self.since
+                        pending.discard(name)
+                        logger.info('Deployment %s ready after %.1fs' % (name, ready[name]))
+                else:
+                    name = self._owner_of(obj)
+                    failure = pod_failure(obj)
+                    if name in pending and failure \
+                            and created_at(obj) >= self.since - CLOCK_SKEW:
+                        raise RolloutError('Deployment {} failed, pod {} {}'.format(
+                            name, (obj.get('metadata') or {}).get('name'), failure))
+        finally:
+            for _, watch in watches:
+                watch.close()
+        return ready
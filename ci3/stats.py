@@ -0,0 +1,155 @@
+"""
+History of build and push runs per container in `.ci3/.cache/stats.sqlite3`.
+
+Durations, cache hits and image sizes are recorded by `kubic build`, `push`
+and `redo`. The history orders jobs longest first and is reported by
+`kubic stats`.
+"""
+import math
+import time
+import sqlite3
+import logging
+import threading
+
+from ci3.cache import cache_path
+
+
+logger = logging.getLogger(__name__)
+# Runs kept in the database, older ones are dropped.
+MAX_RUNS = 20000
+# Recent successful runs the expected duration of a job is the median of.
+EXPECTED_RUNS = 10
+# Recent runs compared to the runs before them to flag a regression.
+RECENT_RUNS = 3
+REGRESSION_FACTOR = 1.5
+REGRESSION_MIN_SECONDS = 10
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    container TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    cluster TEXT,
+    seconds REAL NOT NULL,
+    cache_hit INTEGER NOT NULL,
+    bytes INTEGER,
+    success INTEGER NOT NULL,
+    sha TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_container_stage ON runs (container, stage, id);
+"""
+
+
+def percentile(values, percent):
+    """Return nearest-rank percentile of values, None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, int(math.ceil(percent / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+class StatsStore(object):
+    """
+    Runs recorded by concurrent jobs, written by `save` in a single transaction.
+
+    `sha` is the commit runs are recorded at, or a function returning it,
+    called by `save`. Runs are not written if there is no commit.
+    """
+
+    def __init__(self, dotci3_path, cluster=None, sha=None):
+        self.path = cache_path(dotci3_path, 'stats.sqlite3')
+        self.cluster = cluster
+        self.sha = sha
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def record(self, container, stage, seconds, cache_hit=False, size=None, success=True):
+        """Remember a finished run of `stage` (`build` or `push`) of container."""
+        with self._lock:
+            self._pending.append((container, stage, self.cluster, seconds, int(bool(cache_hit)),
+                                  size, int(bool(success)), time.time()))
+
+    def save(self):
+        """Write recorded runs, drop the oldest ones beyond `MAX_RUNS`."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        sha = self.sha() if callable(self.sha) else self.sha
+        if sha is None:
+            logger.debug('No git commit, not recording build stats')
+            return
+        pending = [row[:-1] + (sha, row[-1]) for row in pending]
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany(
+                        'INSERT INTO runs (container, stage, cluster, seconds, cache_hit, bytes, '
+                        'success, sha, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', pending)
+                    connection.execute('DELETE FROM runs WHERE id <= '
+                                       '(SELECT MAX(id) FROM runs) - ?', (MAX_RUNS,))
+            finally:
+                connection.close()
+        except sqlite3.Error as error:
+            # Stats are nice to have, never fail the build for them.
+            logger.warning('Failed to record build stats: %s' % error)
+
+    def runs(self, stage=None, limit=50):
+        """Return mapping of (container, stage) to its last runs, oldest first, as dicts."""
+        query = 'SELECT container, stage, seconds, cache_hit, bytes, success FROM runs'
+        params = ()
+        if stage:
+            query += ' WHERE stage = ?'
+            params = (stage,)
+        try:
+            connection = self._connect()
+            try:
+                rows = connection.execute(query + ' ORDER BY id', params).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as error:
+            logger.warning('Failed to read build stats: %s' % error)
+            rows = []
+        runs = {}
+        for container, row_stage, seconds, cache_hit, size, success in rows:
+            runs.setdefault((container, row_stage), []).append({
+                'seconds': seconds, 'cache_hit': bool(cache_hit), 'bytes': size,
+                'success': bool(success)})
+        return dict((key, values[-limit:]) for key, values in runs.items())
+
+    def expected(self, stage):
+        """Return mapping of container to its expected seconds of `stage`."""
+        expected = {}
+        for (container, _), runs in self.runs(stage, limit=EXPECTED_RUNS * 2).items():
+            seconds = [run['seconds'] for run in runs if run['success']][-EXPECTED_RUNS:]
+            if seconds:
+                expected[container] = percentile(seconds, 50)
+        return expected
+
+
+def summarize(runs):
+    """Return p50/p95 seconds, hit rate, failures, last size and regression of runs."""
+    seconds = [run['seconds'] for run in runs if run['success']]
+    sizes = [run['bytes'] for run in runs if run['bytes'] is not None]
+    summary = {
+        'runs': len(runs),
+        'failures': sum(1 for run in runs if not run['success']),
+        'p50': percentile(seconds, 50),
+        'p95': percentile(seconds, 95),
+        'hit_rate': sum(1 for run in runs if run['cache_hit']) / float(len(runs)) if runs else None,
+        'bytes': sizes[-1] if sizes else None,
+        'regression': None,
+    }
+    recent, before = seconds[-RECENT_RUNS:], seconds[:-RECENT_RUNS]
+    if len(recent) == RECENT_RUNS and len(before) >= RECENT_RUNS:
+        current, baseline = percentile(recent, 50), percentile(before, 50)
+        if current > baseline * REGRESSION_FACTOR and current - baseline > REGRESSION_MIN_SECONDS:
+            summary['regression'] = current / baseline if baseline else float('inf')
+    return summary
@@ -0,0 +1,64 @@
+"""Shared jinja2 environment with compiled template cache."""
+import os
+import logging
+
+from ci3.cache import cache_path
+from ci3.trace import span
+
+
+logger = logging.getLogger(__name__)
+_environments = {}
+
+
+def get_environment(dotci3_path):
+    """
+    Return jinja2 environment for `.ci3` templates, one per process.
+
+    Templates are looked up in `.ci3` first, then by absolute path. Parsed
+    templates are kept in memory and reloaded if their mtime changes. Compiled
+    bytecode is stored in `.ci3/.cache/jinja2`, keyed by template name and path,
+    and is used only if the checksum of the template source still matches.
+    """
+    if dotci3_path not in _environments:
+        import jinja2
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_path(dotci3_path, 'jinja2', ''))
+        loader = jinja2.ChoiceLoader([jinja2.FileSystemLoader(dotci3_path),
+                                      jinja2.FileSystemLoader(os.path.sep)])
+        _environments[dotci3_path] = jinja2.Environment(loader=loader, auto_reload=True,
+                                                        bytecode_cache=bytecode_cache)
+    return _environments[dotci3_path]
+
+
+def forget_environments():
+    """Drop jinja2 environments together with their parsed templates."""
+    _environments.clear()
+
+
+def template_name(dotci3_path, template_path):
+    """Return loader name of the template at path: relative to `.ci3` or to filesystem root."""
+    path = os.path.abspath(template_path)
+    relpath = os.path.relpath(path, dotci3_path)
+    if relpath.startswith(os.pardir):
+        relpath = os.path.relpath(path, os.path.sep)
+    return relpath.replace(os.path.sep, '/')
+
+
+def get_template(dotci3_path, template_path):
+    """Return compiled template from path, served from cache when possible."""
+    name = template_name(dotci3_path, template_path)
+    logger.debug('Loading template %s' % name)
+    with span('load template', 'template', template=name):
+        return get_environment(dotci3_path).get_template(name)
+
+
+def buffered(chunks, buffer_size=64 * 1024):
+    """Join small rendered chunks into pieces of about buffer_size characters."""
+    pieces, size = [], 0
+    for chunk in chunks:
+        pieces.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield ''.join(pieces)
+            pieces, size = [], 0
+    if pieces:
+        yield ''.join(pieces)
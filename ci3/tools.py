@@ -0,0 +1,62 @@
+"""External command line tools, resolved on first use rather than at import time."""
+import shutil
+from functools import partial
+
+from ci3.error import Ci3Error
+from ci3.trace import span
+
+
+def _callback(target):
+    """Return line callback for a callable or a stream, e.g. `sys.stdout`."""
+    if target is None or callable(target):
+        return target
+    return target.write
+
+
+class Tool(object):
+    """
+    Lazy handle of an executable, e.g. `docker = Tool('docker')`.
+
+    The executable is looked up on PATH when the tool is called for the first
+    time, calls run on the process engine, see `ci3.process.run`. Keyword
+    arguments are `_in` (input), `_out`/`_err` (line callbacks or streams),
+    `_timeout` in seconds, `_env` and `_cwd`. With `_iter=True` a
+    `ProcessStream` of output lines is returned instead of waiting.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._path = None
+
+    @property
+    def path(self):
+        """Return path of the executable, raise error if it is missing."""
+        if self._path is None:
+            self._path = shutil.which(self.name)
+            if self._path is None:
+                raise Ci3Error("Executable `{}` not found on PATH".format(self.name))
+        return self._path
+
+    def __call__(self, *args, **kwargs):
+        from ci3 import process
+        argv = [self.path] + [str(arg) for arg in args]
+        if kwargs.get('_iter'):
+            return process.ProcessStream(argv, env=kwargs.get('_env'), cwd=kwargs.get('_cwd'))
+        with span(self.name, 'process', argv=[self.name] + argv[1:]) as record:
+            try:
+                result = process.run(argv, stdin=kwargs.get('_in'),
+                                     on_stdout=_callback(kwargs.get('_out')),
+                                     on_stderr=_callback(kwargs.get('_err')),
+                                     timeout=kwargs.get('_timeout'),
+                                     env=kwargs.get('_env'), cwd=kwargs.get('_cwd'))
+            except process.ProcessError as error:
+                record.args['exit_code'] = error.exit_code
+                raise
+            record.args['exit_code'] = 0
+            return result
+
+    def __getattr__(self, name):
+        """Return subcommand, e.g. `docker.build(..)` is `docker('build', ..)`."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return partial(self, name)
@@ -0,0 +1,99 @@
+"""
+Timing spans recorded in Chrome trace-event format, viewable in Perfetto.
+
+Tracing is off by default, then `span` costs one function call. Enable it with
+`kubic --trace FILE <command>`.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class _NullSpan(object):
+    """Span used while tracing is off, does nothing."""
+
+    @property
+    def args(self):
+        """Return throwaway args."""
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Collect complete (`ph: X`) trace events of nested spans from all threads."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._start = time.time()
+
+    def enable(self):
+        """Start recording spans."""
+        self.enabled = True
+        self._start = time.time()
+
+    def _tid(self):
+        ident = threading.current_thread().ident
+        with self._lock:
+            if ident not in self._threads:
+                self._threads[ident] = len(self._threads) + 1
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                    'tid': self._threads[ident],
+                    'args': {'name': threading.current_thread().name},
+                })
+            return self._threads[ident]
+
+    @contextmanager
+    def _span(self, name, category, args):
+        record = _Span(args)
+        start = time.time()
+        try:
+            yield record
+        except BaseException as error:
+            record.args.setdefault('error', str(error).strip().split('\n')[0])
+            raise
+        finally:
+            event = {
+                'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': self._tid(),
+                'ts': int((start - self._start) * 1e6), 'dur': int((time.time() - start) * 1e6),
+                'args': record.args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def span(self, name, category='kubic', **args):
+        """Return context manager timing the enclosed block, its `args` can be extended."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, category, args)
+
+    def save(self, path):
+        """Write recorded events as Chrome trace JSON."""
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as stream:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, stream, default=str)
+
+
+class _Span(object):
+    """Handle of a recorded span, `args` end up in the trace event."""
+
+    def __init__(self, args):
+        self.args = args
+
+
+tracer = Tracer()
+span = tracer.span
@@ -55,14 +55,18 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 
+    # The process engine relies on asyncio of Python 3.7.
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='kubernetes git ci continuous integration',
 
@@ -81,7 +85,6 @@ setup(
     install_requires=[
         'PyYAML>=3.12',
         'jinja2>=2.9.6',
-        'sh>=1.12.13',
     ],
 
     # List additional groups of dependencies here (e.g. development
@@ -90,7 +93,7 @@ setup(
     # $ pip install -e .[dev,test]
     extras_require={
         'dev': ['check-manifest'],
-        'test': ['coverage'],
+        'test': ['coverage', 'pytest'],
     },
 
     # If there are data files included in your packages that need to be
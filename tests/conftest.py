@@ -0,0 +1,94 @@
+"""Fixtures shared by the tests: an in-process HTTP server answering via a function."""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class Request(object):
+    """Request received by `FakeServer`."""
+
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class FakeServer(object):
+    """
+    HTTP/1.1 server in a background thread, `handle(request)` makes the responses.
+
+    `handle` returns (status, headers, body). A body of bytes is sent with
+    `Content-Length`, an iterable of bytes chunk by chunk with chunked
+    encoding. Received requests are kept in `requests`.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.requests = []
+        self.connections = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super(Handler, self).setup()
+                server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                request = Request(self.command, self.path, self.headers,
+                                  self.rfile.read(length) if length else b'')
+                server.requests.append(request)
+                status, headers, body = server.handle(request)
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                if isinstance(body, bytes):
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    if self.command != 'HEAD':
+                        self.wfile.write(body)
+                    return
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for chunk in body:
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                        self.wfile.flush()
+                    self.wfile.write(b'0\r\n\r\n')
+                except OSError:
+                    # Client went away, e.g. closed a watch.
+                    self.close_connection = True
+
+            do_GET = do_HEAD = do_PUT = do_PATCH = do_POST = _respond
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.host = '127.0.0.1:{}'.format(self.httpd.server_port)
+        self.url = 'http://' + self.host
+        self._thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def fake_server():
+    """Return function starting a `FakeServer` for a handle function, stopped after the test."""
+    servers = []
+
+    def start(handle):
+        servers.append(FakeServer(handle))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,105 @@
+"""Tests of `.dockerignore` rules and build context hashes."""
+import os
+
+import pytest
+
+from ci3.buildcontext import (FileHashCache, context_hash, is_ignored, read_dockerignore,
+                              with_dependencies)
+
+DOCKERIGNORE = """
+# Comments and blank lines are skipped.
+*.log
+**/__pycache__
+/build
+docs/*.md
+!build/keep.txt
+"""
+
+
+@pytest.mark.parametrize('relpath, ignored', [
+    ('app.log', True),
+    ('src/app.log', False),
+    ('src/pkg/__pycache__/mod.pyc', True),
+    ('__pycache__', True),
+    ('build', True),
+    ('build/out/bin', True),
+    ('build/keep.txt', False),
+    ('docs/index.md', True),
+    ('docs/api/index.md', False),
+    ('buildfile', False),
+    ('src/app.py', False),
+])
+def test_dockerignore_rules(tmp_path, relpath, ignored):
+    (tmp_path / '.dockerignore').write_text(DOCKERIGNORE)
+    assert is_ignored(relpath, read_dockerignore(str(tmp_path))) == ignored
+
+
+def test_missing_dockerignore_ignores_nothing(tmp_path):
+    assert read_dockerignore(str(tmp_path)) == []
+
+
+@pytest.fixture
+def context(tmp_path):
+    """Return function writing files of a build context, `.ci3` cache in it."""
+    dotci3 = tmp_path / '.ci3'
+    dotci3.mkdir()
+
+    def write(relpath, content='x'):
+        path = tmp_path.joinpath(*relpath.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        return path
+    write('.dockerignore', DOCKERIGNORE)
+    write('Dockerfile', 'FROM scratch\n')
+    write('src/app.py', 'print(1)\n')
+    write('build/keep.txt')
+    write.root = tmp_path
+    write.hash = lambda hash_cache=None: context_hash(
+        str(tmp_path), str(tmp_path / 'Dockerfile'), hash_cache or FileHashCache(str(dotci3)))
+    return write
+
+
+def test_ignored_files_dont_change_hash(context):
+    before = context.hash()
+    context('app.log')
+    context('build/out/bin')
+    context('src/__pycache__/app.pyc')
+    context('.ci3/.cache/renders/deploy.yaml.pickle')
+    assert context.hash() == before
+
+
+@pytest.mark.parametrize('change', [
+    lambda write: write('src/app.py', 'print(2)\n'),
+    lambda write: write('src/new.py'),
+    lambda write: os.rename(str(write.root / 'src' / 'app.py'), str(write.root / 'src' / 'b.py')),
+    lambda write: os.chmod(str(write.root / 'src' / 'app.py'), 0o755),
+    lambda write: write('build/keep.txt', 'y'),
+    lambda write: write('Dockerfile', 'FROM alpine\n'),
+    lambda write: write('.dockerignore', DOCKERIGNORE + 'src\n'),
+])
+def test_included_changes_change_hash(context, change):
+    before = context.hash()
+    change(context)
+    assert context.hash() != before
+
+
+def test_unchanged_files_are_not_read_again(context, monkeypatch):
+    dotci3 = str(context.root / '.ci3')
+    hash_cache = FileHashCache(dotci3)
+    before = context.hash(hash_cache)
+    hash_cache.save()
+    read = []
+    hash_file = FileHashCache._hash_file
+    monkeypatch.setattr(FileHashCache, '_hash_file',
+                        staticmethod(lambda path: read.append(path) or hash_file(path)))
+    assert context.hash(FileHashCache(dotci3)) == before
+    assert read == []
+    context('src/app.py', 'print(10)\n')
+    context.hash(FileHashCache(dotci3))
+    assert read == [str(context.root / 'src' / 'app.py')]
+
+
+def test_with_dependencies():
+    assert with_dependencies('a', []) == 'a'
+    assert with_dependencies('a', ['b', 'c']) == with_dependencies('a', ['c', 'b'])
+    assert with_dependencies('a', ['b']) not in ('a', with_dependencies('a', ['c']))
@@ -0,0 +1,102 @@
+"""Tests of selecting the commit `ChangeDetector` diffs containers against."""
+import subprocess
+
+import pytest
+
+from ci3.changes import ChangeDetector
+from ci3.error import Ci3Error
+from ci3.repo import RepoContext
+
+CONFIG_VARS = {
+    'cluster': {'image_registry_url': 'registry'},
+    'containers': dict((name, {'image': {'name': name}, 'build': {'context': name}})
+                       for name in ('web', 'api')),
+}
+
+
+def git(path, *args):
+    return subprocess.check_output(
+        ('git', '-c', 'user.name=test', '-c', 'user.email=test@example.com') + args,
+        cwd=str(path), stderr=subprocess.STDOUT).decode('utf-8').strip()
+
+
+def commit(path, *files):
+    for name in files:
+        target = path.joinpath(*name.split('/'))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(name + str(len(git(path, 'log', '--oneline', '--all') or '')))
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'change ' + ' '.join(files))
+    return git(path, 'rev-parse', 'HEAD')
+
+
+@pytest.fixture
+def clone(tmp_path, monkeypatch):
+    """Return clone of a repository with default branch `trunk`, checked out on `feature`."""
+    for name in ('CI_DEFAULT_BRANCH', 'CI_COMMIT_REF_NAME'):
+        monkeypatch.delenv(name, raising=False)
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git(origin, 'init', '-q', '-b', 'trunk')
+    commit(origin, 'web/Dockerfile', 'api/Dockerfile')
+    git(tmp_path, 'clone', '-q', str(origin), 'clone')
+    path = tmp_path / 'clone'
+    git(path, 'checkout', '-q', '-b', 'feature')
+    # `RepoContext` runs git in the current folder.
+    monkeypatch.chdir(path)
+    return path
+
+
+def affected(path, stage='build', since=None):
+    detector = ChangeDetector(str(path / '.ci3'), RepoContext(str(path)), stage, since)
+    return detector, detector.affected(CONFIG_VARS)
+
+
+def test_diffs_against_default_branch_of_origin(clone):
+    commit(clone, 'web/app.py')
+    detector, names = affected(clone)
+    assert detector.base_branches() == ['trunk', 'master', 'main']
+    assert names == {'web'}
+
+
+def test_falls_back_to_local_main(clone):
+    git(clone, 'remote', 'remove', 'origin')
+    git(clone, 'branch', '-q', 'main', 'trunk')
+    commit(clone, 'api/app.py')
+    assert affected(clone)[1] == {'api'}
+
+
+def test_ci_default_branch_wins(clone, monkeypatch):
+    commit(clone, 'web/app.py')
+    git(clone, 'branch', '-q', 'release')
+    monkeypatch.setenv('CI_DEFAULT_BRANCH', 'release')
+    detector, names = affected(clone)
+    assert detector.base_branches() == ['release']
+    assert names == set()
+
+
+def test_all_affected_on_base_branch_or_without_one(clone):
+    git(clone, 'checkout', '-q', 'trunk')
+    assert affected(clone)[1] == {'web', 'api'}
+    git(clone, 'checkout', '-q', 'feature')
+    git(clone, 'remote', 'remove', 'origin')
+    assert affected(clone)[1] == {'web', 'api'}
+
+
+def test_recorded_commit_wins_over_base_branch(clone):
+    commit(clone, 'web/app.py')
+    detector, _ = affected(clone)
+    detector.record('registry/web')
+    detector.save()
+    commit(clone, 'api/app.py')
+    assert affected(clone)[1] == {'api'}
+    # Other stages have records of their own.
+    assert affected(clone, 'push')[1] == {'web', 'api'}
+
+
+def test_since_overrides_records(clone):
+    first = commit(clone, 'web/app.py')
+    commit(clone, 'api/app.py')
+    assert affected(clone, since=first)[1] == {'api'}
+    with pytest.raises(Ci3Error):
+        affected(clone, since='no-such-ref')
@@ -0,0 +1,93 @@
+"""Tests of incremental rendering: after each kind of edit it must equal a full render."""
+import os
+
+import pytest
+
+from ci3.commands.dotci3 import DotCi3Mixin
+
+FILES = {
+    'deploy.yaml': "---\n{% include 'services/web.yaml' %}\n"
+                   "---\n{% include 'services/config.yaml' %}\n"
+                   "---\n{% include 'services/labels.yaml' %}\n",
+    'services/web.yaml': "kind: Deployment\nmetadata:\n  name: web\n"
+                         "{% include 'parts/container.yaml' %}\n",
+    'parts/container.yaml': "spec:\n  image: {{ containers.web.image }}\n",
+    'services/config.yaml': "kind: ConfigMap\ndata:\n  branch: {{ git.branch }}\n"
+                            "  stage: {{ env.KUBIC_TEST_STAGE | default('none') }}\n",
+    'services/labels.yaml': "kind: Service\nmetadata:\n  labels:\n"
+                            "{% for key, value in labels.items() %}"
+                            "    {{ key }}: {{ value }}\n{% endfor %}",
+    'vars/global.yaml': "containers:\n  web:\n    image: web:1\nlabels:\n  app: web\n",
+    'vars/clusters/minikube.yaml': "cluster:\n  type: minikube\n",
+}
+
+
+class Repo(object):
+    """Stand-in of `RepoContext` with a settable branch."""
+
+    branch = 'feature/one'
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Return function editing a file of a `.ci3` folder in the current directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('KUBIC_TEST_STAGE', raising=False)
+    edits = []
+
+    def edit(name, content):
+        path = tmp_path.joinpath('.ci3', *name.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        # Files are told apart by mtime, make sure edits within a tick count.
+        edits.append(None)
+        os.utime(str(path), (1e9 + len(edits), 1e9 + len(edits)))
+    for name, content in FILES.items():
+        edit(name, content)
+    return edit
+
+
+def render(repo=Repo, incremental=True):
+    command = DotCi3Mixin()
+    command.repo = repo
+    command.incremental_render = incremental
+    command.load_vars('minikube')
+    return command.render(command.deploy_path)
+
+
+def assert_rerenders(change, expected):
+    """Render, change something, check incremental output equals a full render and changed."""
+    before = render()
+    repo = change() or Repo
+    after = render(repo)
+    assert after == render(repo, incremental=False)
+    assert after != before
+    assert expected in after
+
+
+def test_edit_of_nested_include(project):
+    assert_rerenders(lambda: project('parts/container.yaml',
+                                     "spec:\n  image: {{ containers.web.image }}\n  replicas: 2\n"),
+                     'replicas: 2')
+
+
+def test_edit_of_vars_file(project):
+    assert_rerenders(lambda: project('vars/global.yaml', FILES['vars/global.yaml']
+                                     .replace('web:1', 'web:2')),
+                     'image: web:2')
+
+
+def test_change_of_git_branch(project):
+    class Other(Repo):
+        branch = 'feature/two'
+    assert_rerenders(lambda: Other, 'branch: two')
+
+
+def test_change_of_env_value(project, monkeypatch):
+    assert_rerenders(lambda: monkeypatch.setenv('KUBIC_TEST_STAGE', 'prod'), 'stage: prod')
+
+
+def test_new_key_of_looped_mapping(project):
+    assert_rerenders(lambda: project('vars/global.yaml', FILES['vars/global.yaml']
+                                     + '  tier: front\n'),
+                     'tier: front')
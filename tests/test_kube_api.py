@@ -0,0 +1,229 @@
+"""Tests of the API server backend and its keep-alive connections against a fake API server."""
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ci3.httppool import ConnectionPool
+from ci3.kube import ApiBackend, KubeApiError, KubeContext
+
+RESOURCES = {
+    '/api/v1': [
+        {'name': 'configmaps', 'kind': 'ConfigMap', 'namespaced': True},
+        {'name': 'namespaces', 'kind': 'Namespace', 'namespaced': False},
+        {'name': 'pods', 'kind': 'Pod', 'namespaced': True},
+        {'name': 'pods/log', 'kind': 'Pod', 'namespaced': True},
+    ],
+    '/apis/apps/v1': [
+        {'name': 'deployments', 'kind': 'Deployment', 'namespaced': True},
+    ],
+}
+
+
+class FakeContext(object):
+    """Stand-in of `KubeContext` for a plain HTTP fake API server."""
+
+    namespace = 'default'
+
+    def __init__(self, server):
+        self.server = server
+
+    def ssl_context(self):
+        return None
+
+    def auth_headers(self):
+        return {'Authorization': 'Bearer secret'}
+
+
+def json_response(status, value):
+    return status, {'Content-Type': 'application/json'}, json.dumps(value).encode('utf-8')
+
+
+def event(kind, name, resource_version):
+    return (json.dumps({'type': kind, 'object': {
+        'metadata': {'name': name, 'resourceVersion': resource_version}}}) + '\n').encode('utf-8')
+
+
+def api_server(fake_server, watch=None, fail=()):
+    """Start fake API server, `watch(request)` returns chunks of watch responses."""
+    def handle(request):
+        path = request.path.split('?')[0]
+        if path in RESOURCES:
+            return json_response(200, {'resources': RESOURCES[path]})
+        if 'watch=1' in request.path:
+            return 200, {'Content-Type': 'application/json'}, watch(request)
+        if path.rsplit('/', 1)[-1] in fail:
+            return json_response(422, {'message': 'invalid object'})
+        return json_response(200, json.loads(request.body.decode('utf-8')))
+    server = fake_server(handle)
+    return server, ApiBackend(namespace='ns', kube_context=FakeContext(server.url))
+
+
+def test_apply_batch_reports_errors_per_object(fake_server):
+    server, backend = api_server(fake_server, fail=('bad',))
+    objects = [
+        {'apiVersion': 'v1', 'kind': 'Namespace', 'metadata': {'name': 'ns'}},
+        {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'bad'}},
+        {'apiVersion': 'apps/v1', 'kind': 'Deployment', 'metadata': {'name': 'web'}},
+    ]
+    results = backend.apply_batch(objects)
+    assert [obj['metadata']['name'] for obj, _ in results] == ['ns', 'bad', 'web']
+    assert results[0][1] is None and results[2][1] is None
+    assert isinstance(results[1][1], KubeApiError)
+    assert 'invalid object' in str(results[1][1])
+    patches = [request for request in server.requests if request.method == 'PATCH']
+    assert [request.path for request in patches] == [
+        '/api/v1/namespaces/ns?fieldManager=kubic&force=true',
+        '/api/v1/namespaces/ns/configmaps/bad?fieldManager=kubic&force=true',
+        '/apis/apps/v1/namespaces/ns/deployments/web?fieldManager=kubic&force=true',
+    ]
+    assert all(request.headers['Content-Type'] == 'application/apply-patch+yaml'
+               and request.headers['Authorization'] == 'Bearer secret' for request in patches)
+    assert json.loads(patches[2].body.decode('utf-8')) == objects[2]
+
+
+def test_patch_deployment(fake_server):
+    server, backend = api_server(fake_server)
+    payload = {'spec': {'template': {'spec': {'containers': [{'name': 'web', 'image': 'web:1'}]}}}}
+    backend.patch_deployment('web', payload)
+    request = server.requests[-1]
+    assert request.method == 'PATCH'
+    assert request.path == '/apis/apps/v1/namespaces/ns/deployments/web'
+    assert request.headers['Content-Type'] == 'application/strategic-merge-patch+json'
+    assert json.loads(request.body.decode('utf-8')) == payload
+
+
+def test_patch_deployment_raises_on_error(fake_server):
+    _, backend = api_server(fake_server, fail=('web',))
+    with pytest.raises(KubeApiError):
+        backend.patch_deployment('web', {})
+
+
+def test_requests_reuse_connection(fake_server):
+    server, backend = api_server(fake_server)
+    for name in ('a', 'b', 'c'):
+        backend.patch_deployment(name, {})
+    assert len(server.requests) == 4
+    assert server.connections == 1
+
+
+def test_pool_reconnects_after_server_closed_connection(fake_server):
+    server = fake_server(lambda request: (200, {'Connection': 'close'}, b'ok'))
+    pool = ConnectionPool(server.url)
+    assert [pool.request('GET', '/').body for _ in range(3)] == [b'ok'] * 3
+    assert server.connections == 3
+
+
+def test_watch_parses_chunked_stream(fake_server):
+    def watch(request):
+        # Events split across chunks, bookmarks only move the resource version.
+        first, second = event('ADDED', 'a', '1'), event('MODIFIED', 'b', '2')
+        yield first[:10]
+        yield first[10:] + second[:5]
+        yield second[5:] + event('BOOKMARK', '', '3')
+        time.sleep(5)
+    _, backend = api_server(fake_server, watch)
+    watch = backend.watch('apps/v1', 'Deployment')
+    objects = iter(watch)
+    assert [next(objects)['metadata']['name'] for _ in range(2)] == ['a', 'b']
+    watch.close()
+    assert list(objects) == []
+
+
+def test_watch_resumes_from_last_resource_version(fake_server, monkeypatch):
+    monkeypatch.setattr('ci3.kube.WATCH_RETRY_DELAY', 0)
+
+    def watch(request):
+        if 'resourceVersion=' not in request.path:
+            yield event('ADDED', 'a', '7')
+        else:
+            yield event('MODIFIED', 'a', '8')
+            time.sleep(5)
+    server, backend = api_server(fake_server, watch)
+    watch = backend.watch('v1', 'Pod', timeout=30)
+    objects = iter(watch)
+    assert [next(objects)['metadata']['resourceVersion'] for _ in range(2)] == ['7', '8']
+    watch.close()
+    paths = [request.path for request in server.requests if 'watch=1' in request.path]
+    assert paths == [
+        '/api/v1/namespaces/ns/pods?watch=1&allowWatchBookmarks=true&timeoutSeconds=30',
+        '/api/v1/namespaces/ns/pods?watch=1&allowWatchBookmarks=true&timeoutSeconds=30'
+        '&resourceVersion=7',
+    ]
+
+
+def test_watch_error_event_raises(fake_server):
+    def watch(request):
+        yield (json.dumps({'type': 'ERROR', 'object': {'code': 500, 'message': 'boom'}})
+               + '\n').encode('utf-8')
+    _, backend = api_server(fake_server, watch)
+    with pytest.raises(KubeApiError) as info:
+        list(backend.watch('v1', 'Pod'))
+    assert 'boom' in str(info.value)
+
+
+def test_watch_restarts_when_resource_version_is_gone(fake_server, monkeypatch):
+    monkeypatch.setattr('ci3.kube.WATCH_RETRY_DELAY', 0)
+    calls = []
+
+    def watch(request):
+        calls.append(request.path)
+        if len(calls) == 1:
+            yield event('ADDED', 'a', '5')
+        elif len(calls) == 2:
+            yield (json.dumps({'type': 'ERROR', 'object': {'code': 410, 'message': 'too old'}})
+                   + '\n').encode('utf-8')
+        else:
+            yield event('ADDED', 'a', '9')
+            time.sleep(5)
+    _, backend = api_server(fake_server, watch)
+    watch = backend.watch('v1', 'Pod')
+    objects = iter(watch)
+    assert [next(objects)['metadata']['resourceVersion'] for _ in range(2)] == ['5', '9']
+    watch.close()
+    assert ['resourceVersion=' in path for path in calls] == [False, True, False]
+
+
+def test_unreadable_discovery_cache_is_a_miss(fake_server, tmp_path):
+    server, _ = api_server(fake_server)
+    backend = ApiBackend(kube_context=FakeContext(server.url), cache_dir=str(tmp_path))
+    cache_path = backend._discovery_cache_path('v1')
+    os.makedirs(os.path.dirname(cache_path))
+    with open(cache_path, 'w') as stream:
+        stream.write('{"truncated')
+    assert backend.resource('v1', 'ConfigMap') == ('configmaps', True)
+    with open(cache_path) as stream:
+        assert json.load(stream) == RESOURCES['/api/v1']
+    assert os.listdir(os.path.dirname(cache_path)) == ['v1.json']
+
+
+def exec_context(tmp_path, expires_in):
+    """Return `KubeContext` of a credential plugin issuing tokens valid for seconds."""
+    log = tmp_path / 'plugin.log'
+    plugin = tmp_path / 'plugin'
+    plugin.write_text('#!/bin/sh\necho run >> "{}"\nprintf \'{{"status": {{"token": "t%s", '
+                      '"expirationTimestamp": "%s"}}}}\' $(wc -l < "{}") "$EXPIRY"\n'
+                      .format(log, log))
+    os.chmod(str(plugin), 0o755)
+    expiry = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+    kubeconfig = {
+        'contexts': [{'name': 'c', 'context': {'cluster': 'c', 'user': 'u'}}],
+        'clusters': [{'name': 'c', 'cluster': {'server': 'https://127.0.0.1'}}],
+        'users': [{'name': 'u', 'user': {'exec': {
+            'command': str(plugin),
+            'env': [{'name': 'EXPIRY', 'value': expiry.strftime('%Y-%m-%dT%H:%M:%SZ')}]}}}],
+    }
+    return KubeContext('c', kubeconfig)
+
+
+def test_exec_token_is_reused_until_it_expires(tmp_path):
+    context = exec_context(tmp_path, 3600)
+    assert [context.auth_headers() for _ in range(2)] == [{'Authorization': 'Bearer t1'}] * 2
+
+
+def test_expiring_exec_token_is_renewed(tmp_path):
+    context = exec_context(tmp_path, 10)
+    assert [context.auth_headers()['Authorization'] for _ in range(2)] == [
+        'Bearer t1', 'Bearer t2']
@@ -0,0 +1,56 @@
+"""Tests of the kubectl backend against a fake kubectl script."""
+import json
+import os
+
+import pytest
+import yaml
+
+from ci3 import kube
+from ci3.kube import KubectlBackend
+
+# Logs arguments, keeps applied objects in `calls.log.<namespace>`.
+FAKE_KUBECTL = """#!/bin/sh
+echo "$@" >> "{log}"
+for arg; do
+    if [ "$previous" = --namespace ]; then namespace=$arg; fi
+    if [ "$arg" = apply ]; then cat > "{log}.$namespace"; fi
+    previous=$arg
+done
+"""
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+    """Return function listing argument lines kubectl was called with so far."""
+    log = tmp_path / 'calls.log'
+    script = tmp_path / 'kubectl'
+    script.write_text(FAKE_KUBECTL.format(log=log))
+    os.chmod(str(script), 0o755)
+    monkeypatch.setattr(kube.kubectl, '_path', str(script))
+    return lambda: log.read_text().splitlines() if log.exists() else []
+
+
+def test_apply_defaults_namespace_of_objects_without_one(calls, tmp_path):
+    objects = [
+        {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'a'}},
+        {'apiVersion': 'v1', 'kind': 'ConfigMap', 'metadata': {'name': 'b', 'namespace': 'other'}},
+        {'apiVersion': 'v1', 'kind': 'Namespace', 'metadata': {'name': 'ns'}},
+    ]
+    results = KubectlBackend(context_name='ctx', namespace='ns').apply_batch(objects)
+    assert results == [(obj, None) for obj in objects]
+    assert calls() == [
+        '--context ctx --namespace ns apply -f -',
+        '--context ctx --namespace other apply -f -',
+    ]
+    applied = list(yaml.safe_load_all((tmp_path / 'calls.log.ns').read_text()))
+    assert [obj['metadata']['name'] for obj in applied] == ['a', 'ns']
+
+
+def test_patch_and_watch_use_namespace(calls):
+    backend = KubectlBackend(namespace='ns')
+    backend.patch_deployment('web', {'spec': {}})
+    list(backend.watch('apps/v1', 'Deployment'))
+    assert calls() == [
+        '--namespace ns patch deployment web -p ' + json.dumps({'spec': {}}),
+        '--namespace ns get deployment.apps --watch -o json',
+    ]
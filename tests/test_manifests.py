@@ -0,0 +1,28 @@
+"""Tests of parsing rendered k8s configuration and tracking applied objects."""
+import pytest
+
+from ci3.manifests import ChunkReader, DigestStore, iter_objects, load_objects
+
+TEXT = ''.join('---\napiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: c{}\ndata:\n  k: "{}"\n'
+               .format(index, 'x' * index) for index in range(50)) + '---\n# empty\n'
+
+
+def test_chunk_reader_reads_across_chunks():
+    reader = ChunkReader(['ab', '', 'cde'])
+    assert [reader.read(2), reader.read(2), reader.read(), reader.read(3)] == ['ab', 'cd', 'e', '']
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, len(TEXT)])
+def test_iter_objects_equals_load_objects(size):
+    chunks = (TEXT[start:start + size] for start in range(0, len(TEXT), size))
+    assert list(iter_objects(chunks)) == load_objects(TEXT)
+
+
+def test_digest_store_changed_objects(tmp_path):
+    objects = load_objects(TEXT)[:3]
+    store = DigestStore(str(tmp_path), 'minikube', 'ns')
+    assert store.changed(objects) == objects
+    store.save(objects)
+    edited = dict(objects[1], data={'k': 'edited'})
+    store = DigestStore(str(tmp_path), 'minikube', 'ns')
+    assert store.changed([objects[0], edited, objects[2]]) == [edited]
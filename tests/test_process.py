@@ -0,0 +1,86 @@
+"""Tests of the asyncio process engine and job cancellation."""
+import signal
+import threading
+import time
+
+import pytest
+
+from ci3.jobs import JobError, run_jobs
+from ci3.process import ProcessCancelled, ProcessError, ProcessTimeout, run
+
+
+def test_run_captures_output():
+    result = run(['sh', '-c', 'echo hello; echo world'])
+    assert result.exit_code == 0
+    assert str(result) == 'hello\nworld\n'
+
+
+def test_run_passes_output_lines_and_input_chunks():
+    lines = []
+    run(['cat'], stdin=iter(['one\n', b'two\n', 'three']), on_stdout=lines.append)
+    assert lines == ['one\n', 'two\n', 'three']
+
+
+def test_non_zero_exit_raises_with_stderr():
+    with pytest.raises(ProcessError) as info:
+        run(['sh', '-c', 'echo progress; echo "no such image" >&2; exit 3'])
+    assert info.value.exit_code == 3
+    assert 'exited with 3' in str(info.value)
+    assert 'no such image' in str(info.value)
+    assert 'progress' in info.value.result.tail
+
+
+def test_timeout_terminates_process():
+    start = time.time()
+    with pytest.raises(ProcessTimeout):
+        run(['sleep', '30'], timeout=0.2)
+    assert time.time() - start < 5
+
+
+def test_failure_cancels_running_siblings():
+    cancelled = []
+
+    def slow():
+        try:
+            run(['sleep', '30'])
+        except ProcessCancelled:
+            cancelled.append('slow')
+            raise
+
+    def failing():
+        time.sleep(0.2)
+        run(['sh', '-c', 'exit 1'])
+
+    start = time.time()
+    with pytest.raises(JobError) as info:
+        run_jobs({'slow': slow, 'failing': failing}, max_workers=2)
+    assert time.time() - start < 10
+    assert list(info.value.failures) == ['failing']
+    assert cancelled == ['slow']
+
+
+def test_failure_skips_pending_jobs():
+    started = []
+
+    def job(name, command):
+        started.append(name)
+        run(['sh', '-c', command])
+
+    with pytest.raises(JobError):
+        run_jobs({'first': lambda: job('first', 'exit 1'),
+                  'second': lambda: job('second', 'true')},
+                 max_workers=1)
+    assert started == ['first']
+
+
+def test_interrupt_terminates_running_jobs():
+    # Jobs' processes run in sessions of their own, Ctrl-C only reaches kubic.
+    main = threading.main_thread().ident
+    timer = threading.Timer(0.5, signal.pthread_kill, [main, signal.SIGINT])
+    timer.start()
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        run_jobs({'a': lambda: run(['sleep', '20']), 'b': lambda: run(['sleep', '20'])},
+                 max_workers=2)
+    timer.join()
+    assert time.time() - start < 5
@@ -0,0 +1,125 @@
+"""Tests of the registry v2 client against a stub registry."""
+import json
+
+import pytest
+
+from ci3.registry import MANIFEST_TYPES, Registry, RegistryError, parse_reference
+
+CONFIG = 'sha256:c0'
+LAYERS = ['sha256:l1', 'sha256:l2']
+MANIFEST = json.dumps({
+    'schemaVersion': 2,
+    'mediaType': MANIFEST_TYPES[0],
+    'config': {'digest': CONFIG},
+    'layers': [{'digest': digest} for digest in LAYERS],
+}).encode('utf-8')
+DIGEST = 'sha256:m1'
+
+
+def stub_registry(fake_server, blobs=(CONFIG,) + tuple(LAYERS), token=None):
+    """
+    Start registry with `MANIFEST` tagged `app:commit-1` and the given blobs.
+
+    With token set, requests need it as bearer token from `/token`, which
+    only hands it out for a known scope.
+    """
+    tags = {'commit-1': MANIFEST}
+
+    def handle(request):
+        path = request.path.split('?')[0]
+        if path == '/token':
+            if 'scope=' not in request.path:
+                return 403, {}, b''
+            return 200, {}, json.dumps({'token': token}).encode('utf-8')
+        if token and request.headers.get('Authorization') != 'Bearer ' + token:
+            return 401, {'WWW-Authenticate': 'Bearer realm="{}/token",service="stub",'
+                                             'scope="repository:app:pull"'.format(server.url)}, b''
+        _, _, repository, kind, reference = path.split('/', 4)
+        if kind == 'blobs':
+            return (200 if reference in blobs else 404), {}, b''
+        if request.method == 'PUT':
+            tags[reference] = request.body
+            return 201, {'Docker-Content-Digest': DIGEST}, b''
+        if repository != 'app' or reference not in tags:
+            return 404, {}, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}'
+        return 200, {'Content-Type': MANIFEST_TYPES[0], 'Docker-Content-Digest': DIGEST}, \
+            tags[reference]
+    server = fake_server(handle)
+    return server, Registry(server.host)
+
+
+def test_parse_reference():
+    assert parse_reference('localhost:5000/app:commit-1') == ('localhost:5000', 'app', 'commit-1')
+    assert parse_reference('gcr.io/p/app') == ('gcr.io', 'p/app', 'latest')
+    assert parse_reference('nginx:1') == ('registry-1.docker.io', 'nginx', '1')
+    assert parse_reference('gcr.io/p/app@sha256:ab') == ('gcr.io', 'p/app', 'sha256:ab')
+
+
+def test_find_image_found(fake_server):
+    server, registry = stub_registry(fake_server)
+    assert registry.find_image('app', CONFIG, ['missing', 'commit-1']) == (
+        MANIFEST_TYPES[0], MANIFEST, DIGEST)
+    assert registry.manifest_digest('app', 'commit-1') == DIGEST
+    heads = [request.path for request in server.requests if request.method == 'HEAD']
+    assert heads == ['/v2/app/blobs/' + digest for digest in [CONFIG] + LAYERS] + [
+        '/v2/app/manifests/commit-1']
+
+
+def test_find_image_missing_manifest(fake_server):
+    _, registry = stub_registry(fake_server)
+    assert registry.find_image('app', CONFIG, ['branch']) is None
+    assert registry.find_image('other', CONFIG, ['commit-1']) is None
+    assert registry.manifest_digest('app', 'branch') is None
+
+
+def test_find_image_of_other_config(fake_server):
+    _, registry = stub_registry(fake_server)
+    assert registry.find_image('app', 'sha256:other', ['commit-1']) is None
+
+
+def test_find_image_with_missing_blob(fake_server):
+    _, registry = stub_registry(fake_server, blobs=(CONFIG, LAYERS[0]))
+    assert registry.find_image('app', CONFIG, ['commit-1']) is None
+
+
+def test_put_manifest_adds_tag(fake_server):
+    server, registry = stub_registry(fake_server)
+    registry.put_manifest('app', 'commit-2', MANIFEST_TYPES[0], MANIFEST)
+    request = server.requests[-1]
+    assert (request.method, request.path) == ('PUT', '/v2/app/manifests/commit-2')
+    assert request.headers['Content-Type'] == MANIFEST_TYPES[0]
+    assert registry.manifest_digest('app', 'commit-2') == DIGEST
+
+
+def test_bearer_token_is_fetched_once_per_scope(fake_server):
+    server, registry = stub_registry(fake_server, token='tok')
+    assert registry.find_image('app', CONFIG, ['commit-1']) is not None
+    assert registry.manifest_digest('app', 'commit-1') == DIGEST
+    paths = [request.path.split('?')[0] for request in server.requests]
+    assert paths.count('/token') == 1
+    assert sum(1 for request in server.requests if request.headers.get('Authorization')) == \
+        len(paths) - 2
+
+
+def test_rejected_token_raises(fake_server):
+    _, registry = stub_registry(fake_server, token='tok')
+    registry._authorize = lambda challenge: 'Bearer wrong'
+    with pytest.raises(RegistryError) as info:
+        registry.manifest('app', 'commit-1')
+    assert '401' in str(info.value)
+
+
+def test_basic_auth_without_credentials_raises(fake_server):
+    server = fake_server(lambda request: (401, {'WWW-Authenticate': 'Basic realm="stub"'}, b''))
+    with pytest.raises(RegistryError) as info:
+        Registry(server.host).manifest('app', 'commit-1')
+    assert 'requires credentials' in str(info.value)
+
+
+def test_basic_auth_with_credentials(fake_server):
+    def handle(request):
+        if request.headers.get('Authorization') != 'Basic dXNlcjpwYXNz':
+            return 401, {'WWW-Authenticate': 'Basic realm="stub"'}, b''
+        return 200, {'Docker-Content-Digest': DIGEST}, b''
+    server = fake_server(handle)
+    assert Registry(server.host, ('user', 'pass')).manifest_digest('app', 'commit-1') == DIGEST